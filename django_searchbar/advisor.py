@@ -0,0 +1,255 @@
+import hashlib
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections, models, router
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.functions import Upper
+from django.urls import get_resolver, URLPattern, URLResolver
+from django_searchbar.mixins import SearchBarViewMixin
+from django_searchbar.planning import PATH_PREFIXES
+from django_searchbar.terms import PREFIXES
+from django_searchbar.utils import listify
+
+# A B-tree index on the column helps these lookups
+INDEXED_LOOKUPS = ('', 'exact', 'in', 'gt', 'gte', 'lt', 'lte', 'range', 'startswith', 'isnull', 'date', 'year')
+# PostgreSQL and Oracle compare UPPER(column) for these, they need an index on the expression
+UPPER_LOOKUPS = ('iexact', 'istartswith')
+# The lookups a composite index can have after its equality columns
+RANGE_LOOKUPS = ('gt', 'gte', 'lt', 'lte', 'range', 'startswith', 'istartswith', 'date', 'year')
+
+STATUSES = {
+    'indexed': 'indexed',
+    'missing': 'missing index',
+    'unindexable': 'no index helps, use a full text or trigram backend',
+    'unresolved': 'not a column of the model',
+}
+
+
+class Advice:
+
+    """
+    How a search field of a view is looked up, and whether an index supports it
+    ``status`` is one of STATUSES, ``index`` the name of the existing index or the suggested models.Index,
+    ``upper`` whether the index is on UPPER(column).
+    """
+
+    def __init__(self, view, label, path, lookup, model=None, column=None, status='unresolved', index=None,
+                 required=False, upper=False):
+        self.view = view
+        self.label = label
+        self.path = path
+        self.lookup = lookup
+        self.model = model
+        self.column = column
+        self.status = status
+        self.index = index
+        self.required = required
+        self.upper = upper
+
+    @property
+    def target(self):
+        if self.model is None:
+            return self.path
+        return '%s.%s' % (self.model._meta.label, self.column)
+
+    def __str__(self):
+        return '%s %s (%s): %s' % (self.label, self.target, self.lookup or 'exact', STATUSES[self.status])
+
+    def __repr__(self):
+        return '<Advice %s>' % self
+
+
+def iter_views(patterns=None, prefix=''):
+    """
+    Yields the (route, view class) of the URLconf whose views use SearchBarViewMixin
+    """
+    if patterns is None:
+        patterns = get_resolver().url_patterns
+
+    for pattern in patterns:
+        route = prefix + str(pattern.pattern)
+        if isinstance(pattern, URLResolver):
+            yield from iter_views(pattern.url_patterns, route)
+        elif isinstance(pattern, URLPattern):
+            view_class = getattr(pattern.callback, 'view_class', None)
+            if isinstance(view_class, type) and issubclass(view_class, SearchBarViewMixin):
+                yield route, view_class
+
+
+def get_view_model(view_class):
+    if getattr(view_class, 'model', None) is not None:
+        return view_class.model
+    if getattr(view_class, 'queryset', None) is not None:
+        return view_class.queryset.model
+    return None
+
+
+def get_index_name(model, columns, suffix='idx'):
+    """
+    A name like the ones of django's indexes: a part of the table and of the first column, and a hash
+    """
+    digest = hashlib.md5(('%s:%s' % (model._meta.db_table, ','.join(columns))).encode('utf-8')).hexdigest()[:6]
+    return '%s_%s_%s_%s' % (model._meta.db_table[:11], columns[0][:7], digest, suffix)
+
+
+def get_indexes(model):
+    """
+    Returns the existing indexes of the model, as (name, leading columns, upper) tuples
+    Only the leading column of an index helps a search on its own.
+    """
+    indexes = []
+    for field in model._meta.local_concrete_fields:
+        if field.primary_key or field.unique or field.db_index:
+            indexes.append((field.name, (field.name,), False))
+    for index in model._meta.indexes:
+        if index.fields:
+            indexes.append((index.name, tuple(name.lstrip('-') for name in index.fields), False))
+        for expression in index.expressions:
+            if isinstance(expression, Upper):
+                indexes.append((index.name, tuple(str(source.name) for source in expression.get_source_expressions()), True))
+    for constraint in model._meta.constraints:
+        if isinstance(constraint, models.UniqueConstraint) and constraint.fields and constraint.condition is None:
+            indexes.append((constraint.name, tuple(constraint.fields), False))
+    for fields in list(model._meta.unique_together) + list(getattr(model._meta, 'index_together', ())):
+        indexes.append((','.join(fields), tuple(fields), False))
+    return indexes
+
+
+def find_index(model, columns, upper=False):
+    """
+    Returns the name of an index starting with the columns, or None
+    """
+    columns = tuple(columns)
+    for name, index_columns, index_upper in get_indexes(model):
+        if index_upper == upper and index_columns[:len(columns)] == columns:
+            return name
+    return None
+
+
+def resolve_column(model, path):
+    """
+    Follows a lookup path to the model and column it ends on
+    @return tuple: (model, column, lookup) or None when the path is not a column
+    """
+    parts = path.split(LOOKUP_SEP)
+    for position, part in enumerate(parts):
+        try:
+            field = model._meta.get_field(part)
+        except FieldDoesNotExist:
+            return None
+        rest = parts[position + 1:]
+        if field.is_relation and field.related_model is not None and rest:
+            try:
+                field.related_model._meta.get_field(rest[0])
+            except FieldDoesNotExist:
+                pass
+            else:
+                model = field.related_model
+                continue
+        if not field.concrete:
+            return None
+        return model, field.name, LOOKUP_SEP.join(rest)
+    return None
+
+
+def get_searches(view_class):
+    """
+    Yields the (label, path, lookup, required) of the search fields of a view, after replacements
+    Full text fields are left out, their backend has its own index.
+    """
+    replacements = getattr(view_class, 'searchbar_replacements', {}) or {}
+    for field in listify(view_class.searchbar_fields):
+        spec = field if isinstance(field, dict) else {'label': field}
+        if spec.get('fulltext'):
+            continue
+
+        label = spec['label']
+        replacement = replacements.get(label, label) if isinstance(replacements, dict) else label
+        if callable(replacement):
+            replacement = replacement(label)
+
+        lookup = spec.get('lookup', '')
+        if spec.get('type') == 'terms':
+            lookup = lookup or 'icontains'
+            for target in listify(replacement):
+                if target[0] in PREFIXES:
+                    yield label, target.lstrip(PATH_PREFIXES), PREFIXES[target[0]], spec.get('required', False)
+                else:
+                    yield label, target, lookup, spec.get('required', False)
+        else:
+            for target in listify(replacement):
+                yield label, target, lookup, spec.get('required', False)
+
+
+def get_index_kind(connection, lookup):
+    """
+    How the database can use an index for the lookup
+    @return str|None: 'column' for an index on the column, 'upper' for one on UPPER(column), None when none helps
+    """
+    if lookup in INDEXED_LOOKUPS:
+        return 'column'
+    if lookup in UPPER_LOOKUPS:
+        if 'UPPER(' in connection.operators.get(lookup, ''):
+            return 'upper'
+        # MySQL compares in the case insensitive collation of the column, SQLite uses LIKE which no index helps
+        if connection.vendor == 'mysql':
+            return 'column'
+    return None
+
+
+def advise(view_class, model=None, using=None):
+    """
+    Checks the indexes behind the search fields of a view
+    @param using: the database the searches run on, the one the router reads the model from by default
+    @return tuple: (advices, suggestions) where suggestions are (model, models.Index) pairs of the missing indexes
+    """
+    model = model or get_view_model(view_class)
+    advices = []
+    for label, path, lookup, required in get_searches(view_class):
+        advice = Advice(view_class, label, path, lookup, required=required)
+        advices.append(advice)
+        resolved = resolve_column(model, path) if model is not None else None
+        if resolved is None:
+            continue
+
+        advice.model, advice.column, path_lookup = resolved
+        advice.lookup = lookup = path_lookup or lookup
+        kind = get_index_kind(connections[using or router.db_for_read(advice.model)], lookup)
+        if kind is None:
+            advice.status = 'unindexable'
+            continue
+        advice.upper = kind == 'upper'
+        advice.index = find_index(advice.model, [advice.column], upper=advice.upper)
+        advice.status = 'indexed' if advice.index else 'missing'
+
+    suggestions = []
+    composites = {}
+    for advice in advices:
+        # The fields that are always there can share an index: equalities first, then one range
+        if advice.required and advice.status in ('indexed', 'missing') and not advice.upper:
+            composites.setdefault(advice.model, []).append(advice)
+
+    for composite_model, composite in composites.items():
+        if len(composite) < 2:
+            continue
+        composite.sort(key=lambda advice: advice.lookup in RANGE_LOOKUPS)
+        columns = [advice.column for advice in composite if advice.lookup not in RANGE_LOOKUPS]
+        columns += [advice.column for advice in composite if advice.lookup in RANGE_LOOKUPS][:1]
+        if len(columns) > 1 and find_index(composite_model, columns) is None:
+            index = models.Index(fields=columns, name=get_index_name(composite_model, columns))
+            suggestions.append((composite_model, index))
+            for advice in composite:
+                if advice.column in columns and advice.status == 'missing':
+                    advice.index = index
+
+    for advice in advices:
+        if advice.status != 'missing' or advice.index is not None:
+            continue
+        if advice.upper:
+            index = models.Index(Upper(advice.column), name=get_index_name(advice.model, [advice.column], 'upper'))
+        else:
+            index = models.Index(fields=[advice.column], name=get_index_name(advice.model, [advice.column]))
+        if not any(suggested.name == index.name for suggested_model, suggested in suggestions):
+            suggestions.append((advice.model, index))
+        advice.index = index
+
+    return advices, suggestions
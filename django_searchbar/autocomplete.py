@@ -0,0 +1,244 @@
+import bisect
+import collections
+import hashlib
+import json
+import threading
+from django.core.cache import caches
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.views.generic import View
+from django_searchbar.cache import ModelVersions
+from django_searchbar.coalescing import Call
+from django_searchbar.planning import PATH_PREFIXES
+from django_searchbar.utils import listify
+
+
+class PrefixIndex:
+
+    """
+    The distinct values of a column kept sorted in this process, searched with bisect instead of a query
+    It suits small vocabularies (tags, cities, first names): a column with more than ``max_size`` values is left
+    to the database. An index is loaded once for each version of its model, the ``max_entries`` columns (and
+    querysets) searched last are kept. The concurrent misses of a column wait for the one loading it, the
+    other columns are searched and loaded meanwhile.
+    """
+
+    def __init__(self, max_size=5000, max_entries=64):
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        # The loads running, by key and version
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def load(self, queryset, target):
+        values = list(queryset.order_by().values_list(target, flat=True).distinct()[:self.max_size + 1])
+        if len(values) > self.max_size:
+            return None
+        pairs = sorted((str(value).casefold(), str(value)) for value in values if value not in (None, ''))
+        return [key for key, value in pairs], [value for key, value in pairs]
+
+    def search(self, queryset, target, prefix, limit, version=None):
+        """
+        @return list|None: the first ``limit`` values starting with the prefix, whatever the case,
+                           None when the column has too many values for the index
+        """
+        key = (queryset.model._meta.label_lower, target, str(queryset.query))
+        call = None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+            else:
+                call = self.loading.get((key, version))
+                leader = call is None
+                if leader:
+                    call = self.loading[(key, version)] = Call()
+
+        if call is not None:
+            if leader:
+                try:
+                    call.result = (version, self.load(queryset, target))
+                except Exception as e:
+                    call.error = e
+                    raise
+                finally:
+                    with self.lock:
+                        del self.loading[(key, version)]
+                        if call.error is None:
+                            self.entries[key] = call.result
+                            self.entries.move_to_end(key)
+                            while len(self.entries) > self.max_entries:
+                                self.entries.popitem(last=False)
+                    call.event.set()
+            else:
+                call.event.wait()
+                if call.error is not None:
+                    raise call.error
+            entry = call.result
+
+        if entry[1] is None:
+            return None
+
+        keys, values = entry[1]
+        prefix = prefix.casefold()
+        start = bisect.bisect_left(keys, prefix)
+        results = []
+        for position in range(start, len(keys)):
+            if len(results) == limit or not keys[position].startswith(prefix):
+                break
+            results.append(values[position])
+        return results
+
+
+class Autocomplete:
+
+    """
+    Suggests the values of a search field starting with what has been typed so far, for typeahead.
+    Usage:
+        autocomplete = Autocomplete(['username', 'email'], label='username')
+        # or with the spec of a view
+        autocomplete = Autocomplete.from_view(UserSearchView, label='username')
+        suggestions = autocomplete.suggest(User.objects.all(), 'ars')
+
+    The field goes through the replacements like in SearchBar, each of its targets is looked up with a bounded
+    istartswith query, which an index on UPPER(column) supports (see the searchbar_indexes command), or in a
+    PrefixIndex when one is given. The responses of the prefixes up to ``cache_length`` characters, the ones
+    matching the most rows and typed by everyone, are cached under a version of the model.
+    """
+
+    def __init__(self, fields, replacements={}, label=None, limit=10, min_length=1, cache_length=3, timeout=300,
+                 index=None, alias='default', key_prefix='searchbar'):
+        """
+        @param label: the field to suggest values of, the first field of the spec by default
+        @param limit: the maximum number of suggestions
+        @param min_length: shorter prefixes have no suggestions
+        @param index: a PrefixIndex for the small vocabularies
+        """
+        fields = listify(fields)
+        if label is None:
+            label = fields[0]['label'] if isinstance(fields[0], dict) else fields[0]
+        assert any(label == (item['label'] if isinstance(item, dict) else item) for item in fields), \
+            '%s is not a field of the spec' % label
+
+        self.fields = fields
+        self.replacements = replacements
+        self.label = label
+        self.limit = limit
+        self.min_length = min_length
+        self.cache_length = cache_length
+        self.timeout = timeout
+        self.index = index
+        self.alias = alias
+        self.key_prefix = key_prefix
+        self.versions = ModelVersions(alias, key_prefix)
+
+    @classmethod
+    def from_view(cls, view_class, **kwargs):
+        """
+        Builds the autocomplete of a SearchBarViewMixin view, with its searchbar_fields and searchbar_replacements
+        """
+        return cls(view_class.searchbar_fields, getattr(view_class, 'searchbar_replacements', {}), **kwargs)
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get_version(self, model):
+        self.versions.watch(model)
+        return self.versions.get(model)
+
+    def get_targets(self):
+        """
+        Returns the columns the field searches, after replacements
+        """
+        replacement = self.replacements.get(self.label, self.label) if isinstance(self.replacements, dict) else self.label
+        if callable(replacement):
+            replacement = replacement(self.label)
+        return [target.lstrip(PATH_PREFIXES) for target in listify(replacement)]
+
+    def get_key(self, queryset, prefix, version):
+        query = '%s:%s:%s:%s' % (self.label, self.limit, self.get_targets(), queryset.query)
+        return '%s:autocomplete:%s:%s:%s:%s' % (
+            self.key_prefix,
+            queryset.model._meta.label_lower,
+            version,
+            hashlib.md5(query.encode('utf-8')).hexdigest(),
+            hashlib.md5(prefix.casefold().encode('utf-8')).hexdigest(),
+        )
+
+    def suggest(self, queryset, prefix, version=None):
+        """
+        @return list: up to ``limit`` distinct values of the field starting with the prefix
+        """
+        prefix = prefix.strip()
+        if len(prefix) < self.min_length:
+            return []
+        if self.index is not None and version is None:
+            version = self.get_version(queryset.model)
+
+        results = []
+        for target in self.get_targets():
+            values = None
+            if self.index is not None:
+                values = self.index.search(queryset, target, prefix, self.limit, version)
+            if values is None:
+                values = (queryset.filter(**{'%s__istartswith' % target: prefix}).order_by(target)
+                          .values_list(target, flat=True).distinct()[:self.limit])
+            for value in values:
+                if value not in results:
+                    results.append(value)
+            if len(results) >= self.limit:
+                break
+        return results[:self.limit]
+
+    def get_content(self, queryset, prefix):
+        """
+        @return bytes: the suggestions as compact JSON, cached for the short prefixes
+        """
+        prefix = prefix.strip()
+        if len(prefix) < self.min_length:
+            return self.dumps([])
+        version = self.get_version(queryset.model)
+        if len(prefix) > self.cache_length:
+            return self.dumps(self.suggest(queryset, prefix, version))
+
+        key = self.get_key(queryset, prefix, version)
+        content = self.cache.get(key)
+        if content is None:
+            content = self.dumps(self.suggest(queryset, prefix, version))
+            self.cache.set(key, content, self.timeout)
+        return content
+
+    def dumps(self, suggestions):
+        return json.dumps(suggestions, separators=(',', ':'), ensure_ascii=False, default=str).encode('utf-8')
+
+
+class AutocompleteView(View):
+
+    """
+    Answers GET ?q=<prefix> with a JSON list of suggestions, e.g. ["arsham","arshia"]
+    Usage:
+        class UserAutocompleteView(AutocompleteView):
+            model = User
+            autocomplete = Autocomplete.from_view(UserSearchView, label='username')
+
+    Override get_queryset to restrict the suggestions, e.g. to what the user can see.
+    """
+
+    model = None
+    queryset = None
+    autocomplete = None
+    autocomplete_kwarg = 'q'
+
+    def get_queryset(self):
+        if self.queryset is not None:
+            return self.queryset.all()
+        assert self.model is not None, 'You should provide a model or a queryset attribute in your class'
+        return self.model._default_manager.all()
+
+    def get(self, request, *args, **kwargs):
+        assert self.autocomplete is not None, 'You should provide an autocomplete attribute in your class'
+        prefix = request.GET.get(self.autocomplete_kwarg, '')
+        if len(prefix) > 100:
+            return HttpResponseBadRequest('The prefix is too long')
+        return HttpResponse(self.autocomplete.get_content(self.get_queryset(), prefix), content_type='application/json')
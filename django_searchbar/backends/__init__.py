@@ -0,0 +1,94 @@
+"""
+Full text search backends for the 'fulltext' fields of a SearchBar:
+    people_index = FTS5Backend(Person, ['name', 'bio'])
+    search_bar = SearchBar(request, [{'label': 'q', 'fulltext': people_index}])
+    Person.objects.filter(search_bar.get_filters())
+
+get_filters turns the input of the field into a primary key subquery, 'pk__in', or '<replacement>__in'
+when the field has a replacement, e.g. to search the profiles of people.
+"""
+import weakref
+from django.db import router, connections
+from django.db.models.signals import post_save, post_delete
+
+# The backends in use, a backend leaves it once it isn't referenced anymore
+registry = weakref.WeakSet()
+
+
+class SearchBackend:
+
+    """
+    The interface of the full text backends
+    A backend mirrors ``fields`` of ``model`` in an index kept up to date by post_save/post_delete,
+    and by the searchbar_fulltext management command for the changes that don't send signals.
+    The searches go to the database the router reads the model from, the index changes to the one of the row.
+    The backends with registered False, e.g. the indexes kept in memory, are left out of the registry.
+    """
+    registered = True
+
+    def __init__(self, model, fields, watch=True):
+        self.model = model
+        self.fields = list(fields)
+        if self.registered:
+            registry.add(self)
+        if watch:
+            self.watch()
+
+    @property
+    def connection(self):
+        return connections[router.db_for_read(self.model)]
+
+    @property
+    def write_connection(self):
+        """
+        The connection install() and sync() change the index on
+        """
+        return connections[router.db_for_write(self.model)]
+
+    def watch(self):
+        # Weak receivers, so the backends that aren't used anymore go away with their receivers
+        dispatch_uid = 'searchbar-fulltext-%s' % id(self)
+        post_save.connect(self.on_save, sender=self.model, dispatch_uid=dispatch_uid)
+        post_delete.connect(self.on_delete, sender=self.model, dispatch_uid=dispatch_uid)
+
+    def unwatch(self):
+        dispatch_uid = 'searchbar-fulltext-%s' % id(self)
+        post_save.disconnect(sender=self.model, dispatch_uid=dispatch_uid)
+        post_delete.disconnect(sender=self.model, dispatch_uid=dispatch_uid)
+
+    def on_save(self, sender, instance, **kwargs):
+        self.update(instance)
+
+    def on_delete(self, sender, instance, **kwargs):
+        self.delete(instance)
+
+    def install(self):
+        """
+        Creates the index
+        """
+        raise NotImplementedError
+
+    def sync(self, rebuild=False):
+        """
+        Adds the missing rows to the index, indexes again the changed ones and removes the ones that are gone,
+        or indexes everything again
+        """
+        raise NotImplementedError
+
+    def update(self, instance):
+        raise NotImplementedError
+
+    def delete(self, instance):
+        raise NotImplementedError
+
+    def search(self, value):
+        """
+        Returns what goes in a pk__in lookup for the rows matching value: an expression or a queryset
+        """
+        raise NotImplementedError
+
+    def rank(self, queryset, value, alias='search_rank'):
+        """
+        Annotates the queryset with the relevance of the rows for value (lower is better) and orders by it
+        """
+        raise NotImplementedError
@@ -0,0 +1,131 @@
+import re
+import warnings
+from django.db import connections
+from django.db.models import F, FloatField, Func
+from django.db.models.expressions import RawSQL
+from django_searchbar.backends import SearchBackend
+
+
+class Rank(Func):
+
+    """
+    The FTS5 rank of a row for a query, the rowid being the column of the primary key wherever the query puts it.
+    FTS5 answers a MATCH restricted to a rowid by seeking that rowid in the index, not by matching every row.
+    """
+
+    template = '(SELECT rank FROM %(table)s WHERE %(table)s MATCH %%s AND rowid = %(expressions)s)'
+    output_field = FloatField()
+
+    def __init__(self, expression, query, **extra):
+        super(Rank, self).__init__(expression, **extra)
+        self.query = query
+
+    def as_sql(self, compiler, connection, **extra_context):
+        sql, params = super(Rank, self).as_sql(compiler, connection, **extra_context)
+        return sql, [self.query] + list(params)
+
+
+class FTS5Backend(SearchBackend):
+
+    """
+    A SQLite FTS5 virtual table mirroring some columns of a model, with the primary key as rowid.
+    Run install() (or the searchbar_fulltext management command) once to create it.
+    The input is split into words, each one matching as a prefix, all of them have to match.
+    Saving a row before the index is installed only warns, the next sync indexes it.
+    """
+
+    def __init__(self, model, fields, watch=True, table=None, tokenize='unicode61', prefix=True):
+        assert model._meta.pk.get_internal_type() in ('AutoField', 'BigAutoField', 'IntegerField', 'BigIntegerField'), \
+            'FTS5 needs an integer primary key'
+        super(FTS5Backend, self).__init__(model, fields, watch)
+
+        self.table = table or 'searchbar_fts_%s' % model._meta.db_table
+        self.tokenize = tokenize
+        self.prefix = prefix
+        self.columns = [model._meta.get_field(field).column for field in self.fields]
+        # The aliases of the databases the index is known to be installed on
+        self.installed = set()
+
+    def quote(self, name):
+        return self.connection.ops.quote_name(name)
+
+    def is_installed(self, connection):
+        if connection.alias not in self.installed and self.table in connection.introspection.table_names():
+            self.installed.add(connection.alias)
+        return connection.alias in self.installed
+
+    def install(self):
+        connection = self.write_connection
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, tokenize='%s')" % (
+                self.quote(self.table), ', '.join(self.quote(column) for column in self.columns), self.tokenize))
+        self.installed.add(connection.alias)
+
+    def uninstall(self):
+        connection = self.write_connection
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS %s' % self.quote(self.table))
+        self.installed.discard(connection.alias)
+
+    def sync(self, rebuild=False):
+        table = self.quote(self.table)
+        model_table = self.quote(self.model._meta.db_table)
+        pk = self.quote(self.model._meta.pk.column)
+        columns = ', '.join(self.quote(column) for column in self.columns)
+
+        with self.write_connection.cursor() as cursor:
+            if rebuild:
+                cursor.execute('DELETE FROM %s' % table)
+            else:
+                # The rows that are gone, and the ones changed without signals (update(), raw SQL), which are
+                # inserted again below
+                changed = ' OR '.join('f.%s IS NOT m.%s' % (column, column) for column in map(self.quote, self.columns))
+                cursor.execute(
+                    'DELETE FROM %s WHERE rowid IN (SELECT f.rowid FROM %s f LEFT JOIN %s m ON m.%s = f.rowid '
+                    'WHERE m.%s IS NULL OR %s)' % (table, table, model_table, pk, pk, changed))
+            cursor.execute('INSERT INTO %s (rowid, %s) SELECT %s, %s FROM %s WHERE %s NOT IN (SELECT rowid FROM %s)' % (
+                table, columns, pk, columns, model_table, pk, table))
+
+    def update(self, instance):
+        connection = connections[instance._state.db]
+        if not self.is_installed(connection):
+            warnings.warn('The full text index %s is not installed, run the searchbar_fulltext command' % self.table)
+            return
+        values = [getattr(instance, field.attname) for field in map(self.model._meta.get_field, self.fields)]
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid = %%s' % self.quote(self.table), [instance.pk])
+            cursor.execute('INSERT INTO %s (rowid, %s) VALUES (%s)' % (
+                self.quote(self.table),
+                ', '.join(self.quote(column) for column in self.columns),
+                ', '.join(['%s'] * (len(self.columns) + 1)),
+            ), [instance.pk] + values)
+
+    def delete(self, instance):
+        connection = connections[instance._state.db]
+        if not self.is_installed(connection):
+            return
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid = %%s' % self.quote(self.table), [instance.pk])
+
+    def get_query(self, value):
+        """
+        Turns the input into a FTS5 query, the words are quoted so the input can't use the query syntax
+        @return str|None: None when there is no word to search for
+        """
+        words = re.findall(r'\w+', str(value))
+        if not words:
+            return None
+        suffix = '*' if self.prefix else ''
+        return ' '.join('"%s"%s' % (word.replace('"', '""'), suffix) for word in words)
+
+    def search(self, value):
+        query = self.get_query(value)
+        if query is None:
+            return RawSQL('SELECT rowid FROM %s WHERE 0' % self.quote(self.table), [])
+        return RawSQL('SELECT rowid FROM %s WHERE %s MATCH %%s' % (self.quote(self.table), self.quote(self.table)), [query])
+
+    def rank(self, queryset, value, alias='search_rank'):
+        query = self.get_query(value)
+        if query is None:
+            return queryset
+        return queryset.annotate(**{alias: Rank(F('pk'), query, table=self.quote(self.table))}).order_by(alias)
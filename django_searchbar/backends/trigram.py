@@ -0,0 +1,178 @@
+import collections
+import sys
+import threading
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, When
+from django_searchbar.backends import SearchBackend
+
+SEPARATOR = '\x00'
+TRIGRAM_LENGTH = 3
+
+
+def get_trigrams(text):
+    return {text[i:i + TRIGRAM_LENGTH] for i in range(len(text) - TRIGRAM_LENGTH + 1)}
+
+
+class TrigramBackend(SearchBackend):
+
+    """
+    An in-process trigram index of some fields of a small or medium model, for the tables that are searched
+    too often for LIKE '%term%' scans but are too small for a search server.
+    The index is built from the database on the first search (or install/sync), and kept up to date by
+    post_save/post_delete once their transaction is committed. Searches return the matching primary keys,
+    get_filters turns them into pk__in.
+        substring: the rows containing the input, case insensitive, like icontains
+        fuzzy: the rows sharing at least ``threshold`` of the trigrams of the input, best matches first
+    An input shorter than a trigram matches nothing. A search returns at most ``limit`` primary keys, so the
+    pk__in stays within the query parameters of the database: a substring search matching more rows is run by
+    the database (icontains), a fuzzy search keeps the best ``limit`` matches.
+    The index is rebuilt from the database by each process, it isn't in the registry of searchbar_fulltext.
+    Each process has its own copy, see memory_usage(). The signals only reach the copy of the process that saved
+    the row: with several workers, give ``versions`` (a django_searchbar.cache.ModelVersions on a shared cache)
+    and each copy is built again on its next search after the model changed.
+    """
+
+    registered = False
+
+    def __init__(self, model, fields, watch=True, fuzzy=False, threshold=0.5, limit=500, versions=None):
+        super(TrigramBackend, self).__init__(model, fields, watch)
+        self.fuzzy = fuzzy
+        self.threshold = threshold
+        self.limit = limit
+        self.versions = versions
+        if versions is not None:
+            versions.watch(model)
+        self.attnames = [model._meta.get_field(field).attname for field in self.fields]
+        self.documents = None
+        self.trigrams = None
+        self.version = None
+        self.lock = threading.RLock()
+
+    def get_document(self, values):
+        return SEPARATOR.join('' if value is None else str(value) for value in values).lower()
+
+    def add(self, pk, document):
+        self.documents[pk] = document
+        for trigram in get_trigrams(document):
+            self.trigrams[trigram].add(pk)
+
+    def remove(self, pk):
+        document = self.documents.pop(pk, None)
+        if document is None:
+            return
+        for trigram in get_trigrams(document):
+            pks = self.trigrams.get(trigram)
+            if pks is not None:
+                pks.discard(pk)
+                if not pks:
+                    del self.trigrams[trigram]
+
+    def install(self):
+        self.sync(rebuild=True)
+
+    def sync(self, rebuild=False):
+        with self.lock:
+            self.version = self.versions.get(self.model) if self.versions is not None else None
+            self.documents = {}
+            self.trigrams = collections.defaultdict(set)
+            for row in self.model._base_manager.values_list('pk', *self.attnames).iterator():
+                self.add(row[0], self.get_document(row[1:]))
+
+    def ensure_index(self):
+        if self.documents is None or (self.versions is not None and self.versions.get(self.model) != self.version):
+            self.sync()
+
+    def update(self, instance):
+        if self.documents is None:
+            return
+        pk = instance.pk
+        document = self.get_document(getattr(instance, attname) for attname in self.attnames)
+        transaction.on_commit(lambda: self.replace(pk, document), using=instance._state.db)
+
+    def delete(self, instance):
+        if self.documents is None:
+            return
+        pk = instance.pk
+        transaction.on_commit(lambda: self.replace(pk, None), using=instance._state.db)
+
+    def replace(self, pk, document):
+        """
+        Changes the indexed document of pk, once the transaction that changed the row is committed
+        """
+        with self.lock:
+            if self.documents is None:
+                return
+            self.remove(pk)
+            if document is not None:
+                self.add(pk, document)
+
+    def get_matches(self, value):
+        """
+        @return list: up to ``limit`` matching primary keys, best matches first when fuzzy, sorted otherwise.
+                      None for a substring matching more than ``limit`` rows.
+        """
+        query = str(value).lower()
+        if len(query) < TRIGRAM_LENGTH:
+            return []
+        query_trigrams = get_trigrams(query)
+
+        with self.lock:
+            self.ensure_index()
+
+            if not self.fuzzy:
+                postings = sorted((self.trigrams.get(trigram, ()) for trigram in query_trigrams), key=len)
+                candidates = set(postings[0]).intersection(*postings[1:])
+                matches = []
+                for pk in candidates:
+                    if query in self.documents[pk]:
+                        if len(matches) == self.limit:
+                            return None
+                        matches.append(pk)
+                return sorted(matches)
+
+            counts = collections.Counter()
+            for trigram in query_trigrams:
+                counts.update(self.trigrams.get(trigram, ()))
+            needed = self.threshold * len(query_trigrams)
+            return [pk for pk, count in counts.most_common() if count >= needed][:self.limit]
+
+    def get_queryset(self, value):
+        """
+        The rows containing value, searched by the database
+        """
+        condition = Q()
+        for attname in self.attnames:
+            condition |= Q(**{'%s__icontains' % attname: value})
+        return self.model._base_manager.filter(condition)
+
+    def search(self, value):
+        pks = self.get_matches(value)
+        if pks is None:
+            return self.get_queryset(value).values('pk')
+        return pks
+
+    def rank(self, queryset, value, alias='search_rank'):
+        pks = self.get_matches(value)
+        if pks is None:
+            # Too many substring matches to list, they are in the order of their primary keys like the others
+            return queryset.annotate(**{alias: F('pk')}).order_by(alias)
+        if not pks:
+            return queryset
+        rank = Case(*[When(pk=pk, then=position) for position, pk in enumerate(pks)], output_field=IntegerField())
+        return queryset.annotate(**{alias: rank}).order_by(alias)
+
+    def memory_usage(self):
+        """
+        Approximate size of the index in this process
+        @return dict: documents, trigrams and bytes
+        """
+        with self.lock:
+            self.ensure_index()
+            size = sys.getsizeof(self.documents) + sys.getsizeof(self.trigrams)
+            size += sum(sys.getsizeof(pk) + sys.getsizeof(document) for pk, document in self.documents.items())
+            size += sum(sys.getsizeof(trigram) + sys.getsizeof(pks) for trigram, pks in self.trigrams.items())
+            return {
+                'documents': len(self.documents),
+                'trigrams': len(self.trigrams),
+                'bytes': size,
+            }
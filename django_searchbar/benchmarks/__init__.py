@@ -0,0 +1,121 @@
+"""
+Benchmarks of the SearchBar hot paths
+Each module has a run() function returning its timings, and can be run on its own:
+    python -m django_searchbar.benchmarks.rendering
+or all together, with their results written as JSON to compare commits:
+    python manage.py searchbar_benchmark --output before.json
+"""
+import datetime
+import json
+import os
+import platform
+import subprocess
+import timeit
+
+
+def setup():
+    """
+    Configures django with the project settings when a benchmark runs as a script
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_searchbar.settings')
+    import django
+    django.setup()
+
+
+def create_database():
+    """
+    Creates an empty test database, so the benchmarks never touch the one in the settings
+    """
+    from django.db import connection
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+
+def create_users(count):
+    """
+    Fills auth_user with ``count`` synthetic users: user<n>, with names and emails made of a few words
+    """
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.utils import timezone
+
+    words = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet', 'kilo']
+    now = timezone.now()
+
+    def rows():
+        for i in range(count):
+            first_name, last_name = words[i % len(words)], words[(i // len(words)) % len(words)]
+            yield ('', False, 'user%07d' % i, first_name, '%s%s' % (last_name, i), '%s.%s@example.com' % (first_name, i),
+                   i % 10 == 0, i % 7 != 0, now)
+
+    # bulk_create is limited to a few rows per query on sqlite
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            'INSERT INTO %s (password, is_superuser, username, first_name, last_name, email, is_staff, is_active, '
+            'date_joined) VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)' % User._meta.db_table,
+            rows(),
+        )
+
+
+def measure(func, number=1000, repeat=5):
+    """
+    @return float: the best time of a single call, in seconds
+    """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def format_results(results):
+    """
+    Formats the timings in microseconds, and the other numbers (ints, e.g. sizes) as they are
+    @return list: a line for each result
+    """
+    lines = []
+    for name, value in results.items():
+        if isinstance(value, int):
+            lines.append('%-30s %10d' % (name, value))
+        else:
+            lines.append('%-30s %10.2f us' % (name, value * 1000000))
+    return lines
+
+
+def get_metadata(**kwargs):
+    """
+    Describes where the results come from: the commit, python and django versions and the arguments of the run
+    """
+    import django
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                         stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    metadata = {
+        'date': datetime.datetime.utcnow().replace(microsecond=0).isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+    }
+    metadata.update(kwargs)
+    return metadata
+
+
+def to_json(results, metadata):
+    """
+    @param results: {benchmark: {name: value}}, timings are in seconds
+    @return str
+    """
+    return json.dumps({'metadata': metadata, 'results': results}, indent=2, sort_keys=True)
+
+
+def compare(before, after):
+    """
+    Compares the results of two runs, as returned by to_json
+    @return list: (benchmark, name, before, after, ratio) of the timings both runs have, ratio > 1 is slower
+    """
+    changes = []
+    for benchmark, results in sorted(after['results'].items()):
+        for name, value in sorted(results.items()):
+            old = before['results'].get(benchmark, {}).get(name)
+            if isinstance(value, float) and isinstance(old, float) and old:
+                changes.append((benchmark, name, old, value, value / old))
+    return changes
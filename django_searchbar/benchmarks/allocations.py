@@ -0,0 +1,68 @@
+"""
+The memory a search allocates, measured with tracemalloc: the peak of a validated search building its filters,
+what a search bar keeps while it lives, and the canonical key of the spec the form cache used to build on each
+request, against the lookup of its field table
+"""
+import tracemalloc
+from django.test.client import RequestFactory
+from django_searchbar.benchmarks import format_results, setup
+from django_searchbar.benchmarks.hotpaths import FIELDS, DATA, REPLACEMENTS
+
+
+def peak(func, repeat=5):
+    """
+    @return int: the lowest peak of the memory allocated by a call, in bytes
+    """
+    func()
+    peaks = []
+    for i in range(repeat):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        func()
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    return min(peaks)
+
+
+def retained(func, number=100):
+    """
+    @return tuple: the bytes and memory blocks each result of func keeps allocated
+    """
+    func()
+    before = tracemalloc.take_snapshot()
+    results = [func() for i in range(number)]
+    after = tracemalloc.take_snapshot()
+    stats = after.compare_to(before, 'filename')
+    del results
+    return (sum(stat.size_diff for stat in stats) // number, sum(stat.count_diff for stat in stats) // number)
+
+
+def run(number=100, repeat=5):
+    from django_searchbar.compiled import get_field_table
+    from django_searchbar.forms import freeze_spec
+    from django_searchbar.utils import SearchBar
+
+    request = RequestFactory().get('/', DATA)
+
+    def search():
+        search_bar = SearchBar(request, FIELDS, REPLACEMENTS, 'get', fast=True)
+        search_bar.is_valid()
+        search_bar.get_filters()
+        return search_bar
+
+    tracemalloc.start()
+    try:
+        size, blocks = retained(search, number)
+        return {
+            'search peak (bytes)': peak(search, repeat),
+            'search bar retained (bytes)': size,
+            'search bar retained (blocks)': blocks,
+            'freeze_spec peak (bytes)': peak(lambda: freeze_spec(FIELDS), repeat),
+            'field table peak (bytes)': peak(lambda: get_field_table(FIELDS, REPLACEMENTS), repeat),
+        }
+    finally:
+        tracemalloc.stop()
+
+
+if __name__ == '__main__':
+    setup()
+    print('\n'.join(format_results(run())))
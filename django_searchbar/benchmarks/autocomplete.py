@@ -0,0 +1,38 @@
+"""
+The latency of the autocomplete: istartswith queries, the prefix index and the cached responses
+"""
+from django_searchbar.benchmarks import measure, format_results, setup, create_database, create_users
+
+
+def run(rows=10000, number=200, repeat=3):
+    from django.contrib.auth.models import User
+    from django.core.cache import cache
+    from django.test.client import RequestFactory
+    from django_searchbar.autocomplete import Autocomplete, AutocompleteView, PrefixIndex
+
+    create_users(rows)
+    fields = ['username', 'first_name']
+    queryset = User.objects.all()
+    usernames = Autocomplete(fields, label='username', cache_length=0)
+    first_names = Autocomplete(fields, label='first_name', cache_length=0)
+    indexed = Autocomplete(fields, label='first_name', cache_length=0, index=PrefixIndex())
+    cached = Autocomplete(fields, label='username', key_prefix='searchbar-benchmark')
+    view = AutocompleteView.as_view(model=User, autocomplete=cached)
+    request = RequestFactory().get('/', {'q': 'use'})
+
+    cache.clear()
+    indexed.suggest(queryset, 'al')
+    return {
+        'query short prefix': measure(lambda: usernames.get_content(queryset, 'u'), number, repeat),
+        'query long prefix': measure(lambda: usernames.get_content(queryset, 'user00012'), number, repeat),
+        'query small vocabulary': measure(lambda: first_names.get_content(queryset, 'al'), number, repeat),
+        'prefix index': measure(lambda: indexed.get_content(queryset, 'al'), number, repeat),
+        'cached short prefix': measure(lambda: cached.get_content(queryset, 'u'), number, repeat),
+        'view cached': measure(lambda: view(request), number, repeat),
+    }
+
+
+if __name__ == '__main__':
+    setup()
+    create_database()
+    print('\n'.join(format_results(run())))
@@ -0,0 +1,99 @@
+"""
+The SearchBar hot paths, from building a search bar to a whole request through SearchBarViewMixin
+"""
+from django.test.client import RequestFactory
+from django_searchbar.benchmarks import measure, format_results, setup, create_database, create_users
+
+CHOICES = tuple(('c%s' % i, 'Choice %s' % i) for i in range(1000))
+
+FIELDS = [
+    'username',
+    {'label': 'email', 'lookup': 'icontains'},
+    {'label': 'name', 'lookup': 'istartswith'},
+    {'label': 'staff', 'choices': (('', 'All'), ('1', 'Yes'), ('0', 'No')), 'ignore_list': ['']},
+    {'label': 'category', 'choices': CHOICES},
+    {'label': 'joined', 'type': 'date', 'lookup': 'range'},
+] + ['extra_%s' % i for i in range(20)]
+
+DATA = {
+    'email': 'alpha',
+    'name': 'al',
+    'staff': '1',
+    'category': 'c500',
+    'joined_0': '2000-01-01',
+}
+
+
+COLUMNS = {'name': 'first_name', 'staff': 'is_staff', 'joined': 'date_joined'}
+
+
+def get_column(field):
+    return COLUMNS[field]
+
+
+REPLACEMENTS = {field: get_column for field in COLUMNS}
+
+
+def run(rows=10000, number=200, repeat=3):
+    from django.contrib.auth.models import User
+    from django.views.generic import ListView
+    from django_searchbar.forms import SearchBarForm, compile_form, clear_form_cache
+    from django_searchbar.mixins import SearchBarViewMixin
+    from django_searchbar.utils import SearchBar
+
+    create_users(rows)
+    request = RequestFactory().get('/', DATA)
+    # The request cycle searches the fields that are in the table
+    view_fields = FIELDS[:4] + [FIELDS[5]]
+
+    class BenchmarkView(SearchBarViewMixin, ListView):
+        model = User
+        template_name = 'django_searchbar/benchmark.html'
+        paginate_by = 20
+        ordering = ('pk',)
+        searchbar_fields = view_fields
+        searchbar_replacements = REPLACEMENTS
+        searchbar_method = 'get'
+
+    view = BenchmarkView.as_view()
+
+    def search_bar():
+        return SearchBar(request, FIELDS, REPLACEMENTS, 'get')
+
+    def compile_uncached():
+        clear_form_cache()
+        compile_form(FIELDS)
+
+    def validated():
+        search_bar().is_valid()
+
+    def filters():
+        bar = search_bar()
+        bar.is_valid()
+        bar.get_filters()
+
+    def results():
+        bar = SearchBar(request, view_fields, REPLACEMENTS, 'get')
+        bar.is_valid()
+        list(bar.filter(User.objects.order_by('pk'))[:20])
+
+    def request_cycle():
+        view(request).render()
+
+    return {
+        'SearchBar()': measure(search_bar, number, repeat),
+        'compile_form uncached': measure(compile_uncached, max(1, number // 10), repeat),
+        'compile_form cached': measure(lambda: compile_form(FIELDS), number, repeat),
+        'SearchBarForm': measure(lambda: SearchBarForm(request.GET, FIELDS), number, repeat),
+        'is_valid': measure(validated, number, repeat),
+        'get_filters': measure(filters, number, repeat),
+        'as_form': measure(lambda: search_bar().as_form(), number, repeat),
+        'search query': measure(results, max(1, number // 10), repeat),
+        'view request': measure(request_cycle, max(1, number // 10), repeat),
+    }
+
+
+if __name__ == '__main__':
+    setup()
+    create_database()
+    print('\n'.join(format_results(run())))
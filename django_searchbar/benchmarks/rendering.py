@@ -0,0 +1,42 @@
+"""
+Rendering a search bar with and without the fragment cache
+"""
+from django.test.client import RequestFactory
+from django_searchbar.benchmarks import measure, format_results, setup
+
+
+FIELDS = [
+    'name',
+    'email',
+    {'label': 'age', 'required': True},
+    {
+        'label': 'country',
+        'choices': tuple(('c%s' % i, 'Country %s' % i) for i in range(200)),
+    },
+]
+
+
+def run(number=1000, repeat=5):
+    from django_searchbar.cache import FragmentCache
+    from django_searchbar.utils import SearchBar
+
+    request = RequestFactory().post('/', {'name': 'arsham', 'age': '6', 'country': 'c10'})
+    cache = FragmentCache(key_prefix='searchbar-benchmark')
+
+    def uncached():
+        SearchBar(request, FIELDS).as_form()
+
+    def cached():
+        search_bar = SearchBar(request, FIELDS)
+        search_bar.fragment_cache = cache
+        search_bar.as_form()
+
+    return {
+        'as_form uncached': measure(uncached, number, repeat),
+        'as_form cached': measure(cached, number, repeat),
+    }
+
+
+if __name__ == '__main__':
+    setup()
+    print('\n'.join(format_results(run())))
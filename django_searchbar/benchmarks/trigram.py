@@ -0,0 +1,30 @@
+"""
+Substring and fuzzy searches with the trigram backend, against icontains through the ORM
+"""
+from django_searchbar.benchmarks import measure, format_results, setup, create_database, create_users
+
+
+def run(rows=20000, number=20, repeat=3):
+    from django.contrib.auth.models import User
+    from django_searchbar.backends.trigram import TrigramBackend
+
+    create_users(rows)
+    substring = TrigramBackend(User, ['username', 'first_name', 'last_name'], watch=False)
+    fuzzy = TrigramBackend(User, ['username', 'first_name', 'last_name'], watch=False, fuzzy=True)
+    fuzzy.install()
+
+    results = {
+        'orm icontains': measure(lambda: list(User.objects.filter(last_name__icontains='kilo12').values_list('pk', flat=True)), number, repeat),
+        'trigram build': measure(substring.install, 1, repeat),
+        'trigram substring': measure(lambda: list(User.objects.filter(pk__in=substring.search('kilo12')).values_list('pk', flat=True)), number, repeat),
+        'trigram fuzzy': measure(lambda: fuzzy.search('kilo1200'), number, repeat),
+    }
+    memory = substring.memory_usage()
+    results['trigram memory (bytes)'] = memory['bytes']
+    return results
+
+
+if __name__ == '__main__':
+    setup()
+    create_database()
+    print('\n'.join(format_results(run())))
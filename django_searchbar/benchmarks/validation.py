@@ -0,0 +1,36 @@
+"""
+Validating a search and building its filters, with the form and with FastForm
+"""
+from django.test.client import RequestFactory
+from django_searchbar.benchmarks import measure, format_results, setup
+from django_searchbar.benchmarks.hotpaths import FIELDS, DATA, REPLACEMENTS
+
+
+def run(number=1000, repeat=5):
+    from django_searchbar.utils import SearchBar
+
+    request = RequestFactory().get('/', DATA)
+
+    def validate(fast):
+        def validated():
+            SearchBar(request, FIELDS, REPLACEMENTS, 'get', fast=fast).is_valid()
+        return validated
+
+    def filters(fast):
+        def built():
+            search_bar = SearchBar(request, FIELDS, REPLACEMENTS, 'get', fast=fast)
+            search_bar.is_valid()
+            search_bar.get_filters()
+        return built
+
+    return {
+        'form is_valid': measure(validate(False), number, repeat),
+        'fast is_valid': measure(validate(True), number, repeat),
+        'form get_filters': measure(filters(False), number, repeat),
+        'fast get_filters': measure(filters(True), number, repeat),
+    }
+
+
+if __name__ == '__main__':
+    setup()
+    print('\n'.join(format_results(run())))
@@ -0,0 +1,128 @@
+import contextlib
+import time
+from django.db import connections, transaction, OperationalError
+
+# These scan every row, an index doesn't help them, a short value matches most of the table
+SCAN_LOOKUPS = ('contains', 'icontains', 'endswith', 'iendswith', 'regex', 'iregex', 'terms')
+
+# The number of SQLite virtual machine instructions between two checks of the deadline
+PROGRESS_STEPS = 1000
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def sqlite_limit(connection, timeout):
+    """
+    Interrupts the queries of the block after ``timeout`` seconds, with a progress handler
+    """
+    connection.ensure_connection()
+    deadline = time.monotonic() + timeout
+    connection.connection.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_STEPS)
+    try:
+        yield
+    except OperationalError as e:
+        if time.monotonic() > deadline:
+            raise SearchTimeout() from e
+        raise
+    finally:
+        connection.connection.set_progress_handler(None, PROGRESS_STEPS)
+
+
+@contextlib.contextmanager
+def postgresql_limit(connection, timeout):
+    """
+    Cancels each query of the block after ``timeout`` seconds, with statement_timeout in a savepoint,
+    so a canceled query doesn't break the transaction around it
+    """
+    try:
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.execute('SHOW statement_timeout')
+                previous = cursor.fetchone()[0]
+                cursor.execute("SELECT set_config('statement_timeout', %s, true)", [str(int(timeout * 1000))])
+            yield
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT set_config('statement_timeout', %s, true)", [previous])
+    except OperationalError as e:
+        # query_canceled, psycopg2 has pgcode and psycopg sqlstate
+        cause = e.__cause__
+        if getattr(cause, 'pgcode', None) == '57014' or getattr(cause, 'sqlstate', None) == '57014':
+            raise SearchTimeout() from e
+        raise
+
+
+# The limiters of the database vendors, the queries of the others run without a time budget
+LIMITERS = {
+    'sqlite': sqlite_limit,
+    'postgresql': postgresql_limit,
+}
+
+
+class SearchBudget:
+
+    """
+    Bounds what a search can cost.
+    Usage:
+        budget = SearchBudget(min_term_length=3, max_fields=4, timeout=2)
+
+        class MyView(SearchBarViewMixin, ListView):
+            searchbar_budget = budget
+
+        # or, on your own
+        search_bar.budget = budget
+        people = search_bar.evaluate(search_bar.filter(Person.objects.all()))
+
+    Before the query, a search with more than ``max_fields`` fields, or a scanning lookup (see SCAN_LOOKUPS) on a value
+    shorter than ``min_term_length``, doesn't validate. The short terms of a terms field are left out instead.
+    While it runs, the query is canceled after ``timeout`` seconds: the search gets an error, and no results,
+    instead of tying up the worker. Register the limiter of other vendors in LIMITERS.
+    """
+
+    def __init__(self, min_term_length=None, max_fields=None, timeout=None):
+        self.min_term_length = min_term_length
+        self.max_fields = max_fields
+        self.timeout = timeout
+
+    def simplify_terms(self, terms):
+        """
+        Leaves out the terms shorter than min_term_length
+        """
+        if not self.min_term_length:
+            return terms
+        return [term for term in terms if len(term.strip()) >= self.min_term_length]
+
+    def check(self, active_fields):
+        """
+        @param active_fields: the (field, lookup, value) of the search, see SearchBar.get_active_fields
+        @return list: the errors of the search, empty when it's within the budget
+        """
+        errors = []
+        if self.max_fields is not None and len(active_fields) > self.max_fields:
+            errors.append('Search at most %s fields at once' % self.max_fields)
+        if self.min_term_length:
+            for field, lookup, value in active_fields:
+                if lookup in SCAN_LOOKUPS and isinstance(value, str) and len(value.strip()) < self.min_term_length:
+                    errors.append('%s needs at least %s characters' % (field, self.min_term_length))
+        return errors
+
+    @contextlib.contextmanager
+    def limit(self, using='default'):
+        """
+        Runs the queries of the block within the time budget, raises SearchTimeout when it's exceeded
+        A block within another one of the same database runs in the budget of the outer one.
+        """
+        connection = connections[using]
+        limiter = LIMITERS.get(connection.vendor)
+        if self.timeout is None or limiter is None or getattr(connection, 'searchbar_limited', False):
+            yield
+            return
+
+        connection.searchbar_limited = True
+        try:
+            with limiter(connection, self.timeout):
+                yield
+        finally:
+            connection.searchbar_limited = False
@@ -0,0 +1,237 @@
+import hashlib
+import threading
+import time
+from django.core.cache import caches
+from django.db.models.signals import post_save, post_delete
+
+
+class ModelVersions:
+
+    """
+    A version of each model in a django cache backend, bumped by post_save/post_delete of the watched models,
+    for the cache keys that have to change when a model does
+    """
+
+    def __init__(self, alias='default', key_prefix='searchbar'):
+        self.alias = alias
+        self.key_prefix = key_prefix
+        self.models = set()
+        self.lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get_key(self, model):
+        return '%s:version:%s' % (self.key_prefix, model._meta.label_lower)
+
+    def get(self, model):
+        key = self.get_key(model)
+        version = self.cache.get(key)
+        if version is None:
+            # Starting from the clock, a culled version never brings old entries back
+            self.cache.add(key, int(time.time() * 1000), None)
+            version = self.cache.get(key)
+        return version
+
+    def invalidate(self, model):
+        key = self.get_key(model)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.set(key, int(time.time() * 1000), None)
+
+    def on_change(self, sender, **kwargs):
+        self.invalidate(sender)
+
+    def watch(self, model):
+        """
+        Bumps the version of the model when any of its instances is saved or deleted
+        The versions of a backend and prefix are shared, so are their receivers: there is one for each model,
+        however many instances watch it.
+        """
+        if model in self.models:
+            return
+        with self.lock:
+            dispatch_uid = 'searchbar-versions-%s-%s-%s' % (self.alias, self.key_prefix, model._meta.label_lower)
+            post_save.connect(self.on_change, sender=model, weak=False, dispatch_uid=dispatch_uid)
+            post_delete.connect(self.on_change, sender=model, weak=False, dispatch_uid=dispatch_uid)
+            self.models.add(model)
+
+
+class SearchResultCache:
+
+    """
+    Caches the primary keys matching a search in a django cache backend.
+    Usage:
+        results_cache = SearchResultCache(timeout=60)
+        people = search_bar.filter(Person.objects.all(), cache=results_cache)
+
+    The key is made of the model, the normalized cleaned data, the lookup string and the
+    replacements (see SearchBar.get_search_key), and a version of the model that is bumped by
+    post_save/post_delete, so any change to the model invalidates its entries.
+    Expiry and LRU culling are left to the backend (timeout, and MAX_ENTRIES of locmem).
+    The search runs on the unrestricted model, and the cached primary keys are applied to your
+    queryset with pk__in, so its own filters and ordering are kept.
+    Note that queryset.update() and bulk_create() don't send signals, the timeout bounds how stale
+    the results can get after them.
+    """
+
+    def __init__(self, alias='default', timeout=300, max_results=1000, key_prefix='searchbar', single_flight=None):
+        """
+        @param alias: the cache backend in settings.CACHES
+        @param timeout: seconds before an entry expires
+        @param max_results: searches matching more rows than this are not cached
+        @param single_flight: a django_searchbar.coalescing.SingleFlight, so the concurrent misses of a key run one query
+        """
+        self.alias = alias
+        self.single_flight = single_flight
+        self.timeout = timeout
+        self.max_results = max_results
+        self.key_prefix = key_prefix
+        self.hits = 0
+        self.misses = 0
+        self.versions = ModelVersions(alias, key_prefix)
+        self.lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get_version(self, model):
+        return self.versions.get(model)
+
+    def invalidate(self, model):
+        self.versions.invalidate(model)
+
+    def watch(self, model):
+        """
+        Invalidates the entries of the model when any of its instances is saved or deleted
+        """
+        self.versions.watch(model)
+
+    def get_key(self, model, search_bar, *args, lookup_string=''):
+        search_key = repr(search_bar.get_search_key(*args, lookup_string=lookup_string))
+        return '%s:results:%s:%s:%s' % (
+            self.key_prefix,
+            model._meta.label_lower,
+            self.get_version(model),
+            hashlib.md5(search_key.encode('utf-8')).hexdigest(),
+        )
+
+    def get_pks(self, model, filters, key, using=None):
+        pks = list(model._base_manager.using(using).filter(filters).values_list('pk', flat=True)[:self.max_results + 1])
+        if len(pks) > self.max_results:
+            pks = False
+        self.cache.set(key, pks, self.timeout)
+        return pks
+
+    def filter(self, queryset, search_bar, *args, lookup_string=''):
+        """
+        Same as queryset.filter(search_bar.get_filters(*args, lookup_string=lookup_string)), using the cache
+        """
+        filters = search_bar.get_filters(*args, lookup_string=lookup_string)
+        if not filters:
+            return queryset
+
+        model = queryset.model
+        self.watch(model)
+        key = self.get_key(model, search_bar, *args, lookup_string=lookup_string)
+        pks = self.cache.get(key)
+
+        with self.lock:
+            if pks is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if pks is None:
+            with search_bar.limit(queryset):
+                if self.single_flight is not None:
+                    pks = self.single_flight.do(key, lambda: self.get_pks(model, filters, key, queryset.db))
+                else:
+                    pks = self.get_pks(model, filters, key, queryset.db)
+
+        if pks is False:
+            return queryset.filter(filters)
+        return queryset.filter(pk__in=pks)
+
+    def stats(self):
+        """
+        @return dict: hits, misses and the hit ratio of this instance
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'ratio': self.hits / total if total else 0.0,
+        }
+
+
+class FragmentCache:
+
+    """
+    Caches the rendered markup of search bars in a django cache backend.
+    Usage:
+        search_bar.fragment_cache = FragmentCache()
+        str(search_bar), search_bar.as_form()  # rendered once for each spec, method, action and input
+
+    The csrf token is never part of the cached markup, as_form puts it in after the lookup, so
+    the fragments are safe to share between users.
+    """
+
+    def __init__(self, alias='default', timeout=3600, key_prefix='searchbar'):
+        self.alias = alias
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get_key(self, search_bar, kind):
+        form = search_bar.form
+        values = ()
+        if form.is_bound:
+            values = tuple((name, field.widget.value_from_datadict(form.data, form.files, form.add_prefix(name)))
+                           for name, field in form.fields.items())
+        from django_searchbar.choices import LazyChoices
+        # The options of lazy choices change with their model
+        versions = tuple(field.choices.version for field in form.fields.values()
+                         if isinstance(getattr(field, 'choices', None), LazyChoices))
+        fragment_key = repr((kind, form.spec, search_bar.method, search_bar.action, values, search_bar.facets, versions))
+        return '%s:fragment:%s' % (self.key_prefix, hashlib.md5(fragment_key.encode('utf-8')).hexdigest())
+
+    def render(self, search_bar, kind, render):
+        """
+        Returns the cached markup, calling render() when it's not in the cache
+        @param kind: which rendering this is, e.g. 'str' or 'as_form'
+        """
+        key = self.get_key(search_bar, kind)
+        html = self.cache.get(key)
+        with self.lock:
+            if html is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if html is None:
+            html = render()
+            self.cache.set(key, html, self.timeout)
+        return html
+
+    def stats(self):
+        """
+        @return dict: hits, misses and the hit ratio of this instance
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'ratio': self.hits / total if total else 0.0,
+        }
+
+
+fragment_cache = FragmentCache()
@@ -0,0 +1,237 @@
+import hashlib
+import threading
+import time
+import uuid
+from django import forms
+from django.core.cache import caches
+from django.db.models.query import QuerySet, ModelIterable
+from django.forms.utils import flatatt
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+from django_searchbar.cache import ModelVersions
+
+
+def is_lazy_source(choices):
+    """
+    Tells whether a spec's choices are loaded when they're used: a queryset, a callable or LazyChoices
+    """
+    return isinstance(choices, (QuerySet, LazyChoices)) or callable(choices)
+
+
+def get_source_key(source):
+    """
+    Returns a key of a queryset that doesn't depend on the instance, so the querysets of a spec built on
+    each request share their choices
+    """
+    return (QuerySet, source.model._meta.label_lower, str(source.query))
+
+
+def iter_values(choices):
+    from django_searchbar.utils import iter_choices
+    for value, label in iter_choices(choices):
+        yield str(value)
+
+
+def get_options(choices):
+    """
+    Renders the options of the choices once, with and without the selected attribute
+    @return list: the parts of the markup, strings or (value, option, selected option) tuples
+    """
+    parts = []
+    for choice in choices:
+        if isinstance(choice, dict):
+            parts.extend(get_options(choice.items()))
+        elif isinstance(choice[1], (list, tuple)):
+            parts.append(format_html('<optgroup label="{}">', choice[0]))
+            parts.extend(get_options(choice[1]))
+            parts.append('</optgroup>')
+        else:
+            value, label = str(choice[0]), choice[1]
+            parts.append((value, format_html('<option value="{}">{}</option>', value, label),
+                          format_html('<option value="{}" selected>{}</option>', value, label)))
+    return parts
+
+
+class LoadedChoices:
+
+    def __init__(self, version, choices, expires):
+        self.version = version
+        self.expires = expires
+        self.choices = choices
+        self.values = frozenset(iter_values(choices))
+        self.parts = get_options(choices)
+        self.options = ''.join(part if isinstance(part, str) else part[1] for part in self.parts)
+
+
+class LazyChoices:
+
+    """
+    The choices of a field, loaded from a queryset or a callable when they're first used.
+    Usage:
+        fields = [{'label': 'country', 'choices': Country.objects.values_list('code', 'name')}]
+        fields = [{'label': 'country', 'choices': LazyChoices(get_countries, model=Country, timeout=600)}]
+
+    A queryset of instances gives (pk, str(instance)) choices, values_list() its own pairs, and a callable returns
+    the pairs. They are kept in a django cache backend, shared by the processes, under a version of the model
+    bumped by post_save/post_delete, and in this instance until that version changes or ``timeout`` passes, which
+    is the only expiry of the callables without a model.
+    The values are looked up in a set when validating, and the options are rendered once for each version
+    (see CachedSelect). Copying the field, as each form does, doesn't copy the choices.
+    A queryset is keyed by its query. Two callables can have the same name (lambdas, closures, methods), so
+    each instance keeps the choices of a callable to itself, unless it's given a ``key`` to share them with
+    the other processes.
+    """
+
+    def __init__(self, source, model=None, alias='default', timeout=3600, key_prefix='searchbar', key=None):
+        assert isinstance(source, QuerySet) or callable(source), 'source should be a queryset or a callable'
+        self.source = source
+        self.model = source.model if isinstance(source, QuerySet) else model
+        self.alias = alias
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+        if key is None:
+            key = get_source_key(source) if isinstance(source, QuerySet) else uuid.uuid4().hex
+        self.key = hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+        self.versions = ModelVersions(alias, key_prefix)
+        self.loaded = None
+        self.lock = threading.Lock()
+        if self.model is not None:
+            self.versions.watch(self.model)
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @property
+    def version(self):
+        if self.model is None:
+            return None
+        return self.versions.get(self.model)
+
+    def fetch(self):
+        if not isinstance(self.source, QuerySet):
+            return [tuple(choice) if isinstance(choice, list) else choice for choice in self.source()]
+        if issubclass(self.source._iterable_class, ModelIterable):
+            return [(obj.pk, str(obj)) for obj in self.source.all()]
+        return [tuple(choice) for choice in self.source.all()]
+
+    def load(self):
+        """
+        @return LoadedChoices: of the current version of the model
+        """
+        version = self.version
+        loaded = self.loaded
+        if loaded is not None and loaded.version == version and loaded.expires > time.monotonic():
+            return loaded
+
+        with self.lock:
+            key = self.get_key(version)
+            choices = self.cache.get(key)
+            if choices is None:
+                choices = self.fetch()
+                self.cache.set(key, choices, self.timeout)
+            self.loaded = LoadedChoices(version, choices, time.monotonic() + self.timeout)
+            return self.loaded
+
+    def get_key(self, version):
+        return '%s:choices:%s:%s' % (self.key_prefix, self.key, version)
+
+    def invalidate(self):
+        self.loaded = None
+        if self.model is not None:
+            self.versions.invalidate(self.model)
+        else:
+            self.cache.delete(self.get_key(None))
+
+    def __contains__(self, value):
+        return str(value) in self.load().values
+
+    def __iter__(self):
+        return iter(self.load().choices)
+
+    def __len__(self):
+        return len(self.load().choices)
+
+    def __bool__(self):
+        return True
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def render_options(self, selected=()):
+        """
+        @param selected: the values to mark as selected
+        @return str: the <option> tags
+        """
+        loaded = self.load()
+        selected = {str(value) for value in selected if value is not None}
+        if not selected:
+            return loaded.options
+        return ''.join(part if isinstance(part, str) else part[2 if part[0] in selected else 1] for part in loaded.parts)
+
+    def __repr__(self):
+        return '<LazyChoices of %r>' % (self.source,)
+
+
+class CachedSelect(forms.Select):
+
+    """
+    A select rendering the pre-rendered options of LazyChoices, other choices render like a Select
+    """
+
+    def render(self, name, value, attrs=None, renderer=None):
+        if not isinstance(self.choices, LazyChoices):
+            return super(CachedSelect, self).render(name, value, attrs, renderer)
+
+        final_attrs = self.build_attrs(self.attrs, attrs)
+        final_attrs['name'] = name
+        if self.allow_multiple_selected:
+            final_attrs['multiple'] = True
+        return mark_safe('<select%s>%s</select>' % (flatatt(final_attrs), self.choices.render_options(self.format_value(value))))
+
+
+class CachedSelectMultiple(CachedSelect, forms.SelectMultiple):
+    pass
+
+
+class SearchChoiceField(forms.ChoiceField):
+
+    """
+    A ChoiceField that validates with a set of the values instead of going through the choices,
+    and keeps LazyChoices as they are
+    The copies of the field share its choices, they are replaced (e.g. by count_facets) but never changed in place.
+    """
+
+    widget = CachedSelect
+
+    def __deepcopy__(self, memo):
+        result = forms.Field.__deepcopy__(self, memo)
+        result._choices = self._choices
+        return result
+
+    def _set_choices(self, value):
+        if isinstance(value, LazyChoices):
+            self._choices = self.widget.choices = value
+        else:
+            forms.ChoiceField._set_choices(self, value)
+        self._values = None
+
+    choices = property(forms.ChoiceField._get_choices, _set_choices)
+
+    def get_values(self):
+        if isinstance(self._choices, LazyChoices):
+            return self._choices.load().values
+        if self._values is None:
+            self._values = frozenset(iter_values(self._choices))
+        return self._values
+
+    def valid_value(self, value):
+        return str(value) in self.get_values()
+
+
+class SearchMultipleChoiceField(SearchChoiceField, forms.MultipleChoiceField):
+
+    widget = CachedSelectMultiple
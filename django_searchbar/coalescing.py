@@ -0,0 +1,213 @@
+import copy
+import hashlib
+import threading
+import time
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet
+from django_searchbar.cache import ModelVersions
+
+
+class Call:
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SharedQuerySet:
+
+    """
+    Mixed into the class of a queryset by SingleFlight.filter: fetching the rows goes through the single flight,
+    keyed by the SQL of the query. It survives the clones of the view (ordering, pagination), so the query that is
+    coalesced is the one that would run anyway.
+    """
+
+    single_flight = None
+
+    def _clone(self):
+        clone = super(SharedQuerySet, self)._clone()
+        clone.single_flight = self.single_flight
+        return clone
+
+    def _fetch_all(self):
+        if self._result_cache is None and self.single_flight is not None:
+            try:
+                key = self.single_flight.get_key(self)
+            except EmptyResultSet:
+                key = None
+            if key is not None:
+                rows = self.single_flight.do(key, self.fetch_shared)
+                if self._result_cache is None and rows is not False:
+                    # Waited for another caller: a copy of its rows
+                    self._result_cache = [copy.copy(row) for row in rows]
+        super(SharedQuerySet, self)._fetch_all()
+
+    def fetch_shared(self):
+        """
+        Fetches the rows of this queryset, and returns what the callers waiting for it get
+        """
+        self._result_cache = list(self._iterable_class(self))
+        if len(self._result_cache) > self.single_flight.max_results:
+            return False
+        return self._result_cache
+
+
+shared_classes = {}
+
+
+def get_shared_class(queryset_class):
+    if issubclass(queryset_class, SharedQuerySet):
+        return queryset_class
+    if queryset_class not in shared_classes:
+        shared_classes[queryset_class] = type('Shared%s' % queryset_class.__name__, (SharedQuerySet, queryset_class), {})
+    return shared_classes[queryset_class]
+
+
+class SingleFlight:
+
+    """
+    Coalesces identical concurrent searches of a process: the first caller of a key runs the query,
+    the ones arriving while it runs wait for it and share its result, or its exception.
+    Usage:
+        single_flight = SingleFlight()
+        people = search_bar.filter(Person.objects.all(), single_flight=single_flight)
+
+    The filtered queryset stays lazy: when its rows are fetched, the callers running the same SQL on the same
+    database at that moment get copies of the rows of the first one, which is a query like without the single flight.
+    Nothing is kept once the query has finished, see SearchResultCache for that.
+    A caller doesn't wait more than ``timeout`` seconds, it runs the query itself after that.
+    """
+
+    def __init__(self, max_results=1000, timeout=10):
+        """
+        @param max_results: the searches matching more rows than this are not shared, the others run their own
+        """
+        self.max_results = max_results
+        self.timeout = timeout
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.shared = 0
+
+    def do(self, key, func):
+        """
+        Returns func(), called once for the concurrent callers with the same key
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+                self.runs += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            if not call.event.wait(self.timeout):
+                with self.lock:
+                    self.shared -= 1
+                    self.runs += 1
+                return func()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self.run(key, func)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result
+
+    def run(self, key, func):
+        return func()
+
+    def get_key(self, queryset):
+        """
+        @return str: the key of the query of the queryset, on its database
+        """
+        sql = repr(queryset.query.sql_with_params())
+        return '%s:%s:%s' % (queryset.db, queryset.model._meta.label_lower, hashlib.md5(sql.encode('utf-8')).hexdigest())
+
+    def filter(self, queryset, search_bar, *args, lookup_string=''):
+        """
+        Same as queryset.filter(search_bar.get_filters(*args, lookup_string=lookup_string)), sharing the rows
+        with the identical queries running at the same time
+        """
+        queryset = queryset.filter(search_bar.get_filters(*args, lookup_string=lookup_string))
+        queryset.__class__ = get_shared_class(type(queryset))
+        queryset.single_flight = self
+        return queryset
+
+    def stats(self):
+        """
+        @return dict: how many queries ran, and how many callers shared one of them
+        """
+        return {
+            'runs': self.runs,
+            'shared': self.shared,
+        }
+
+
+class CacheSingleFlight(SingleFlight):
+
+    """
+    Coalesces the identical searches of all the processes, with a lock in a django cache backend
+    The first process to add the lock runs the query and leaves the result in the cache for ``result_timeout``
+    seconds, the others poll for it. If the result doesn't come within ``lock_timeout`` seconds, e.g. the
+    process holding the lock died, they run the query themselves. The keys of the queries have the version of
+    their model, a result left in the cache isn't given out once the model changed.
+    The backend has to be shared by the processes (not locmem) and its add() atomic, as memcached's and redis' are.
+    """
+
+    def __init__(self, max_results=1000, alias='default', lock_timeout=10, result_timeout=5, poll_interval=0.01,
+                 key_prefix='searchbar'):
+        super(CacheSingleFlight, self).__init__(max_results, lock_timeout)
+        self.alias = alias
+        self.lock_timeout = lock_timeout
+        self.result_timeout = result_timeout
+        self.poll_interval = poll_interval
+        self.key_prefix = key_prefix
+        self.versions = ModelVersions(alias, key_prefix)
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get_key(self, queryset):
+        self.versions.watch(queryset.model)
+        return '%s:%s' % (super(CacheSingleFlight, self).get_key(queryset), self.versions.get(queryset.model))
+
+    def run(self, key, func):
+        lock_key = '%s:flight:lock:%s' % (self.key_prefix, key)
+        result_key = '%s:flight:result:%s' % (self.key_prefix, key)
+        deadline = time.monotonic() + self.lock_timeout
+
+        while True:
+            # In a tuple, so a None result is found too
+            result = self.cache.get(result_key)
+            if result is not None:
+                with self.lock:
+                    self.shared += 1
+                return result[0]
+
+            if self.cache.add(lock_key, 1, self.lock_timeout):
+                try:
+                    # The previous holder may have just finished
+                    result = self.cache.get(result_key)
+                    if result is not None:
+                        return result[0]
+                    result = func()
+                    self.cache.set(result_key, (result,), self.result_timeout)
+                    return result
+                finally:
+                    self.cache.delete(lock_key)
+
+            if time.monotonic() > deadline:
+                return func()
+            time.sleep(self.poll_interval)
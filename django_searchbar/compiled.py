@@ -0,0 +1,143 @@
+import asyncio
+import collections
+import threading
+from types import MappingProxyType
+from django_searchbar.forms import compile_form
+from django_searchbar.terms import MAX_TERMS
+
+TABLE_CACHE_SIZE = 256
+
+_tables = collections.OrderedDict()
+_tables_lock = threading.Lock()
+
+
+def resolve_replacement(label, replacements):
+    """
+    Returns the name of a field in the queries and whether it's resolved, coroutine functions are left to
+    SearchBar.aget_lookups
+    @return tuple: (replacement, resolved)
+    """
+    if isinstance(replacements, dict):
+        replacement = replacements.get(label, label)
+    else:
+        replacement = replacements(label)
+    if asyncio.iscoroutinefunction(replacement):
+        return replacement, False
+    if callable(replacement):
+        replacement = replacement(label)
+    return replacement, True
+
+
+class FieldSpec:
+
+    """
+    A field of the spec, as get_active_fields reads it
+    ``lookup`` is None when the lookup string of the search applies, ``spec`` is the dictionary of the field,
+    None for a field given by its name.
+    """
+
+    __slots__ = ('label', 'lookup', 'ignore_list', 'max_terms', 'replacement', 'resolved', 'spec')
+
+    def __init__(self, item, replacements):
+        self.spec = item if isinstance(item, dict) else None
+        self.lookup = None
+        self.ignore_list = ()
+        self.max_terms = MAX_TERMS
+        if self.spec is None:
+            self.label = item
+        else:
+            self.label = item['label']
+            self.ignore_list = tuple(item.get('ignore_list', ()))
+            if item.get('fulltext'):
+                self.lookup = 'match'
+            elif item.get('type') == 'terms':
+                self.lookup = 'terms'
+                self.max_terms = item.get('max_terms', MAX_TERMS)
+            elif 'lookup' in item:
+                self.lookup = item['lookup'].lower().strip()
+        self.replacement, self.resolved = resolve_replacement(self.label, replacements)
+
+    def __repr__(self):
+        return '<FieldSpec %s>' % self.label
+
+
+class FieldTable:
+
+    """
+    The fields of a spec with their replacements resolved, built once for each spec and shared by its search bars
+    Usage:
+        table = get_field_table(fields, replacements)
+
+    Callable replacements are called when the table is built, not for each request. The table is looked up
+    by the identity of the spec, as given (a single field isn't put in a new list for each request), and the
+    contents of the replacements, and checked against a shallow copy of the spec, so a spec changed in place gets
+    a new table, except for a change deep inside a field (e.g. appending to its choices).
+    The table is shared between threads and isn't changed once built.
+    """
+
+    __slots__ = ('fields', 'labels', 'source', 'replacements', 'snapshot', 'replacements_snapshot', 'form_class')
+
+    def __init__(self, fields, replacements={}):
+        from django_searchbar.utils import listify
+        self.source = fields
+        self.replacements = replacements
+        if isinstance(fields, (list, tuple)):
+            self.snapshot = type(fields)(dict(item) if isinstance(item, dict) else item for item in fields)
+        else:
+            self.snapshot = dict(fields) if isinstance(fields, dict) else fields
+        self.replacements_snapshot = dict(replacements) if isinstance(replacements, dict) else replacements
+        self.fields = tuple(FieldSpec(item, replacements) for item in listify(fields))
+        labels = {}
+        for spec in self.fields:
+            labels.setdefault(spec.label, spec)
+        self.labels = MappingProxyType(labels)
+        # The compiled form class of the spec, see compile_form
+        self.form_class = compile_form(fields)
+
+    def matches(self, fields, replacements):
+        """
+        Tells whether the table still describes the spec, comparing without copying it
+        """
+        return self.snapshot == fields and self.replacements_snapshot == replacements
+
+
+def get_replacements_key(replacements):
+    """
+    Returns a hashable key of the contents of the replacements, so equal replacements built for each request
+    share a table. A callable is its own key.
+    """
+    if not isinstance(replacements, dict):
+        return replacements
+    try:
+        key = tuple(sorted((label, tuple(value) if isinstance(value, list) else value)
+                           for label, value in replacements.items()))
+        hash(key)
+    except TypeError:
+        return id(replacements)
+    return key
+
+
+def get_field_table(fields, replacements={}):
+    """
+    Returns the FieldTable of the spec, kept in a LRU of TABLE_CACHE_SIZE entries
+    @type fields: str|dict|list|tuple
+    """
+    key = (id(fields), get_replacements_key(replacements))
+    with _tables_lock:
+        table = _tables.get(key)
+        if table is not None and table.matches(fields, replacements):
+            _tables.move_to_end(key)
+            return table
+
+    table = FieldTable(fields, replacements)
+    with _tables_lock:
+        # The table keeps the spec, so its id isn't reused while it's cached
+        _tables[key] = table
+        while len(_tables) > TABLE_CACHE_SIZE:
+            _tables.popitem(last=False)
+    return table
+
+
+def clear_table_cache():
+    with _tables_lock:
+        _tables.clear()
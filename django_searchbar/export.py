@@ -0,0 +1,68 @@
+import csv
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/jsonl; charset=utf-8',
+}
+
+
+class Echo:
+
+    """
+    A file-like object for csv.writer, write returns the line instead of keeping it
+    """
+
+    def write(self, value):
+        return value
+
+
+def iter_rows(queryset, columns, chunk_size=2000):
+    """
+    Yields the values of the columns, fetching chunk_size rows at a time
+    """
+    return queryset.values_list(*columns).iterator(chunk_size=chunk_size)
+
+
+def iter_csv(queryset, columns, chunk_size=2000):
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for row in iter_rows(queryset, columns, chunk_size):
+        yield writer.writerow(row)
+
+
+def iter_jsonl(queryset, columns, chunk_size=2000):
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    for row in iter_rows(queryset, columns, chunk_size):
+        yield encoder.encode(dict(zip(columns, row))) + '\n'
+
+
+def iter_limited(lines, limit):
+    """
+    Yields the lines within the limit, the context manager is entered when the stream starts
+    """
+    with limit():
+        yield from lines
+
+
+def export_response(queryset, columns, export_format, filename=None, chunk_size=2000, limit=None):
+    """
+    Streams the columns of the queryset as csv or jsonl (one json object per line), the memory used
+    doesn't grow with the number of rows
+    @param export_format: 'csv' or 'jsonl'
+    @param limit: a callable returning the context manager the queries of the stream run in,
+                  e.g. lambda: search_bar.limit(queryset)
+    @return StreamingHttpResponse
+    """
+    assert export_format in EXPORT_FORMATS, 'export_format should be one of %s' % ', '.join(sorted(EXPORT_FORMATS))
+
+    rows = iter_csv if export_format == 'csv' else iter_jsonl
+    lines = rows(queryset, list(columns), chunk_size)
+    if limit is not None:
+        lines = iter_limited(lines, limit)
+    response = StreamingHttpResponse(lines, content_type=EXPORT_FORMATS[export_format])
+    filename = filename or '%s.%s' % (queryset.model._meta.model_name, export_format)
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
@@ -1,41 +1,187 @@
+import collections
+import threading
 from django import forms
+from django.db.models.query import QuerySet
+from django_searchbar.choices import LazyChoices, SearchChoiceField, SearchMultipleChoiceField, get_source_key, is_lazy_source
 
 
-class SearchBarForm(forms.Form):
+FORM_CACHE_SIZE = 256
+
+_form_classes = collections.OrderedDict()
+_form_classes_lock = threading.Lock()
 
+
+def freeze_spec(item):
     """
-    This is the form that ends up in your templates
+    Turns a field spec into a hashable, canonical key
+    Dictionaries and sequences keep their order, as the order of choices matters when rendering.
+    Unhashable leaves (e.g. a widget with a custom __eq__) are keyed by identity.
+    @type item: str|dict|iterable
+    @return tuple|str
     """
 
-    def __init__(self, data, fields):
+    if isinstance(item, dict):
+        return (dict, tuple((key, freeze_spec(value)) for key, value in item.items()))
+    if isinstance(item, QuerySet):
+        return get_source_key(item)
+    if isinstance(item, (list, tuple)):
+        return tuple(freeze_spec(value) for value in item)
+    try:
+        hash(item)
+    except TypeError:
+        return (id, id(item))
+    return item
 
-        from django_searchbar.utils import listify
-        fields = listify(fields)
 
-        if __debug__:
-            for field in fields:
-                assert isinstance(field, (str, dict)), 'fields should be string types, but you provided %s' % type(field)
-                if isinstance(field, dict):
-                    assert 'label' in field, 'You should provide a label'
-                    if 'choices' in field:
-                        assert isinstance(field['choices'], (list, tuple)), 'You should provide a label'
+def get_label(name):
+    return name.replace('-', ' ').replace('_', ' ').title()
 
-        super(SearchBarForm, self).__init__(data)
-        for field in fields:
 
-            if isinstance(field, str):
+FIELD_TYPES = {
+    'integer': forms.IntegerField,
+    'decimal': forms.DecimalField,
+    'float': forms.FloatField,
+    'date': forms.DateField,
+    'datetime': forms.DateTimeField,
+    'terms': forms.CharField,
+}
+
 
-                label = field.replace('-', ' ').replace('_', ' ').title()
-                self.fields[field] = forms.CharField(label=label, required=False)
+class RangeWidget(forms.MultiWidget):
+
+    def __init__(self, widget=forms.TextInput, attrs=None):
+        super(RangeWidget, self).__init__((widget, widget), attrs)
+
+    def decompress(self, value):
+        if value:
+            return list(value)
+        return [None, None]
+
+
+class RangeField(forms.MultiValueField):
+
+    """
+    Two inputs of the same type, the cleaned value is a (lower, upper) tuple and either bound can be None
+    """
 
-            elif isinstance(field, dict):
+    def __init__(self, field_class=forms.CharField, widget=None, **kwargs):
+        fields = (field_class(required=False), field_class(required=False))
+        widget = RangeWidget(widget or field_class.widget)
+        super(RangeField, self).__init__(fields, widget=widget, require_all_fields=False, **kwargs)
 
-                label = field['label'].replace('-', ' ').replace('_', ' ').title()
-                required = field.get('required', False)
+    def compress(self, data_list):
+        if data_list:
+            return tuple(value if value not in self.empty_values else None for value in data_list)
+        return (None, None)
 
+
+def build_fields(fields):
+    """
+    Builds the django form fields of a field spec
+    @return OrderedDict
+    """
+
+    if __debug__:
+        for field in fields:
+            assert isinstance(field, (str, dict)), 'fields should be string types, but you provided %s' % type(field)
+            if isinstance(field, dict):
+                assert 'label' in field, 'You should provide a label'
                 if 'choices' in field:
-                    self.fields[field['label']] = forms.ChoiceField(label=label, choices=field['choices'], required=required)
-                elif 'widget' in field:
-                    self.fields[field['label']] = forms.CharField(label=label, required=required, widget=field['widget'])
+                    assert isinstance(field['choices'], (list, tuple)) or is_lazy_source(field['choices']), \
+                        'choices should be a list, a tuple, a queryset or a callable'
+                if 'type' in field:
+                    assert field['type'] in FIELD_TYPES, 'type should be one of %s' % ', '.join(sorted(FIELD_TYPES))
+                if field.get('lookup') == 'in':
+                    assert 'choices' in field, 'The in lookup needs choices'
+
+    form_fields = collections.OrderedDict()
+    for field in fields:
+
+        if isinstance(field, str):
+
+            form_fields[field] = forms.CharField(label=get_label(field), required=False)
+
+        elif isinstance(field, dict):
+
+            label = get_label(field['label'])
+            required = field.get('required', False)
+            lookup = field.get('lookup')
+
+            if 'choices' in field:
+                choices = field['choices']
+                if is_lazy_source(choices) and not isinstance(choices, LazyChoices):
+                    choices = LazyChoices(choices)
+                field_class = SearchMultipleChoiceField if lookup == 'in' else SearchChoiceField
+                form_fields[field['label']] = field_class(label=label, choices=choices, required=required)
+            else:
+                field_class = FIELD_TYPES.get(field.get('type'), forms.CharField)
+                kwargs = {'label': label, 'required': required}
+                if 'widget' in field:
+                    kwargs['widget'] = field['widget']
+
+                if lookup == 'range':
+                    form_fields[field['label']] = RangeField(field_class, **kwargs)
                 else:
-                    self.fields[field['label']] = forms.CharField(label=label, required=required)
+                    form_fields[field['label']] = field_class(**kwargs)
+
+    return form_fields
+
+
+def compile_form(fields):
+    """
+    Returns a form class for the field spec, built once and cached by the canonical spec
+    The classes are kept in a LRU of FORM_CACHE_SIZE entries.
+    @type fields: str|dict|list|tuple
+    @return CompiledSearchBarForm subclass
+    """
+
+    from django_searchbar.utils import listify
+    fields = listify(fields)
+    key = freeze_spec(fields)
+
+    with _form_classes_lock:
+        form_class = _form_classes.get(key)
+        if form_class is not None:
+            _form_classes.move_to_end(key)
+            return form_class
+
+    form_class = type('SearchBarForm', (CompiledSearchBarForm,), {'spec': key})
+    form_class.base_fields = build_fields(fields)
+    form_class.declared_fields = form_class.base_fields
+
+    with _form_classes_lock:
+        _form_classes[key] = form_class
+        while len(_form_classes) > FORM_CACHE_SIZE:
+            _form_classes.popitem(last=False)
+
+    return form_class
+
+
+def clear_form_cache():
+    with _form_classes_lock:
+        _form_classes.clear()
+
+
+class SearchBarForm(forms.Form):
+
+    """
+    This is the form that ends up in your templates
+    """
+
+    def __init__(self, data, fields):
+
+        self.base_fields = compile_form(fields).base_fields
+        super(SearchBarForm, self).__init__(data)
+
+
+class CompiledSearchBarForm(SearchBarForm):
+
+    """
+    Base of the classes returned by compile_form, their fields are already on the class
+    so instantiating only binds the data.
+    """
+    spec = ()
+
+    def __init__(self, data=None):
+
+        forms.Form.__init__(self, data)
@@ -0,0 +1,182 @@
+import collections
+import contextlib
+import logging
+import random
+import threading
+import time
+from django.db import connections
+from django.dispatch import Signal
+
+logger = logging.getLogger('django_searchbar')
+
+STAGES = ('form', 'is_valid', 'get_filters', 'evaluate', 'render')
+
+# Sent after each stage with search_bar, stage, duration (seconds), queries (the number of SQL queries),
+# search_key (None when the form doesn't validate) and explain (None unless it was captured).
+# The duration and queries of a stage leave out those of the stages nested in it.
+search_stage = Signal()
+
+# Sent when the plan of a slow search is captured, with search_bar, search_key, duration, sql and explain
+slow_search = Signal()
+
+
+class StatsSink:
+
+    """
+    Receives the measures of every stage, subclass it to send them to your metrics system
+    """
+
+    def record(self, search_bar, stage, duration, queries, search_key=None, explain=None):
+        raise NotImplementedError('StatsSink subclasses should implement record')
+
+
+class LoggingSink(StatsSink):
+
+    def __init__(self, logger=logger, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+
+    def record(self, search_bar, stage, duration, queries, search_key=None, explain=None):
+        self.logger.log(self.level, 'search %s: %.2fms, %s queries, key %r', stage, duration * 1000, queries, search_key)
+        if explain:
+            self.logger.log(self.level, 'slow search %r:\n%s', search_key, explain)
+
+
+class MemorySink(StatsSink):
+
+    """
+    Adds up the measures of each search key in this process, ranking() tells which searches cost the most
+    It keeps the ``max_size`` search keys recorded last, and their explains.
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.searches = collections.OrderedDict()
+        self.explains = {}
+        self.lock = threading.Lock()
+
+    def record(self, search_bar, stage, duration, queries, search_key=None, explain=None):
+        with self.lock:
+            stats = self.searches.get(search_key)
+            if stats is None:
+                stats = self.searches[search_key] = {
+                    'searches': 0,
+                    'duration': 0.0,
+                    'queries': 0,
+                    'stages': collections.defaultdict(float),
+                }
+                while len(self.searches) > self.max_size:
+                    key, _ = self.searches.popitem(last=False)
+                    self.explains.pop(key, None)
+            else:
+                self.searches.move_to_end(search_key)
+            # Every search goes through the form stage once
+            if stage == 'form':
+                stats['searches'] += 1
+            stats['duration'] += duration
+            stats['queries'] += queries
+            stats['stages'][stage] += duration
+            if explain:
+                self.explains[search_key] = explain
+
+    def ranking(self, limit=None):
+        """
+        @return list: (search_key, stats) pairs, the most expensive searches first
+        """
+        with self.lock:
+            ranking = sorted(self.searches.items(), key=lambda item: item[1]['duration'], reverse=True)
+        return ranking[:limit]
+
+    def clear(self):
+        with self.lock:
+            self.searches.clear()
+            self.explains.clear()
+
+
+class Instrumentation:
+
+    """
+    Measures the stages of SearchBar: building the form, is_valid, get_filters, evaluating the results and rendering
+    Usage:
+        sink = MemorySink()
+        SearchBar.instrumentation = Instrumentation([sink], slow_threshold=0.5, explain_rate=0.1)
+        sink.ranking(10)
+
+    Each stage sends the search_stage signal and is recorded by the sinks, with the time it took, the number of
+    SQL queries run on the ``using`` database (all of them by default, a replica too) and the normalized search key
+    (see SearchBar.get_search_key). Stages can nest, e.g. the form is built in the first is_valid: a stage is
+    recorded without the time and the queries of the stages nested in it, so they add up to the whole search.
+    When evaluating the results takes ``slow_threshold`` seconds or more, ``explain_rate`` of these searches
+    (0 to 1, none by default) capture the EXPLAIN of their query, which costs one more query.
+    """
+
+    def __init__(self, sinks=(), using=None, slow_threshold=0.5, explain_rate=0.0):
+        self.sinks = list(sinks)
+        self.using = using
+        self.slow_threshold = slow_threshold
+        self.explain_rate = explain_rate
+        # The stages running in each thread, innermost last
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def stage(self, search_bar, name, queryset=None):
+        """
+        Measures the code in the with block as the stage ``name`` of the search_bar
+        @param queryset: the queryset the stage evaluates, to be explained when it's slow
+        """
+        frame = {'queries': 0, 'nested_duration': 0.0, 'nested_queries': 0}
+        stack = self.local.__dict__.setdefault('stages', [])
+
+        def count_queries(execute, sql, params, many, context):
+            frame['queries'] += 1
+            return execute(sql, params, many, context)
+
+        aliases = [self.using] if self.using is not None else list(connections)
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            with contextlib.ExitStack() as wrappers:
+                for alias in aliases:
+                    wrappers.enter_context(connections[alias].execute_wrapper(count_queries))
+                yield
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            if stack:
+                stack[-1]['nested_duration'] += duration
+                stack[-1]['nested_queries'] += frame['queries']
+        self.record(search_bar, name, duration - frame['nested_duration'], frame['queries'] - frame['nested_queries'],
+                    queryset)
+
+    def get_search_key(self, search_bar):
+        """
+        The key of the search, worked out once for the search bar without changing it (no errors are added)
+        """
+        if not search_bar.fields or not search_bar.form.is_valid():
+            return None
+        return search_bar.get_search_key()
+
+    def should_explain(self, duration):
+        return (self.slow_threshold is not None and duration >= self.slow_threshold
+                and self.explain_rate > 0 and random.random() < self.explain_rate)
+
+    def explain(self, queryset):
+        try:
+            return queryset.explain()
+        except Exception:
+            logger.exception('Could not explain the search query')
+            return None
+
+    def record(self, search_bar, stage, duration, queries, queryset=None):
+        search_key = self.get_search_key(search_bar)
+        explain = None
+        if queryset is not None and self.should_explain(duration):
+            explain = self.explain(queryset)
+            if explain is not None:
+                slow_search.send(sender=search_bar.__class__, search_bar=search_bar, search_key=search_key,
+                                 duration=duration, sql=str(queryset.query), explain=explain)
+
+        search_stage.send(sender=search_bar.__class__, search_bar=search_bar, stage=stage, duration=duration,
+                          queries=queries, search_key=search_key, explain=explain)
+        for sink in self.sinks:
+            sink.record(search_bar, stage, duration, queries, search_key=search_key, explain=explain)
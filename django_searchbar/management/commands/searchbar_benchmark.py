@@ -0,0 +1,67 @@
+import importlib
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django_searchbar import benchmarks
+
+BENCHMARKS = ('hotpaths', 'rendering', 'validation', 'trigram', 'autocomplete', 'allocations')
+
+
+class Command(BaseCommand):
+
+    help = 'Runs the searchbar benchmarks on a synthetic database and writes their timings as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmarks', nargs='*',
+                            help='The benchmarks to run, among %s, all of them by default' % ', '.join(BENCHMARKS))
+        parser.add_argument('--rows', type=int, default=10000, help='The number of users in the synthetic dataset')
+        parser.add_argument('--number', type=int, default=200, help='How many times a benchmark runs in a measure')
+        parser.add_argument('--repeat', type=int, default=3, help='How many measures are taken, the best one is kept')
+        parser.add_argument('--output', help='Writes the results to this JSON file')
+        parser.add_argument('--compare', help='Compares the results with this JSON file of an earlier run')
+
+    def run_benchmark(self, name, rows, number, repeat):
+        module = importlib.import_module('django_searchbar.benchmarks.%s' % name)
+        if name in ('rendering', 'validation', 'allocations'):
+            return module.run(number=number, repeat=repeat)
+        if name == 'trigram':
+            return module.run(rows=rows, number=max(1, number // 10), repeat=repeat)
+        return module.run(rows=rows, number=number, repeat=repeat)
+
+    def handle(self, *args, **options):
+        for name in options['benchmarks']:
+            if name not in BENCHMARKS:
+                raise CommandError('Unknown benchmark %s, choose among %s' % (name, ', '.join(BENCHMARKS)))
+
+        before = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as f:
+                    before = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError('Could not read %s: %s' % (options['compare'], e))
+
+        results = {}
+        for name in options['benchmarks'] or BENCHMARKS:
+            # A new database for each, so they all start from the same dataset
+            old_name = connection.settings_dict['NAME']
+            benchmarks.create_database()
+            try:
+                results[name] = self.run_benchmark(name, options['rows'], options['number'], options['repeat'])
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+            self.stdout.write(name)
+            for line in benchmarks.format_results(results[name]):
+                self.stdout.write('    %s' % line)
+
+        metadata = benchmarks.get_metadata(rows=options['rows'], number=options['number'], repeat=options['repeat'])
+        output = benchmarks.to_json(results, metadata)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+
+        if before is not None:
+            self.stdout.write('Compared with %s' % (before['metadata'].get('commit') or options['compare']))
+            for benchmark, name, old, new, ratio in benchmarks.compare(before, json.loads(output)):
+                self.stdout.write('    %-10s %-30s %+7.1f%%' % (benchmark, name, (ratio - 1) * 100))
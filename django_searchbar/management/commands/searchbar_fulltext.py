@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.urls import get_resolver
+from django_searchbar.backends import registry
+
+
+class Command(BaseCommand):
+
+    help = 'Creates the full text indexes of the searchbar backends and brings them up to date'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Index every row again instead of the missing ones')
+
+    def handle(self, *args, **options):
+        # The backends are usually declared next to the views
+        get_resolver().url_patterns
+
+        for backend in list(registry):
+            backend.install()
+            backend.sync(rebuild=options['rebuild'])
+            self.stdout.write('Synced %s (%s)' % (backend.model._meta.label, ', '.join(backend.fields)))
@@ -0,0 +1,104 @@
+import os
+import site
+import sysconfig
+import django
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.migrations import Migration
+from django.db.migrations.autodetector import MigrationAutodetector
+from django.db.migrations.loader import MigrationLoader
+from django.db.migrations.operations import AddIndex
+from django.db.migrations.writer import MigrationWriter
+from django.urls import get_resolver
+from django_searchbar.advisor import advise, iter_views, STATUSES
+
+
+class Command(BaseCommand):
+
+    help = 'Finds the views using SearchBarViewMixin in the URLconf and reports the search fields without an index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--urlconf', help='The URLconf to look in, ROOT_URLCONF by default')
+        parser.add_argument('--migrations', action='store_true', help='Writes a migration adding the missing indexes to each app')
+        parser.add_argument('--dry-run', action='store_true', help='Prints the migrations instead of writing them')
+        parser.add_argument('--check', action='store_true', help='Exits with an error when an index is missing')
+
+    def is_project_app(self, app_label):
+        """
+        Tells whether the migrations of an app are ours to write: MIGRATION_MODULES moves them, or the app is not
+        an installed package (Django, site-packages)
+        """
+        if app_label in getattr(settings, 'MIGRATION_MODULES', {}):
+            return True
+        packages = set(site.getsitepackages() + [site.getusersitepackages()])
+        packages.update(sysconfig.get_paths()[key] for key in ('purelib', 'platlib'))
+        packages.add(os.path.dirname(django.__path__[0]))
+        path = os.path.realpath(apps.get_app_config(app_label).path)
+        return not any(path.startswith(os.path.realpath(package) + os.sep) for package in packages)
+
+    def get_migrations(self, suggestions):
+        """
+        @return list: a Migration adding the suggested indexes for each app of the project
+        """
+        loader = MigrationLoader(None, ignore_no_migrations=True)
+        operations = {}
+        for model, index in suggestions:
+            app_label = model._meta.app_label
+            if app_label in loader.unmigrated_apps:
+                self.stderr.write('%s has no migrations, add %s by hand' % (app_label, index.name))
+                continue
+            if not self.is_project_app(app_label):
+                self.stderr.write('%s is not an app of the project, add %s to one of your migrations or set '
+                                  'MIGRATION_MODULES' % (app_label, index.name))
+                continue
+            operations.setdefault(app_label, []).append(AddIndex(model_name=model._meta.model_name, index=index))
+
+        migrations = []
+        for app_label, app_operations in operations.items():
+            leaves = loader.graph.leaf_nodes(app_label)
+            number = 1
+            if leaves:
+                number = (MigrationAutodetector.parse_number(leaves[-1][1]) or 0) + 1
+            migration = Migration('%04i_searchbar_indexes' % number, app_label)
+            migration.dependencies = leaves
+            migration.operations = app_operations
+            migrations.append(migration)
+        return migrations
+
+    def handle(self, *args, **options):
+        suggestions = {}
+        missing = 0
+        for route, view_class in iter_views(get_resolver(options['urlconf']).url_patterns):
+            self.stdout.write('%s %s.%s' % (route or '/', view_class.__module__, view_class.__name__))
+            advices, view_suggestions = advise(view_class)
+            for advice in advices:
+                line = '    %s' % advice
+                if advice.status == 'indexed':
+                    line += ' by %s' % advice.index
+                elif advice.status == 'missing':
+                    missing += 1
+                    line += ', suggested %s' % advice.index.name
+                self.stdout.write(line)
+            for model, index in view_suggestions:
+                suggestions.setdefault(index.name, (model, index))
+
+        if suggestions:
+            self.stdout.write('Suggested indexes:')
+            for model, index in suggestions.values():
+                self.stdout.write('    %s: %r' % (model._meta.label, index))
+
+        if options['migrations']:
+            for migration in self.get_migrations(suggestions.values()):
+                writer = MigrationWriter(migration)
+                if options['dry_run']:
+                    self.stdout.write('%s:' % writer.path)
+                    self.stdout.write(writer.as_string())
+                    continue
+                os.makedirs(os.path.dirname(writer.path), exist_ok=True)
+                with open(writer.path, 'w') as f:
+                    f.write(writer.as_string())
+                self.stdout.write('Wrote %s' % writer.path)
+
+        if options['check'] and missing:
+            raise CommandError('%s search fields have a %s' % (missing, STATUSES['missing']))
@@ -1,29 +1,265 @@
 # -*- coding: utf-8 -*-
-from .utils import SearchBar
+import hashlib
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Max
+from django.db.models.query import QuerySet
+from django.http import Http404, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from .utils import SearchBar, listify
+from .pagination import KeysetPaginator, KeysetPage, InvalidCursor, SearchPaginator
+from .export import EXPORT_FORMATS, export_response
+from .planning import plan_queryset, logger
+from .routers import get_search_database
+from .budget import SearchTimeout
+from .cache import ModelVersions
 
 
 class SearchBarViewMixin:
 
     """
     A Class Based View Mixin to use SearchBar
+    The SearchBar is built once in dispatch and shared by get, post and get_context_data,
+    so the form is constructed and validated only once per request.
     """
     searchbar_method = 'post'
+    searchbar_cache = None
+    searchbar_fragment_cache = None
+    searchbar_keyset_ordering = None
+    searchbar_cursor_kwarg = 'cursor'
+    searchbar_count_strategy = 'exact'
+    searchbar_count_timeout = 60
+    searchbar_facets = False
+    searchbar_export_columns = None
+    searchbar_export_kwarg = 'export'
+    searchbar_export_chunk_size = 2000
+    searchbar_columns = None
+    searchbar_only = True
+    searchbar_instrumentation = None
+    searchbar_fast = False
+    searchbar_single_flight = None
+    searchbar_routing = True
+    searchbar_budget = None
+    searchbar_etag = False
+    searchbar_etag_field = None
+    searchbar_etag_versions = None
 
     def get_searchbar(self, request):
-        return SearchBar(request, self.searchbar_fields, self.searchbar_replacements, self.searchbar_method)
+        return SearchBar(request, self.searchbar_fields, self.searchbar_replacements, self.searchbar_method,
+                         fast=self.searchbar_fast)
 
     def dispatch(self, request, *args, **kwargs):
         assert hasattr(self, 'searchbar_fields'), 'You should provide searchbar_fields attribute in your class'
         self.searchbar_replacements = getattr(self, 'searchbar_replacements', {})
         self.searchbar_obj = self.get_searchbar(request)
+        if self.searchbar_fragment_cache is not None:
+            self.searchbar_obj.fragment_cache = self.searchbar_fragment_cache
+        if self.searchbar_instrumentation is not None:
+            self.searchbar_obj.instrumentation = self.searchbar_instrumentation
+        if self.searchbar_budget is not None:
+            self.searchbar_obj.budget = self.searchbar_budget
         return super().dispatch(request, *args, **kwargs)
 
+    def filter_queryset(self, queryset):
+        """
+        Applies the filters of this request's SearchBar to the queryset, if it validates
+        A search beyond searchbar_budget, or taking too long for it, returns no results.
+        Set searchbar_cache to a django_searchbar.cache.SearchResultCache to cache the results,
+        searchbar_single_flight to a django_searchbar.coalescing.SingleFlight to run the identical concurrent
+        searches once, and searchbar_facets to count the results of the choices (see SearchBar.count_facets).
+        """
+        queryset = self.route_queryset(queryset, self.get_search_database())
+        search_obj = self.searchbar_obj
+        if search_obj.is_valid():
+            try:
+                if self.searchbar_facets:
+                    search_obj.count_facets(queryset)
+                queryset = search_obj.filter(queryset, cache=self.searchbar_cache,
+                                             single_flight=self.searchbar_single_flight)
+            except SearchTimeout:
+                queryset = queryset.none()
+        elif search_obj.over_budget:
+            # A search beyond the budget isn't run unfiltered
+            queryset = queryset.none()
+        return queryset
+
+    def get_search_database(self):
+        """
+        Returns the alias the search reads from, with settings.SEARCHBAR_REPLICA set (see django_searchbar.routers.SearchRouter)
+        Set searchbar_routing to False for the views that have to read from the primary.
+        """
+        if not self.searchbar_routing:
+            return None
+        return get_search_database(self.request)
+
+    def route_queryset(self, queryset, alias):
+        if alias is None or queryset._db is not None:
+            # A queryset given a database by its view keeps it
+            return queryset
+        return queryset.using(alias)
+
+    def get_searchbar_plan(self, queryset):
+        """
+        Works out the QueryPlan of searchbar_columns, the columns your template displays.
+        A column is either the label of a field in searchbar_fields, which goes through searchbar_replacements,
+        or a lookup path of the model, e.g. 'user__username'. Set searchbar_only to False to load all the columns.
+        @return QueryPlan|None
+        """
+        if not self.searchbar_columns:
+            return None
+
+        paths = []
+        for column in self.searchbar_columns:
+            replacement = self.searchbar_replacements.get(column, column)
+            if callable(replacement):
+                replacement = column
+            paths.extend(listify(replacement))
+
+        plan = plan_queryset(queryset.model, paths, only=self.searchbar_only)
+        logger.debug('%s query plan: %s', self.__class__.__name__, plan)
+        return plan
+
+    def plan_queryset(self, queryset):
+        """
+        Applies the plan of searchbar_columns, so the list doesn't do a query per row for its relations
+        """
+        self.searchbar_plan = self.get_searchbar_plan(queryset)
+        if self.searchbar_plan:
+            queryset = self.searchbar_plan.apply(queryset)
+        return queryset
+
+    def paginate_queryset(self, queryset, page_size):
+        """
+        With searchbar_keyset_ordering set, e.g. ('-date_joined', 'pk'), pages are selected by an opaque
+        cursor in the searchbar_cursor_kwarg parameter instead of a page number
+        """
+        if not self.searchbar_keyset_ordering:
+            return super().paginate_queryset(queryset, page_size)
+
+        paginator = KeysetPaginator(queryset, page_size, self.searchbar_keyset_ordering)
+        try:
+            page = paginator.page(self.request.GET.get(self.searchbar_cursor_kwarg))
+        except InvalidCursor:
+            raise Http404('Invalid cursor')
+        return (paginator, page, page.object_list, page.has_other_pages())
+
+    def get_count_cache_key(self, queryset):
+        """
+        The key of the cached count strategy: the model and the normalized search.
+        Override it if your get_queryset depends on more than that, e.g. the user.
+        """
+        search_key = ''
+        if self.searchbar_obj.is_valid():
+            search_key = repr(self.searchbar_obj.get_search_key())
+        return 'searchbar:count:%s:%s' % (queryset.model._meta.label_lower, hashlib.md5(search_key.encode('utf-8')).hexdigest())
+
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs):
+        """
+        searchbar_count_strategy is 'exact' (the ListView paginator), 'cached' or 'has_more', see SearchPaginator
+        """
+        if self.searchbar_count_strategy == 'exact':
+            return super().get_paginator(queryset, per_page, orphans, allow_empty_first_page, **kwargs)
+
+        cache_key = None
+        if self.searchbar_count_strategy == 'cached':
+            cache_key = self.get_count_cache_key(queryset)
+        return SearchPaginator(queryset, per_page, orphans, allow_empty_first_page,
+                               count_strategy=self.searchbar_count_strategy, cache_key=cache_key,
+                               cache_timeout=self.searchbar_count_timeout)
+
+    def get_export_format(self):
+        """
+        Returns 'csv' or 'jsonl' when an export is asked for, e.g. ?export=csv, and searchbar_export_columns is set
+        """
+        if not self.searchbar_export_columns:
+            return None
+        export_format = self.request.GET.get(self.searchbar_export_kwarg) or self.request.POST.get(self.searchbar_export_kwarg)
+        if export_format in EXPORT_FORMATS:
+            return export_format
+        return None
+
+    def export(self, export_format):
+        queryset = self.get_queryset()
+        return export_response(queryset, self.searchbar_export_columns, export_format,
+                               chunk_size=self.searchbar_export_chunk_size,
+                               limit=lambda: self.searchbar_obj.limit(queryset))
+
+    def get_searchbar_version(self, queryset):
+        """
+        Returns a stamp of the searched table that changes with its rows, and the time of the last change if known.
+        With searchbar_etag_field, e.g. 'updated_at' (better indexed), it's the latest value of that column, which
+        misses the deletions. Otherwise it's a counter bumped by post_save/post_delete of the model.
+        @return tuple: (version, last modified timestamp or None)
+        """
+        if self.searchbar_etag_field:
+            latest = queryset.aggregate(latest=Max(self.searchbar_etag_field))['latest']
+            if latest is None:
+                return None, None
+            return latest.isoformat(), int(latest.timestamp())
+
+        versions = self.get_searchbar_versions()
+        versions.watch(queryset.model)
+        return versions.get(queryset.model), None
+
+    @classmethod
+    def get_searchbar_versions(cls):
+        """
+        Returns searchbar_etag_versions, a django_searchbar.cache.ModelVersions, or else the one of the view class
+        """
+        if cls.searchbar_etag_versions is not None:
+            return cls.searchbar_etag_versions
+        if '_searchbar_versions' not in cls.__dict__:
+            cls._searchbar_versions = ModelVersions()
+        return cls._searchbar_versions
+
+    def get_searchbar_validators(self):
+        """
+        Returns the ETag and Last-Modified of the GET request when searchbar_etag is set, from the normalized search
+        key, the other parameters (e.g. the page) and the version of the table.
+        Override it to add what else your page depends on, e.g. the user.
+        @return dict|None: the etag and last_modified arguments of django.utils.cache.get_conditional_response
+        """
+        if not self.searchbar_etag:
+            return None
+
+        search_obj = self.searchbar_obj
+        search_key = search_obj.get_search_key() if search_obj.is_valid() else ()
+        parameters = sorted((key, self.request.GET.getlist(key)) for key in self.request.GET if key not in search_obj.form.fields)
+        version, last_modified = self.get_searchbar_version(self.get_queryset())
+        etag = hashlib.md5(repr((search_key, parameters, version)).encode('utf-8')).hexdigest()
+        return {'etag': quote_etag(etag), 'last_modified': last_modified}
+
+    def get_not_modified(self, validators):
+        """
+        Returns a 304 Not Modified response when the client has the current version of the page, before any search,
+        or None to render it
+        """
+        if validators is None:
+            return None
+        response = self.add_validators(HttpResponse(), validators)
+        conditional_response = get_conditional_response(self.request, response=response, **validators)
+        # Without a matching precondition, the response given is returned as it is
+        if conditional_response is response:
+            return None
+        return conditional_response
+
+    def add_validators(self, response, validators):
+        if validators is not None:
+            response['ETag'] = validators['etag']
+            if validators['last_modified'] is not None:
+                response['Last-Modified'] = http_date(validators['last_modified'])
+        return response
+
     def post(self, request, *args, **kwargs):
 
-        search_obj = self.get_searchbar(request)
-        if search_obj.is_valid():
-            self.queryset = self.get_queryset().filter(search_obj.get_filters())
+        self.queryset = self.filter_queryset(self.get_queryset())
 
+        export_format = self.get_export_format()
+        if export_format:
+            return self.export(export_format)
+
+        self.queryset = self.plan_queryset(self.queryset)
         if hasattr(super(), 'post'):
             return super().post(request, *args, **kwargs)
         else:
@@ -31,13 +267,118 @@ class SearchBarViewMixin:
 
     def get(self, request, *args, **kwargs):
 
-        search_obj = self.get_searchbar(request)
-        if search_obj.is_valid():
-            self.queryset = self.get_queryset().filter(search_obj.get_filters())
+        validators = self.get_searchbar_validators()
+        not_modified = self.get_not_modified(validators)
+        if not_modified is not None:
+            return not_modified
+
+        self.queryset = self.filter_queryset(self.get_queryset())
 
-        return super().get(request, *args, **kwargs)
+        export_format = self.get_export_format()
+        if export_format:
+            return self.add_validators(self.export(export_format), validators)
+
+        self.queryset = self.plan_queryset(self.queryset)
+        return self.add_validators(super().get(request, *args, **kwargs), validators)
 
     def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['search_bar'] = self.get_searchbar(self.request)
+        """
+        With searchbar_budget set (see django_searchbar.budget.SearchBudget), a search taking too long
+        has an error and no results
+        """
+        try:
+            with self.searchbar_obj.limit(getattr(self, 'object_list', None)):
+                context = super().get_context_data(**kwargs)
+                object_list = context.get('object_list')
+                if (self.searchbar_obj.instrumentation is not None or self.searchbar_obj.budget is not None) \
+                        and isinstance(object_list, QuerySet):
+                    # Evaluated here rather than in the template, so it's measured and limited
+                    self.searchbar_obj.evaluate(object_list)
+        except SearchTimeout:
+            self.object_list = self.object_list.none()
+            # The page asked for doesn't exist in no results
+            self.kwargs = dict(self.kwargs, **{self.page_kwarg: 1})
+            context = super().get_context_data(**kwargs)
+
+        context['search_bar'] = self.searchbar_obj
+        page = context.get('page_obj')
+        if isinstance(page, KeysetPage):
+            context['next_cursor'] = page.next_cursor
+            context['previous_cursor'] = page.previous_cursor
+        if isinstance(context.get('paginator'), SearchPaginator):
+            context['count_strategy'] = context['paginator'].strategy
+        if settings.DEBUG:
+            context['searchbar_plan'] = getattr(self, 'searchbar_plan', None)
         return context
+
+
+class AsyncSearchBarViewMixin(SearchBarViewMixin):
+
+    """
+    An async version of SearchBarViewMixin for ListView, served under ASGI
+    The form is validated in a thread, the filters come from SearchBar.aget_filters (replacements can be
+    coroutine functions) and the results are fetched with async iteration of the queryset.
+    The coroutine replacements are awaited once, before the search key, the facets and the filters use them.
+    POST renders the same list as GET.
+    """
+
+    async def afilter_queryset(self, queryset):
+        # Checking the replica connects to it
+        queryset = self.route_queryset(queryset, await sync_to_async(self.get_search_database)())
+        search_obj = self.searchbar_obj
+        if await sync_to_async(search_obj.is_valid)():
+            filters = await search_obj.aget_filters()
+            try:
+                if self.searchbar_facets:
+                    await sync_to_async(search_obj.count_facets)(queryset)
+                if self.searchbar_cache is not None or self.searchbar_single_flight is not None:
+                    # filter() gets the filters memoized by aget_filters
+                    queryset = await sync_to_async(search_obj.filter)(queryset, cache=self.searchbar_cache,
+                                                                      single_flight=self.searchbar_single_flight)
+                else:
+                    queryset = queryset.filter(filters)
+            except SearchTimeout:
+                queryset = queryset.none()
+        elif search_obj.over_budget:
+            queryset = queryset.none()
+        return queryset
+
+    async def get(self, request, *args, **kwargs):
+
+        if await sync_to_async(self.searchbar_obj.is_valid)():
+            await self.searchbar_obj.aresolve_replacements()
+
+        validators = None
+        if request.method in ('GET', 'HEAD'):
+            validators = await sync_to_async(self.get_searchbar_validators)()
+            not_modified = self.get_not_modified(validators)
+            if not_modified is not None:
+                return not_modified
+
+        self.object_list = self.queryset = await self.afilter_queryset(self.get_queryset())
+
+        export_format = self.get_export_format()
+        if export_format:
+            return self.add_validators(self.export(export_format), validators)
+
+        self.object_list = self.queryset = self.plan_queryset(self.queryset)
+        if not self.get_allow_empty() and not await self.object_list.aexists():
+            raise Http404('Empty list and "%s.allow_empty" is False.' % self.__class__.__name__)
+
+        # Pagination counts synchronously, so the context is built in a thread
+        context = await sync_to_async(self.get_context_data)()
+
+        object_list = context.get('object_list')
+        if isinstance(object_list, QuerySet):
+            results = [obj async for obj in object_list]
+            for key, value in list(context.items()):
+                if value is object_list:
+                    context[key] = results
+            if context.get('page_obj') is not None:
+                context['page_obj'].object_list = results
+
+        return self.add_validators(self.render_to_response(context), validators)
+
+    async def post(self, request, *args, **kwargs):
+
+        return await self.get(request, *args, **kwargs)
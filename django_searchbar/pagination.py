@@ -0,0 +1,265 @@
+import base64
+import binascii
+import datetime
+import decimal
+import json
+import uuid
+from django.core.cache import caches
+from django.core.paginator import Paginator, Page, PageNotAnInteger, EmptyPage
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.utils.functional import cached_property
+
+COUNT_STRATEGIES = ('exact', 'cached', 'has_more')
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class CursorEncoder(json.JSONEncoder):
+
+    """
+    Unlike DjangoJSONEncoder, keeps the microseconds, a cursor has to match the row exactly
+    """
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.date, datetime.time)):
+            return o.isoformat()
+        if isinstance(o, (decimal.Decimal, uuid.UUID)):
+            return str(o)
+        return super(CursorEncoder, self).default(o)
+
+
+def encode_cursor(direction, values):
+    """
+    @param direction: 'next' or 'previous'
+    @param values: the values of the ordering fields of the row the page starts after
+    @return str: an opaque, url safe token
+    """
+    payload = json.dumps([direction, values], cls=CursorEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    @return tuple: (direction, values)
+    @raise InvalidCursor
+    """
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, values = json.loads(payload.decode('utf-8'))
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise InvalidCursor('Invalid cursor %r' % cursor)
+    if direction not in ('next', 'previous') or not isinstance(values, list):
+        raise InvalidCursor('Invalid cursor %r' % cursor)
+    return direction, values
+
+
+def parse_ordering(ordering):
+    """
+    @return list: (field, descending) pairs, ending with the primary key so rows are totally ordered
+    """
+    fields = []
+    for field in ordering:
+        descending = field.startswith('-')
+        fields.append((field.lstrip('-'), descending))
+    if not any(field in ('pk', 'id') for field, descending in fields):
+        fields.append(('pk', fields[-1][1] if fields else False))
+    return fields
+
+
+def get_cursor_filters(ordering, values):
+    """
+    Returns the Q object of the rows that come after ``values`` in ``ordering``
+    e.g. for (a, b) ascending: a > x OR (a = x AND b > y)
+    """
+    filters = Q()
+    equal = Q()
+    for (field, descending), value in zip(ordering, values):
+        filters |= equal & Q(**{'%s__%s' % (field, 'lt' if descending else 'gt'): value})
+        equal &= Q(**{field: value})
+    return filters
+
+
+class KeysetPage:
+
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __repr__(self):
+        return '<KeysetPage of %s objects>' % len(self.object_list)
+
+
+class KeysetPaginator:
+
+    """
+    Paginates with a WHERE on the ordering columns instead of an OFFSET, so deep pages cost the
+    same as the first one (given an index on the ordering).
+    Usage:
+        paginator = KeysetPaginator(Person.objects.filter(search_bar.get_filters()), 20, ['-created', 'pk'])
+        page = paginator.page(request.GET.get('cursor'))
+        page.object_list, page.next_cursor, page.previous_cursor
+
+    The ordering columns should not be nullable, the primary key is added to break the ties.
+    """
+
+    def __init__(self, queryset, per_page, ordering):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.ordering = parse_ordering(ordering)
+
+    def get_values(self, obj):
+        values = []
+        for field, descending in self.ordering:
+            value = obj
+            for attr in field.split('__'):
+                value = getattr(value, attr)
+            values.append(value)
+        return values
+
+    def page(self, cursor=None):
+        """
+        @param cursor: a token from next_cursor/previous_cursor of another page, None for the first page
+        @raise InvalidCursor
+        """
+        direction, values = 'next', None
+        if cursor:
+            direction, values = decode_cursor(cursor)
+            if len(values) != len(self.ordering):
+                raise InvalidCursor('Invalid cursor %r' % cursor)
+
+        ordering = self.ordering
+        if direction == 'previous':
+            ordering = [(field, not descending) for field, descending in ordering]
+
+        queryset = self.queryset.order_by(*[('-' if descending else '') + field for field, descending in ordering])
+        if values is not None:
+            queryset = queryset.filter(get_cursor_filters(ordering, values))
+
+        object_list = list(queryset[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if direction == 'previous':
+            object_list.reverse()
+
+        # Coming from another page, there is always a way back
+        has_next, has_previous = has_more, values is not None
+        if direction == 'previous':
+            has_next, has_previous = has_previous, has_next
+
+        next_cursor = previous_cursor = None
+        if object_list and has_next:
+            next_cursor = encode_cursor('next', self.get_values(object_list[-1]))
+        if object_list and has_previous:
+            previous_cursor = encode_cursor('previous', self.get_values(object_list[0]))
+
+        return KeysetPage(object_list, next_cursor, previous_cursor)
+
+
+class HasMorePage(Page):
+
+    def __init__(self, object_list, number, paginator, more):
+        super(HasMorePage, self).__init__(object_list, number, paginator)
+        self.more = more
+
+    def has_next(self):
+        return self.more
+
+    def end_index(self):
+        return self.start_index() + len(self.object_list) - 1
+
+
+class SearchPaginator(Paginator):
+
+    """
+    A paginator for ListView with a choice of how the total is counted
+        exact: COUNT(*) on every page, like django's Paginator
+        cached: the count is kept in a django cache under ``cache_key`` for ``cache_timeout`` seconds
+        has_more: no count at all, a page fetches one more row to tell whether there is a next page,
+                  count and num_pages are None
+    ``strategy`` tells which one was used for the count: a cached count that was not in the cache is 'exact'.
+    """
+
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True, count_strategy='exact',
+                 cache_key=None, cache_alias='default', cache_timeout=60):
+        assert count_strategy in COUNT_STRATEGIES, 'count_strategy should be one of %s' % ', '.join(COUNT_STRATEGIES)
+        assert count_strategy != 'cached' or cache_key, 'The cached count strategy needs a cache_key'
+
+        super(SearchPaginator, self).__init__(object_list, per_page, orphans, allow_empty_first_page)
+        self.count_strategy = count_strategy
+        self.cache_key = cache_key
+        self.cache_alias = cache_alias
+        self.cache_timeout = cache_timeout
+        self.strategy = None
+
+    @cached_property
+    def count(self):
+        if self.count_strategy == 'has_more':
+            self.strategy = 'has_more'
+            return None
+
+        cache = caches[self.cache_alias]
+        if self.count_strategy == 'cached':
+            count = cache.get(self.cache_key)
+            if count is not None:
+                self.strategy = 'cached'
+                return count
+
+        if isinstance(self.object_list, QuerySet):
+            count = self.object_list.count()
+        else:
+            count = len(self.object_list)
+
+        self.strategy = 'exact'
+        if self.count_strategy == 'cached':
+            cache.set(self.cache_key, count, self.cache_timeout)
+        return count
+
+    @cached_property
+    def num_pages(self):
+        if self.count_strategy == 'has_more':
+            return None
+        return Paginator.num_pages.func(self)
+
+    def validate_number(self, number):
+        if self.count_strategy != 'has_more':
+            return super(SearchPaginator, self).validate_number(number)
+
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        return number
+
+    def page(self, number):
+        if self.count_strategy != 'has_more':
+            return super(SearchPaginator, self).page(number)
+
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        object_list = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not object_list and (number > 1 or not self.allow_empty_first_page):
+            raise EmptyPage('That page contains no results')
+
+        self.strategy = 'has_more'
+        return HasMorePage(object_list[:self.per_page], number, self, len(object_list) > self.per_page)
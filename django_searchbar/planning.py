@@ -0,0 +1,121 @@
+import logging
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models.constants import LOOKUP_SEP
+
+logger = logging.getLogger('django_searchbar')
+
+PATH_PREFIXES = '^=@'
+
+
+class QueryPlan:
+
+    """
+    What a list of results has to load: the relations joined in the same query (select_related),
+    the to-many relations fetched in one more query each (prefetch_related) and the columns (only).
+    ``unresolved`` are the columns that are not model fields (e.g. properties), with any of them
+    the columns are not restricted.
+    """
+
+    def __init__(self, select_related=(), prefetch_related=(), only=(), unresolved=()):
+        self.select_related = tuple(select_related)
+        self.prefetch_related = tuple(prefetch_related)
+        self.only = tuple(only)
+        self.unresolved = tuple(unresolved)
+
+    def apply(self, queryset):
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if self.prefetch_related:
+            queryset = queryset.prefetch_related(*self.prefetch_related)
+        if self.only:
+            queryset = queryset.only(*self.only)
+        return queryset
+
+    def __bool__(self):
+        return bool(self.select_related or self.prefetch_related or self.only)
+
+    def __str__(self):
+        parts = []
+        for name in ('select_related', 'prefetch_related', 'only', 'unresolved'):
+            values = getattr(self, name)
+            if values:
+                parts.append('%s(%s)' % (name, ', '.join(values)))
+        return ' '.join(parts) or 'no plan'
+
+    def __repr__(self):
+        return '<QueryPlan %s>' % self
+
+
+def resolve_path(model, path):
+    """
+    Walks a lookup path, e.g. 'user__groups__name'
+    @return tuple: (relations, field_name, to_many) where relations are the names of the relations in the path,
+                   field_name the concrete field at the end (None when the path ends on a relation) and to_many
+                   the position of the first many to many or reverse foreign key in relations (None if there is none)
+    @raise FieldDoesNotExist: when the path doesn't start with a field of the model
+    """
+    relations = []
+    to_many = None
+    parts = path.lstrip(PATH_PREFIXES).split(LOOKUP_SEP)
+    for position, part in enumerate(parts):
+        try:
+            field = model._meta.get_field(part)
+        except FieldDoesNotExist:
+            if position == 0:
+                raise
+            # The rest is a lookup, e.g. __icontains
+            break
+        if not field.is_relation:
+            return relations, field.name, to_many
+        if to_many is None and (field.many_to_many or field.one_to_many):
+            to_many = len(relations)
+        relations.append(field.name)
+        model = field.related_model
+    return relations, None, to_many
+
+
+def plan_queryset(model, paths, only=True):
+    """
+    Works out the QueryPlan that loads the paths without a query per row
+    Forward relations are joined, the ones after a to-many relation are prefetched along with it.
+    @param paths: lookup paths of the displayed columns
+    @param only: whether to restrict the columns to the paths
+    @return QueryPlan
+    """
+    select_related, prefetch_related, columns, unresolved = [], [], [], []
+
+    for path in paths:
+        try:
+            relations, field_name, to_many = resolve_path(model, path)
+        except FieldDoesNotExist:
+            unresolved.append(path)
+            continue
+
+        joined = relations if to_many is None else relations[:to_many]
+        if joined:
+            select_related.append(LOOKUP_SEP.join(joined))
+
+        if to_many is not None:
+            prefetch_related.append(LOOKUP_SEP.join(relations))
+            if joined:
+                # The prefetch needs the primary key of the last joined model
+                last = model
+                for name in joined:
+                    last = last._meta.get_field(name).related_model
+                columns.append(LOOKUP_SEP.join(joined + [last._meta.pk.name]))
+        elif field_name is not None:
+            columns.append(LOOKUP_SEP.join(relations + [field_name]))
+        else:
+            columns.append(LOOKUP_SEP.join(relations))
+
+    def unique(values):
+        return [value for position, value in enumerate(values) if value not in values[:position]]
+
+    # A shorter path is already covered by a longer one, e.g. user by user__profile
+    select_related = [path for path in unique(select_related)
+                      if not any(other.startswith(path + LOOKUP_SEP) for other in select_related)]
+    prefetch_related = unique(prefetch_related)
+
+    if not only or unresolved:
+        columns = []
+    return QueryPlan(select_related, prefetch_related, unique(columns), unresolved)
@@ -0,0 +1,121 @@
+import contextvars
+import threading
+import time
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS, DatabaseError
+
+STICKY_SESSION_KEY = 'searchbar_primary_until'
+
+# The writes of the current request, set by SearchRouterMiddleware
+request_state = contextvars.ContextVar('searchbar_request_state', default=None)
+
+_down_until = {}
+_down_lock = threading.Lock()
+
+
+def get_replica():
+    """
+    @return str: settings.SEARCHBAR_REPLICA, the alias of the database the searches read from, or None
+    """
+    return getattr(settings, 'SEARCHBAR_REPLICA', None)
+
+
+def is_available(alias):
+    """
+    Tells whether the database can be connected to, a database that couldn't is not tried again for
+    settings.SEARCHBAR_REPLICA_RETRY seconds (30 by default)
+    """
+    if _down_until.get(alias, 0) > time.monotonic():
+        return False
+    try:
+        connections[alias].ensure_connection()
+    except DatabaseError:
+        with _down_lock:
+            _down_until[alias] = time.monotonic() + getattr(settings, 'SEARCHBAR_REPLICA_RETRY', 30)
+        return False
+    return True
+
+
+def is_sticky(request):
+    """
+    Tells whether the request has to read from the primary: it wrote, or its session did a moment ago
+    """
+    state = request_state.get()
+    if state is not None and state['wrote']:
+        return True
+    session = getattr(request, 'session', None)
+    return session is not None and session.get(STICKY_SESSION_KEY, 0) > time.time()
+
+
+class SearchRouter:
+
+    """
+    Sends the searches to a replica
+    Usage, in your settings:
+        DATABASE_ROUTERS = ['django_searchbar.routers.SearchRouter']
+        MIDDLEWARE = [..., 'django.contrib.sessions.middleware.SessionMiddleware', 'django_searchbar.routers.SearchRouterMiddleware']
+        SEARCHBAR_REPLICA = 'replica'
+
+    SearchBarViewMixin reads from the database get_search_database() returns: the replica, unless the session
+    wrote in the last settings.SEARCHBAR_REPLICA_STICKINESS seconds (10 by default), so it sees its own writes,
+    or the replica can't be connected to. The other queries are left to the other routers.
+    """
+
+    def get_search_database(self, request=None):
+        """
+        @return str: the alias the searches of the request read from, None without a replica
+        """
+        replica = get_replica()
+        if replica is None:
+            return None
+        if (request is not None and is_sticky(request)) or not is_available(replica):
+            return DEFAULT_DB_ALIAS
+        return replica
+
+    def db_for_read(self, model, **hints):
+        return None
+
+    def db_for_write(self, model, **hints):
+        state = request_state.get()
+        if state is not None:
+            state['wrote'] = True
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The rows read from the replica are the ones of the primary
+        databases = {DEFAULT_DB_ALIAS, get_replica()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return None
+
+
+def get_search_database(request=None):
+    """
+    Returns the alias the searches of the request read from, see SearchRouter
+    """
+    return SearchRouter().get_search_database(request)
+
+
+class SearchRouterMiddleware:
+
+    """
+    Records the writes of each request, so the searches of its session read from the primary for a while after
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = {'wrote': False}
+        token = request_state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            request_state.reset(token)
+        session = getattr(request, 'session', None)
+        if state['wrote'] and session is not None:
+            session[STICKY_SESSION_KEY] = time.time() + getattr(settings, 'SEARCHBAR_REPLICA_STICKINESS', 10)
+        return response
@@ -0,0 +1,23 @@
+from django import template
+from django.utils.safestring import mark_safe
+from django_searchbar.cache import fragment_cache
+
+register = template.Library()
+
+
+@register.simple_tag
+def searchbar(search_bar, form_tag=True):
+    """
+    Renders a SearchBar through the shared fragment cache
+    Usage:
+        {% load searchbar %}
+        {% searchbar search_bar %}
+        {% searchbar search_bar form_tag=False %} renders the fields only
+    """
+
+    if search_bar.fragment_cache is None:
+        search_bar.fragment_cache = fragment_cache
+
+    if form_tag:
+        return search_bar.as_form()
+    return mark_safe(str(search_bar))
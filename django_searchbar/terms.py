@@ -0,0 +1,100 @@
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Q, Exists, OuterRef, Expression, BooleanField
+from django.utils.text import smart_split, unescape_string_literal
+
+MAX_TERMS = 5
+
+PREFIXES = {
+    '^': 'istartswith',
+    '=': 'iexact',
+}
+
+
+def split_terms(value, max_terms=MAX_TERMS):
+    """
+    Splits the input into distinct terms, "quoted phrases" are kept together, like the admin's search.
+    Only the first ``max_terms`` are kept, so the input can't make the query arbitrarily big.
+    @return list
+    """
+    terms = []
+    for term in smart_split(str(value)):
+        if term[0] in '"\'' and term[0] == term[-1] and len(term) > 1:
+            term = unescape_string_literal(term)
+        if term.strip() and term not in terms:
+            terms.append(term)
+    return terms[:max_terms]
+
+
+def get_target_lookup(target, lookup):
+    """
+    Applies the lookup to a target, '^name' is istartswith and '=name' is iexact
+    """
+    if target[0] in PREFIXES:
+        return '%s__%s' % (target[1:], PREFIXES[target[0]])
+    return '%s__%s' % (target, lookup)
+
+
+def spans_many(model, path):
+    """
+    Tells whether a lookup path goes through a many to many or a reverse foreign key, which
+    would return the same row more than once in a join
+    """
+    for part in path.split('__'):
+        try:
+            field = model._meta.get_field(part)
+        except FieldDoesNotExist:
+            return False
+        if field.many_to_many or field.one_to_many:
+            return True
+        if not field.is_relation:
+            return False
+        model = field.related_model
+    return False
+
+
+class SearchTerms(Expression):
+
+    """
+    Every term has to match at least one of the targets: AND across terms, OR across targets.
+    It's resolved against the model of the query, targets through to-many relations are matched in a
+    single EXISTS subquery per term, so there are neither duplicate rows nor a join per term.
+    """
+
+    conditional = True
+    output_field = BooleanField()
+
+    def __init__(self, targets, terms, lookup='icontains'):
+        super(SearchTerms, self).__init__()
+        self.targets = list(targets)
+        self.terms = list(terms)
+        self.lookup = lookup
+
+    def __repr__(self):
+        return '%s(%r, %r, %r)' % (self.__class__.__name__, self.targets, self.terms, self.lookup)
+
+    def __eq__(self, other):
+        return isinstance(other, SearchTerms) and repr(self) == repr(other)
+
+    def __hash__(self):
+        return hash(repr(self))
+
+    def get_filters(self, model):
+        lookups = [get_target_lookup(target, self.lookup) for target in self.targets]
+        direct = [lookup for lookup in lookups if not spans_many(model, lookup)]
+        related = [lookup for lookup in lookups if spans_many(model, lookup)]
+
+        filters = Q()
+        for term in self.terms:
+            term_filters = Q()
+            for lookup in direct:
+                term_filters |= Q(**{lookup: term})
+            if related:
+                related_filters = Q()
+                for lookup in related:
+                    related_filters |= Q(**{lookup: term})
+                term_filters |= Exists(model._base_manager.filter(related_filters, pk=OuterRef('pk')))
+            filters &= term_filters
+        return filters
+
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None, summarize=False, for_save=False):
+        return self.get_filters(query.model).resolve_expression(query, allow_joins, reuse, summarize, for_save)
@@ -1,10 +1,64 @@
+import asyncio
+import copy
+import datetime
+import gc
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import warnings
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 from django.test import TestCase
 from django.test.client import Client
-from django.test.client import RequestFactory
+from django.test.client import RequestFactory, AsyncRequestFactory
 from django.forms import fields
+from django.db import connection, connections, OperationalError
+from django.utils import timezone
 from django.db.models import Q
-from django_searchbar.utils import SearchBar, listify
-from django_searchbar.forms import SearchBarForm
+from django.db.models.signals import post_save
+from django.http import Http404, StreamingHttpResponse
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.contrib.auth.models import User, Group, Permission
+from django.views.generic import ListView
+from django_searchbar.utils import SearchBar, listify, TIMEOUT_ERROR
+from django_searchbar.forms import SearchBarForm, CompiledSearchBarForm, compile_form
+from django_searchbar.compiled import FieldTable, get_field_table, clear_table_cache
+from django_searchbar.terms import split_terms, MAX_TERMS
+from django_searchbar.mixins import SearchBarViewMixin, AsyncSearchBarViewMixin
+from django_searchbar.planning import plan_queryset
+from django_searchbar.advisor import advise
+from django_searchbar.validation import FastForm
+from django_searchbar.choices import LazyChoices, iter_values
+from django_searchbar.coalescing import Call, SingleFlight, CacheSingleFlight
+from django_searchbar import routers
+from django_searchbar.budget import SearchBudget, SearchTimeout
+from django_searchbar.autocomplete import Autocomplete, AutocompleteView, PrefixIndex
+from django.urls import path, include
+from django_searchbar.instrumentation import Instrumentation, MemorySink, search_stage, slow_search
+from django_searchbar.cache import SearchResultCache, FragmentCache, ModelVersions
+from django.template import Template, Context
+from django_searchbar.backends import registry
+from django_searchbar.backends.sqlite import FTS5Backend
+from django_searchbar.backends.trigram import TrigramBackend
+from django.core.management import call_command, CommandError
+from django_searchbar.pagination import KeysetPaginator, SearchPaginator, encode_cursor
+from django.core.cache import cache
+
+
+class UserSearchView(SearchBarViewMixin, ListView):
+    model = User
+    template_name = 'django_searchbar/test.html'
+    searchbar_fields = ['username', 'email']
+    searchbar_method = 'get'
 
 
 class UtilsTestCase(TestCase):
@@ -323,6 +377,1883 @@ class FormsTestCase(TestCase):
         self.assertIsInstance(search_bar.fields['username'], fields.CharField)
         self.assertIsInstance(search_bar.fields['name'], fields.ChoiceField)
 
+    def testCompiledFormsAreCached(self):
+        spec = ['username', {'label': 'gender', 'choices': (('m', 'Male'), ('f', 'Female'))}]
+        form_class = compile_form(spec)
+        self.assertIs(form_class, compile_form(list(spec)))
+        self.assertIs(form_class, compile_form([
+            'username', {'label': 'gender', 'choices': [('m', 'Male'), ('f', 'Female')]},
+        ]))
+        self.assertIsNot(form_class, compile_form(['username']))
+        self.assertIsNot(form_class, compile_form([
+            'username', {'label': 'gender', 'choices': (('f', 'Female'), ('m', 'Male'))},
+        ]))
+        self.assertIsInstance(form_class({}), SearchBarForm)
+
+    def testCompiledFormsDoNotShareFields(self):
+        form_class = compile_form(['name'])
+        form = form_class({'name': 'arsham'})
+        form.fields['age'] = fields.CharField(required=False)
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['name'], 'arsham')
+        self.assertNotIn('age', form_class({}).fields)
+        self.assertEqual(form.fields['name'].label, 'Name')
+
+    def testSearchBarUsesCompiledForm(self):
+        request = RequestFactory().get('/?name=arsham')
+        self.assertIsInstance(SearchBar(request, ['name']).form, compile_form(['name']))
+
+
+class LookupsTestCase(TestCase):
+
+    def search(self, query, fields, **kwargs):
+        search_bar = SearchBar(RequestFactory().get(query), fields, **kwargs)
+        search_bar.is_valid()
+        return search_bar
+
+    def testFieldLookup(self):
+        search_bar = self.search('/?username=ars&email=arsham@example.com', [
+            {'label': 'username', 'lookup': 'istartswith'},
+            {'label': 'email', 'lookup': 'iexact'},
+        ], replacements={'username': 'user__username'})
+        self.assertEqual(search_bar.get_lookups(), [
+            ('user__username__istartswith', 'ars'),
+            ('email__iexact', 'arsham@example.com'),
+        ])
+
+    def testFieldLookupWinsOverLookupString(self):
+        search_bar = self.search('/?username=ars&email=arsham', ['email', {'label': 'username', 'lookup': 'exact'}])
+        self.assertEqual(search_bar.get_lookups(lookup_string='icontains'), [
+            ('email__icontains', 'arsham'),
+            ('username__exact', 'ars'),
+        ])
+
+    def testRange(self):
+        fields = [{'label': 'age', 'type': 'integer', 'lookup': 'range'}]
+        self.assertEqual(self.search('/?age_0=18&age_1=30', fields).get_lookups(), [('age__range', (18, 30))])
+        self.assertEqual(self.search('/?age_0=18', fields).get_lookups(), [('age__gte', 18)])
+        self.assertEqual(self.search('/?age_1=30', fields).get_lookups(), [('age__lte', 30)])
+        self.assertEqual(self.search('/?age_1=', fields).get_lookups(), [])
+        self.assertEqual(self.search('/?age_0=0', fields).get_lookups(), [('age__gte', 0)])
+        self.assertFalse(self.search('/?age_0=young', fields).is_valid())
+
+        search_bar = self.search('/?joined_0=2014-01-01', [{'label': 'joined', 'type': 'date', 'lookup': 'range'}])
+        self.assertEqual(search_bar.get_lookups(), [('joined__gte', datetime.date(2014, 1, 1))])
+        self.assertIn('name="joined_1"', str(search_bar))
+
+    def testIn(self):
+        fields = [{
+            'label': 'gender',
+            'choices': (('none', '---'), ('m', 'Male'), ('f', 'Female')),
+            'ignore_list': ['none'],
+            'lookup': 'in',
+        }]
+        self.assertEqual(self.search('/?gender=m&gender=f', fields).get_lookups(), [('gender__in', ['m', 'f'])])
+        self.assertEqual(self.search('/?gender=m&gender=none', fields).get_lookups(), [('gender', 'm')])
+        self.assertEqual(self.search('/?gender=none', fields).get_lookups(), [])
+        self.assertEqual(self.search('/', fields).get_lookups(), [])
+        self.assertRaises(AssertionError, compile_form, [{'label': 'gender', 'lookup': 'in'}])
+
+    def testLookupsQueryTheDatabase(self):
+        User.objects.create(username='arsham', email='arsham@example.com')
+        User.objects.create(username='ivan', email='ivan@example.com')
+        search_bar = self.search('/?username=ARS&id_0=1', [
+            {'label': 'username', 'lookup': 'istartswith'},
+            {'label': 'id', 'type': 'integer', 'lookup': 'range'},
+        ])
+        self.assertEqual([u.username for u in User.objects.filter(search_bar.get_filters())], ['arsham'])
+
+
+class FastValidationTestCase(TestCase):
+
+    fields = [
+        'name',
+        {'label': 'email', 'required': True, 'lookup': 'icontains'},
+        {'label': 'age', 'type': 'integer', 'lookup': 'range'},
+        {'label': 'gender', 'choices': (('none', '---'), ('m', 'Male'), ('f', 'Female')), 'ignore_list': ['none']},
+        {'label': 'colours', 'choices': (('r', 'Red'), ('g', 'Green')), 'lookup': 'in'},
+    ]
+
+    def search(self, query, fast, fields=None):
+        return SearchBar(RequestFactory().get(query), fields or self.fields, {'name': 'username'}, 'get', fast=fast)
+
+    def testSameAsTheForm(self):
+        for query in ('/?name=arsham&email=ars&age_0=18&gender=m&colours=r&colours=g', '/?email=ars&gender=none',
+                      '/?name=arsham', '/?email=ars&age_0=young', '/?email=ars&gender=x', '/?email=ars&colours=x',
+                      '/?email=ars&age_1=30', '/'):
+            form, fast = self.search(query, False), self.search(query, True)
+            self.assertIsInstance(fast.form, FastForm)
+            self.assertEqual(fast.is_valid(), form.is_valid(), query)
+            self.assertEqual(fast.errors, form.errors, query)
+            self.assertEqual(fast.form.cleaned_data, form.form.cleaned_data, query)
+            self.assertEqual(set(fast.form.errors), set(form.form.errors), query)
+            if form.is_valid():
+                self.assertEqual(fast.get_lookups(), form.get_lookups(), query)
+                self.assertEqual(str(fast.get_filters()), str(form.get_filters()), query)
+                self.assertEqual(fast['name'], form['name'])
+                self.assertEqual(fast.get_search_key(), form.get_search_key())
+
+    def testRequired(self):
+        search_bar = self.search('/?name=arsham', True)
+        self.assertFalse(search_bar.is_valid())
+        self.assertEqual(list(search_bar.form.errors), ['email'])
+        self.assertTrue(self.search('/?name=arsham', True, ['name']).is_valid('name'))
+        self.assertFalse(self.search('/?email=a', True, ['name', 'email']).is_valid('name'))
+
+    def testMappingAndRendering(self):
+        fast, form = self.search('/?name=arsham&email=ars', True), self.search('/?name=arsham&email=ars', False)
+        self.assertIn('name', fast)
+        self.assertEqual(len(fast), len(form))
+        self.assertEqual(str(fast), str(form))
+        self.assertEqual([field.name for field in fast], [field.name for field in form])
+
+        fast['order'] = (('asc', 'ASC'),)
+        self.assertIn('name="order"', str(fast))
+        self.assertNotIn('order', compile_form(self.fields).base_fields)
+
+    def testFacetsDontChangeTheCompiledFields(self):
+        User.objects.create(username='arsham', is_staff=True)
+        fields = [{'label': 'staff', 'choices': (('1', 'Staff'), ('0', 'Others'))}]
+        search_bar = SearchBar(RequestFactory().get('/'), fields, {'staff': 'is_staff'}, 'get', fast=True)
+        search_bar.is_valid()
+        search_bar.count_facets(User.objects.all())
+        self.assertIn('Staff (1)', str(search_bar))
+        self.assertEqual(list(compile_form(fields).base_fields['staff'].choices), [('1', 'Staff'), ('0', 'Others')])
+
+    def testBenchmark(self):
+        from django_searchbar.benchmarks import validation
+        results = validation.run(number=2, repeat=1)
+        self.assertEqual(set(results), {'form is_valid', 'fast is_valid', 'form get_filters', 'fast get_filters'})
+
+
+def get_group_choices():
+    return [(group.name, group.name.upper()) for group in Group.objects.order_by('name')]
+
+
+class LazyChoicesTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.admins = Group.objects.create(name='Admins')
+        self.editors = Group.objects.create(name='Editors')
+
+    def search(self, query, choices, **kwargs):
+        fields = [dict({'label': 'group', 'choices': choices}, **kwargs)]
+        return SearchBar(RequestFactory().get(query), fields, {'group': 'groups'}, 'get')
+
+    def testQueryset(self):
+        with self.assertNumQueries(0):
+            search_bar = self.search('/?group=%s' % self.editors.pk, Group.objects.order_by('name'))
+            form_class = compile_form(search_bar.fields)
+            self.assertIsInstance(form_class.base_fields['group'].choices, LazyChoices)
+        with self.assertNumQueries(1):
+            self.assertTrue(search_bar.is_valid())
+        self.assertEqual(search_bar['group'], str(self.editors.pk))
+        html = str(search_bar)
+        self.assertIn('<option value="%s" selected>Editors</option>' % self.editors.pk, html)
+        self.assertIn('<option value="%s">Admins</option>' % self.admins.pk, html)
+
+        # Another request, or another process with the same queryset
+        with self.assertNumQueries(0):
+            self.assertFalse(self.search('/?group=0', Group.objects.order_by('name')).is_valid())
+            self.assertEqual(len(LazyChoices(Group.objects.order_by('name'))), 2)
+
+    def testInvalidation(self):
+        choices = LazyChoices(Group.objects.values_list('name', 'name'))
+        self.assertEqual(list(choices), [('Admins', 'Admins'), ('Editors', 'Editors')])
+        self.assertNotIn('Writers', choices)
+        Group.objects.create(name='Writers')
+        self.assertIn('Writers', choices)
+        self.editors.delete()
+        self.assertEqual(list(choices), [('Admins', 'Admins'), ('Writers', 'Writers')])
+
+    def testCallable(self):
+        search_bar = self.search('/?group=Admins&group=Editors', get_group_choices, lookup='in')
+        self.assertTrue(search_bar.is_valid())
+        self.assertEqual(search_bar.get_lookups(), [('groups__in', ['Admins', 'Editors'])])
+        self.assertIn('<select id="id_group" name="group" multiple>', str(search_bar))
+        self.assertIn('<option value="Admins" selected>ADMINS</option>', str(search_bar))
+
+        # Without a model to watch, they're kept until the timeout
+        choices = LazyChoices(get_group_choices)
+        self.assertIn('Admins', choices)
+        Group.objects.create(name='Writers')
+        self.assertNotIn('Writers', choices)
+        choices.invalidate()
+        self.assertIn('Writers', choices)
+        self.assertIn('Writers', LazyChoices(get_group_choices, model=Group, key_prefix='other'))
+
+    def testCallableKeys(self):
+        # Same name, different choices
+        sources = [lambda: [('s', 'Small')], lambda: [('red', 'Red')]]
+        sizes, colours = [LazyChoices(source) for source in sources]
+        self.assertEqual(list(sizes), [('s', 'Small')])
+        self.assertEqual(list(colours), [('red', 'Red')])
+
+        # An explicit key shares them, across the processes too
+        shared = LazyChoices(sources[0], key='sizes')
+        self.assertEqual(list(shared), [('s', 'Small')])
+        self.assertEqual(list(LazyChoices(lambda: [], key='sizes')), [('s', 'Small')])
+
+    def testOneReceiverPerModel(self):
+        receivers = len(post_save.receivers)
+        for i in range(5):
+            LazyChoices(Group.objects.all())
+            LazyChoices(get_group_choices, model=Group)
+        self.assertLessEqual(len(post_save.receivers), receivers + 1)
+
+    def testOptionsAreRenderedOnce(self):
+        choices = LazyChoices(get_group_choices)
+        options = choices.render_options()
+        self.assertIs(choices.render_options(), options)
+        self.assertEqual(choices.render_options(['Editors']),
+                         '<option value="Admins">ADMINS</option><option value="Editors" selected>EDITORS</option>')
+
+    def testHashedLookup(self):
+        field = compile_form([{'label': 'number', 'choices': [(str(i), i) for i in range(1000)]}]).base_fields['number']
+        with mock.patch('django_searchbar.choices.iter_values', wraps=iter_values) as values:
+            self.assertTrue(field.valid_value('999'))
+            self.assertFalse(field.valid_value('1000'))
+            self.assertTrue(field.valid_value(0))
+        self.assertEqual(values.call_count, 1)
+        self.assertIs(copy.deepcopy(field).choices, field.choices)
+
+    def testFastValidationAndFacets(self):
+        User.objects.create(username='arsham').groups.add(self.admins)
+        search_bar = SearchBar(RequestFactory().get('/'), [{'label': 'group', 'choices': get_group_choices}],
+                               {'group': 'groups__name'}, 'get', fast=True)
+        self.assertTrue(search_bar.is_valid())
+        self.assertEqual(search_bar.count_facets(User.objects.all()), {'group': {'Admins': 1, 'Editors': 0}})
+        self.assertIn('ADMINS (1)', str(search_bar))
+
+
+class FacetsTestCase(TestCase):
+
+    fields = [
+        {'label': 'email', 'lookup': 'icontains'},
+        {
+            'label': 'staff',
+            'choices': (('all', 'All'), ('1', 'Staff'), ('0', 'Not staff')),
+            'ignore_list': ['all'],
+        },
+        {
+            'label': 'active',
+            'choices': (('1', 'Active'), ('0', 'Inactive')),
+        },
+    ]
+    replacements = {'staff': 'is_staff', 'active': 'is_active'}
+
+    def setUp(self):
+        for i in range(10):
+            User.objects.create(username='user%s' % i, email='%s@example.com' % ('even' if i % 2 else 'odd'),
+                                is_staff=i < 3, is_active=i % 3 != 0)
+
+    def search(self, query):
+        search_bar = SearchBar(RequestFactory().get(query), self.fields, replacements=self.replacements)
+        search_bar.is_valid()
+        return search_bar
+
+    def testSingleQuery(self):
+        search_bar = self.search('/')
+        with self.assertNumQueries(1):
+            facets = search_bar.count_facets(User.objects.all())
+        self.assertEqual(facets, {
+            'staff': {'1': 3, '0': 7},
+            'active': {'1': 6, '0': 4},
+        })
+        self.assertIs(search_bar['facets'], facets)
+
+    def testFacetsUseTheOtherFilters(self):
+        search_bar = self.search('/?email=odd&staff=1&active=0')
+        facets = search_bar.count_facets(User.objects.all())
+        # odd: users 0, 2, 4, 6, 8. Staff: 0, 2. Inactive: 0, 6
+        self.assertEqual(facets['staff'], {'1': 1, '0': 1})
+        self.assertEqual(facets['active'], {'1': 1, '0': 1})
+        self.assertEqual(User.objects.filter(search_bar.get_filters()).count(), 1)
+
+    def testCountsAreRendered(self):
+        search_bar = self.search('/?staff=all')
+        self.assertEqual(search_bar['facets'], {})
+        search_bar.count_facets(User.objects.all())
+        output = str(search_bar)
+        self.assertIn('>Staff (3)</option>', output)
+        self.assertIn('>Inactive (4)</option>', output)
+        self.assertIn('>All</option>', output)
+
+    def testMixin(self):
+
+        class FacetsView(UserSearchView):
+            searchbar_fields = self.fields
+            searchbar_replacements = self.replacements
+            searchbar_facets = True
+
+        response = FacetsView.as_view()(RequestFactory().get('/?email=even'))
+        self.assertEqual(len(response.context_data['object_list']), 5)
+        self.assertEqual(response.context_data['search_bar']['facets']['staff'], {'1': 1, '0': 4})
+
+
+user_index = FTS5Backend(User, ['username', 'first_name', 'last_name'], watch=False)
+
+
+class FullTextTestCase(TestCase):
+
+    def setUp(self):
+        user_index.install()
+        user_index.watch()
+        self.arsham = User.objects.create(username='arsham', first_name='Arsham', last_name='Shirvani')
+        self.ivan = User.objects.create(username='ivan', first_name='Ivan', last_name='Genchev')
+
+    def tearDown(self):
+        user_index.unwatch()
+
+    def search(self, query, **kwargs):
+        search_bar = SearchBar(RequestFactory().get(query), ['email', {'label': 'q', 'fulltext': user_index}], **kwargs)
+        search_bar.is_valid()
+        return search_bar
+
+    def results(self, query):
+        return [u.username for u in User.objects.filter(self.search(query).get_filters()).order_by('pk')]
+
+    def testMatch(self):
+        self.assertEqual(self.results('/?q=shirvani'), ['arsham'])
+        self.assertEqual(self.results('/?q=gen'), ['ivan'])
+        self.assertEqual(self.results('/?q=ivan+genchev'), ['ivan'])
+        self.assertEqual(self.results('/?q=ivan+shirvani'), [])
+        self.assertEqual(self.results('/?q=%22+OR+*'), [])
+        self.assertEqual(self.results('/?q=NOT+ivan'), [])
+        self.assertEqual(self.results('/'), ['arsham', 'ivan'])
+
+    def testFilters(self):
+        search_bar = self.search('/?q=ivan&email=ivan@example.com')
+        self.assertIn("'email'", str(search_bar.get_filters()))
+        self.assertIn('pk__in', str(search_bar.get_filters()))
+        self.assertIn("'user__in'", str(self.search('/?q=ivan', replacements={'q': 'user'}).get_filters()))
+
+    def testSignals(self):
+        self.ivan.last_name = 'Ivanov'
+        self.ivan.save()
+        self.assertEqual(self.results('/?q=ivanov'), ['ivan'])
+        self.assertEqual(self.results('/?q=genchev'), [])
+        self.ivan.delete()
+        self.assertEqual(self.results('/?q=ivan'), [])
+
+    def testSync(self):
+        User.objects.filter(pk=self.ivan.pk).update(last_name='Ivanov')
+        User.objects.bulk_create([User(username='john', first_name='John')])
+        User.objects.filter(pk=self.arsham.pk).delete()
+        user_index.sync()
+        self.assertEqual(self.results('/?q=john'), ['john'])
+        self.assertEqual(self.results('/?q=genchev'), [])
+        self.assertEqual(self.results('/?q=ivanov'), ['ivan'])
+        self.assertEqual(self.results('/?q=arsham'), [])
+
+        user_index.sync(rebuild=True)
+        self.assertEqual(self.results('/?q=genchev'), [])
+        self.assertEqual(self.results('/?q=ivanov'), ['ivan'])
+
+        call_command('searchbar_fulltext', stdout=io.StringIO())
+        self.assertEqual(self.results('/?q=ivanov'), ['ivan'])
+
+    def testRanking(self):
+        User.objects.create(username='arsham2', first_name='Arsham', last_name='Arsham')
+        search_bar = self.search('/?q=arsham')
+        results = search_bar.order_by_rank(User.objects.filter(search_bar.get_filters()))
+        self.assertEqual([u.username for u in results], ['arsham2', 'arsham'])
+        self.assertLess(results[0].search_rank, results[1].search_rank)
+
+        groups = Group.objects.filter(user__in=search_bar.order_by_rank(User.objects.all()).values('pk'))
+        self.assertEqual(list(groups), [])
+
+    def testNotInstalled(self):
+        user_index.uninstall()
+        with self.assertWarns(UserWarning):
+            User.objects.create(username='john')
+        self.ivan.delete()
+
+        user_index.install()
+        user_index.sync()
+        self.assertEqual(self.results('/?q=john'), ['john'])
+        self.assertEqual(self.results('/?q=ivan'), [])
+
+    def testSearchesRead(self):
+        state = {'wrote': False}
+        token = routers.request_state.set(state)
+        try:
+            with override_settings(DATABASE_ROUTERS=['django_searchbar.routers.SearchRouter']):
+                search_bar = self.search('/?q=arsham')
+                self.assertEqual(len(search_bar.order_by_rank(User.objects.filter(search_bar.get_filters()))), 1)
+        finally:
+            routers.request_state.reset(token)
+        self.assertFalse(state['wrote'])
+
+    def testRegistry(self):
+        backends = len(registry)
+        receivers = len(post_save.receivers)
+        index = FTS5Backend(User, ['email'])
+        reference = weakref.ref(index)
+        self.assertIn(index, registry)
+        self.assertEqual(len(post_save.receivers), receivers + 1)
+
+        del index
+        gc.collect()
+        self.assertIsNone(reference())
+        self.assertEqual(len(registry), backends)
+        User.objects.create(username='john')
+        self.assertEqual(len(post_save.receivers), receivers)
+
+    def testIntegerKey(self):
+        receivers = len(post_save.receivers)
+        with self.assertRaises(AssertionError):
+            FTS5Backend(Session, ['session_data'])
+        self.assertEqual(len(post_save.receivers), receivers)
+
+
+class TrigramTestCase(TestCase):
+
+    def setUp(self):
+        self.index = TrigramBackend(User, ['username', 'last_name'], watch=False)
+        self.index.watch()
+        self.arsham = User.objects.create(username='arsham', last_name='Shirvani')
+        self.ivan = User.objects.create(username='ivan', last_name='Genchev')
+
+    def tearDown(self):
+        self.index.unwatch()
+
+    def results(self, query, index=None):
+        search_bar = SearchBar(RequestFactory().get(query), [{'label': 'q', 'fulltext': index or self.index}])
+        search_bar.is_valid()
+        return sorted(u.username for u in User.objects.filter(search_bar.get_filters()))
+
+    def testSubstring(self):
+        self.assertEqual(self.results('/?q=HIRV'), ['arsham'])
+        self.assertEqual(self.results('/?q=hev'), ['ivan'])
+        self.assertEqual(self.results('/?q=mshi'), [])
+        self.assertEqual(self.results('/?q=xyz'), [])
+        # Shorter than a trigram
+        self.assertEqual(self.results('/?q=ev'), [])
+
+    def testLimit(self):
+        index = TrigramBackend(User, ['username', 'last_name'], watch=False, limit=1)
+        self.assertEqual(index.search('hirv'), [self.arsham.pk])
+        self.assertEqual(index.search('an'), [])
+        # More matches than the limit are searched by the database, none is left out
+        self.assertEqual(self.results('/?q=VAN', index), ['arsham', 'ivan'])
+        User.objects.create(username='arshia')
+        index.sync()
+        self.assertEqual(self.results('/?q=ars', index), ['arsham', 'arshia'])
+        ranked = index.rank(User.objects.filter(pk__in=index.search('ars')), 'ars')
+        self.assertEqual([user.username for user in ranked], ['arsham', 'arshia'])
+
+    def testNotRegistered(self):
+        self.assertNotIn(self.index, registry)
+        with mock.patch.object(self.index, 'sync') as sync:
+            call_command('searchbar_fulltext', stdout=io.StringIO())
+        sync.assert_not_called()
+
+    def testVersions(self):
+        versions = ModelVersions(key_prefix='searchbar-trigram')
+        index = TrigramBackend(User, ['username', 'last_name'], watch=False, versions=versions)
+        self.assertEqual(self.results('/?q=genchev', index), ['ivan'])
+        # Another process changed the model
+        User.objects.filter(pk=self.ivan.pk).update(last_name='Ivanov')
+        versions.invalidate(User)
+        self.assertEqual(self.results('/?q=genchev', index), [])
+        self.assertEqual(self.results('/?q=ivanov', index), ['ivan'])
+
+    def testForeignKey(self):
+        index = TrigramBackend(Permission, ['codename', 'content_type'])
+        self.addCleanup(index.unwatch)
+        permission = Permission.objects.order_by('pk').first()
+        index.sync()
+        document = index.documents[permission.pk]
+        self.assertIn(str(permission.content_type_id), document)
+        with self.captureOnCommitCallbacks(execute=True):
+            permission.save()
+        self.assertEqual(index.documents[permission.pk], document)
+
+    def testFuzzy(self):
+        index = TrigramBackend(User, ['last_name'], watch=False, fuzzy=True, threshold=0.5)
+        self.assertEqual(self.results('/?q=shirvany', index), ['arsham'])
+        self.assertEqual(self.results('/?q=genshev', index), [])
+        index.threshold = 0.3
+        self.assertEqual(self.results('/?q=genshev', index), ['ivan'])
+
+        User.objects.create(username='arsham2', last_name='Shirvanian')
+        index.sync()
+        search_bar = SearchBar(RequestFactory().get('/?q=shirvani'), [{'label': 'q', 'fulltext': index}])
+        search_bar.is_valid()
+        results = search_bar.order_by_rank(User.objects.filter(search_bar.get_filters()))
+        self.assertEqual([u.username for u in results], ['arsham', 'arsham2'])
+
+    def testSignals(self):
+        self.results('/?q=ars')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ivan.last_name = 'Ivanov'
+            self.ivan.save()
+            User.objects.create(username='john')
+        self.assertEqual(self.results('/?q=ivanov'), ['ivan'])
+        self.assertEqual(self.results('/?q=genchev'), [])
+        self.assertEqual(self.results('/?q=john'), ['john'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ivan.delete()
+        self.assertEqual(self.results('/?q=ivan'), [])
+
+    def testMemoryUsage(self):
+        usage = self.index.memory_usage()
+        self.assertEqual(usage['documents'], 2)
+        self.assertGreater(usage['trigrams'], 10)
+        self.assertGreater(usage['bytes'], 0)
+
+    def testBenchmark(self):
+        from django_searchbar.benchmarks import trigram
+        results = trigram.run(rows=100, number=1, repeat=1)
+        self.assertIn('trigram substring', results)
+        self.assertIsInstance(results['trigram memory (bytes)'], int)
+
+
+class TermsTestCase(TestCase):
+
+    fields = [{'label': 'q', 'type': 'terms', 'max_terms': 3}]
+    replacements = {'q': ['username', '^first_name', 'groups__name']}
+
+    def setUp(self):
+        admins = Group.objects.create(name='Admins')
+        editors = Group.objects.create(name='Editors')
+        self.arsham = User.objects.create(username='arsham', first_name='Arsham', email='arsham@example.com')
+        self.arsham.groups.add(admins, editors)
+        self.ivan = User.objects.create(username='ivan', first_name='Ivan', email='ivan@example.com')
+        self.ivan.groups.add(editors)
+
+    def search(self, query, **kwargs):
+        search_bar = SearchBar(RequestFactory().get(query), kwargs.pop('fields', self.fields),
+                               replacements=kwargs.pop('replacements', self.replacements))
+        search_bar.is_valid()
+        return search_bar
+
+    def results(self, query, **kwargs):
+        return [u.username for u in User.objects.filter(self.search(query, **kwargs).get_filters()).order_by('pk')]
+
+    def testSplitTerms(self):
+        self.assertEqual(split_terms('a b  a "c d" \'e\''), ['a', 'b', 'c d', 'e'][:MAX_TERMS])
+        self.assertEqual(split_terms('a b c d', max_terms=2), ['a', 'b'])
+
+    def testAndAcrossTermsOrAcrossFields(self):
+        self.assertEqual(self.results('/?q=edit'), ['arsham', 'ivan'])
+        self.assertEqual(self.results('/?q=edit+adm'), ['arsham'])
+        self.assertEqual(self.results('/?q=iv+edit'), ['ivan'])
+        self.assertEqual(self.results('/?q=iv+adm'), [])
+        # ^first_name is istartswith
+        self.assertEqual(self.results('/?q=sham'), ['arsham'])
+        self.assertEqual(self.results('/?q=rsh&q2=x', replacements={'q': ['^first_name']}), [])
+        self.assertEqual(self.results('/?q=%22+%22'), ['arsham', 'ivan'])
+
+    def testNoDuplicatesNorJoins(self):
+        search_bar = self.search('/?q=e+d')
+        with CaptureQueriesContext(connection) as queries:
+            results = list(User.objects.filter(search_bar.get_filters()))
+        self.assertEqual(len(results), 2)
+        sql = queries[0]['sql']
+        self.assertEqual(sql.count('EXISTS'), 2)
+        self.assertNotIn('JOIN', sql.split('EXISTS')[0])
+        self.assertNotIn('DISTINCT', sql)
+
+    def testMaxTerms(self):
+        search_bar = self.search('/?q=a+b+c+d+e+f')
+        self.assertEqual(search_bar.get_lookups()[0][1].terms, ['a', 'b', 'c'])
+
+    def testWithOtherFields(self):
+        fields = self.fields + ['email']
+        self.assertEqual(self.results('/?q=edit&email=ivan@example.com', fields=fields), ['ivan'])
+        search_bar = self.search('/?q=edit+adm&email=', fields=fields)
+        self.assertEqual(search_bar.get_search_key(), self.search('/?q=edit+adm').get_search_key())
+
+
+class PermissionSearchView(SearchBarViewMixin, ListView):
+    model = Permission
+    template_name = 'django_searchbar/test.html'
+    searchbar_fields = ['name', 'app']
+    searchbar_replacements = {'app': 'content_type__app_label'}
+    searchbar_columns = ('name', 'app')
+    searchbar_method = 'get'
+
+
+class PlanningTestCase(TestCase):
+
+    def testPlan(self):
+        plan = plan_queryset(User, ['username', '^email', 'groups__name', 'groups__permissions__content_type'])
+        self.assertEqual(plan.select_related, ())
+        self.assertEqual(plan.prefetch_related, ('groups', 'groups__permissions__content_type'))
+        self.assertEqual(plan.only, ('username', 'email'))
+
+        plan = plan_queryset(Permission, ['content_type__app_label', 'content_type', 'content_type__permission__name'])
+        self.assertEqual(plan.select_related, ('content_type',))
+        self.assertEqual(plan.prefetch_related, ('content_type__permission',))
+        self.assertEqual(plan.only, ('content_type__app_label', 'content_type', 'content_type__id'))
+
+    def testUnresolvedColumnsLoadEverything(self):
+        plan = plan_queryset(User, ['username', 'get_full_name'])
+        self.assertEqual(plan.only, ())
+        self.assertEqual(plan.unresolved, ('get_full_name',))
+        self.assertEqual(str(plan), 'unresolved(get_full_name)')
+        self.assertFalse(plan)
+
+    def testQueryCount(self):
+        request = RequestFactory().get('/?app=auth')
+        response = PermissionSearchView.as_view()(request)
+        permissions = response.context_data['object_list']
+        with CaptureQueriesContext(connection) as queries:
+            apps = {permission.content_type.app_label for permission in permissions}
+            self.assertEqual(apps, {'auth'})
+            self.assertTrue(all(permission.name for permission in permissions))
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('codename', queries[0]['sql'].split('FROM')[0])
+        self.assertIn('JOIN', queries[0]['sql'])
+
+        group = Group.objects.create(name='Admins')
+        for index in range(5):
+            User.objects.create(username='user%s' % index).groups.add(group)
+        view = type('GroupsView', (UserSearchView,), {'searchbar_columns': ('username', 'groups__name')})
+        response = view.as_view()(RequestFactory().get('/'))
+        with CaptureQueriesContext(connection) as queries:
+            groups = [[group.name for group in user.groups.all()] for user in response.context_data['object_list']]
+        self.assertEqual(groups, [['Admins']] * 5)
+        self.assertEqual(len(queries), 2)
+
+    def testDebugOutput(self):
+        with self.settings(DEBUG=True), self.assertLogs('django_searchbar', 'DEBUG') as logs:
+            response = PermissionSearchView.as_view()(RequestFactory().get('/'))
+        self.assertEqual(str(response.context_data['searchbar_plan']),
+                         'select_related(content_type) only(name, content_type__app_label)')
+        self.assertIn('PermissionSearchView query plan: select_related(content_type)', logs.output[0])
+
+
+class InstrumentationTestCase(TestCase):
+
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        for name in ('arsham', 'ivan', 'ali'):
+            User.objects.create(username=name, email='%s@example.com' % name)
+        self.sink = MemorySink()
+        self.events = []
+        search_stage.connect(self.on_stage)
+        self.addCleanup(search_stage.disconnect, self.on_stage)
+
+    def on_stage(self, sender, stage, queries, search_key, **kwargs):
+        self.events.append((stage, queries, search_key))
+
+    def testStages(self):
+        view = type('InstrumentedView', (UserSearchView,), {'searchbar_instrumentation': Instrumentation([self.sink])})
+        response = view.as_view()(RequestFactory().get('/?username=a'))
+        response.render()
+
+        key = (('username', "'a'"),)
+        self.assertEqual([stage for stage, queries, search_key in self.events],
+                         ['form', 'is_valid', 'get_filters', 'evaluate', 'render'])
+        self.assertTrue(all(search_key == key for stage, queries, search_key in self.events))
+        self.assertEqual(dict((stage, queries) for stage, queries, search_key in self.events)['evaluate'], 1)
+
+        view.as_view()(RequestFactory().get('/?username=i')).render()
+        view.as_view()(RequestFactory().get('/?username=a')).render()
+        ranking = dict(self.sink.ranking())
+        self.assertEqual(ranking[key]['searches'], 2)
+        self.assertEqual(ranking[key]['queries'], 2)
+        self.assertEqual(set(ranking[key]['stages']), {'form', 'is_valid', 'get_filters', 'evaluate', 'render'})
+        self.assertEqual(len(self.sink.ranking(1)), 1)
+
+    def testNotInstrumented(self):
+        UserSearchView.as_view()(RequestFactory().get('/?username=a')).render()
+        self.assertEqual(self.events, [])
+
+    def testNestedStages(self):
+        search_bar = SearchBar(RequestFactory().get('/?username=arsham'), ['username'], method='get')
+        instrumentation = Instrumentation([self.sink])
+        with instrumentation.stage(search_bar, 'is_valid'):
+            User.objects.count()
+            with instrumentation.stage(search_bar, 'form'):
+                User.objects.count()
+                time.sleep(0.05)
+        stats = self.sink.ranking()[0][1]
+        self.assertEqual(stats['queries'], 2)
+        self.assertEqual([(stage, queries) for stage, queries, search_key in self.events], [('form', 1), ('is_valid', 1)])
+        self.assertGreaterEqual(stats['stages']['form'], 0.05)
+        self.assertLess(stats['stages']['is_valid'], 0.05)
+        self.assertAlmostEqual(stats['duration'], stats['stages']['form'] + stats['stages']['is_valid'])
+
+    def testQueriesOfEveryDatabase(self):
+        search_bar = SearchBar(RequestFactory().get('/?username=arsham'), ['username'], method='get')
+        search_bar.instrumentation = Instrumentation([self.sink])
+        search_bar.evaluate(search_bar.filter(User.objects.using('replica')))
+        self.assertEqual([(stage, queries) for stage, queries, search_key in self.events if stage == 'evaluate'],
+                         [('evaluate', 1)])
+
+        search_bar.instrumentation = Instrumentation([self.sink], using='default')
+        search_bar.evaluate(search_bar.filter(User.objects.using('replica')))
+        self.assertEqual(self.events[-1][:2], ('evaluate', 0))
+
+    def testSearchKeyOnce(self):
+        index = TrigramBackend(User, ['username'], watch=False)
+        search_bar = SearchBar(RequestFactory().get('/?q=ars'), [{'label': 'q', 'fulltext': index}], method='get')
+        search_bar.instrumentation = Instrumentation([self.sink])
+        with mock.patch.object(index, 'search', wraps=index.search) as search:
+            users = search_bar.evaluate(search_bar.filter(User.objects.all()))
+        self.assertEqual([user.username for user in users], ['arsham'])
+        self.assertEqual(search.call_count, 1)
+        self.assertEqual(self.events[-1][2], (('q__match', "'ars'"),))
+
+    def testMemorySinkIsBounded(self):
+        sink = MemorySink(max_size=2)
+        search_bar = SearchBar(RequestFactory().get('/'), ['username'], method='get')
+        sink.record(search_bar, 'evaluate', 0.1, 1, search_key='a', explain='SCAN a')
+        sink.record(search_bar, 'evaluate', 0.1, 1, search_key='b')
+        sink.record(search_bar, 'evaluate', 0.1, 1, search_key='a')
+        sink.record(search_bar, 'evaluate', 0.1, 1, search_key='c', explain='SCAN c')
+        self.assertEqual(sorted(key for key, stats in sink.ranking()), ['a', 'c'])
+        self.assertEqual(sink.explains, {'a': 'SCAN a', 'c': 'SCAN c'})
+        sink.record(search_bar, 'evaluate', 0.1, 1, search_key='b')
+        self.assertEqual(sorted(key for key, stats in sink.ranking()), ['b', 'c'])
+        self.assertEqual(sink.explains, {'c': 'SCAN c'})
+
+    def testRecordingHasNoSideEffects(self):
+        fields = [{'label': 'username', 'lookup': 'icontains'}]
+        search_bar = SearchBar(RequestFactory().get('/?username=a'), fields, method='get')
+        search_bar.budget = SearchBudget(min_term_length=3)
+        search_bar.instrumentation = Instrumentation([self.sink])
+        search_bar.form
+        self.assertEqual(self.events[-1][0], 'form')
+        self.assertEqual(search_bar.errors, [])
+        self.assertFalse(search_bar.over_budget)
+        self.assertFalse(search_bar.is_valid())
+        self.assertEqual(search_bar.errors, ['username needs at least 3 characters'])
+
+    def testExplainSlowSearches(self):
+        explains = []
+        slow_search.connect(lambda sender, explain, **kwargs: explains.append(explain), weak=False, dispatch_uid='test')
+        self.addCleanup(slow_search.disconnect, dispatch_uid='test')
+
+        fields = [{'label': 'username', 'lookup': 'icontains'}]
+        search_bar = SearchBar(RequestFactory().get('/?username=a'), fields, method='get')
+        search_bar.instrumentation = Instrumentation([self.sink], slow_threshold=0, explain_rate=1)
+        users = search_bar.evaluate(search_bar.filter(User.objects.all()))
+        self.assertEqual(len(users), 3)
+        self.assertEqual(len(explains), 1)
+        self.assertIn('SCAN', explains[0])
+        self.assertEqual(self.sink.explains[search_bar.get_search_key()], explains[0])
+
+        explains.clear()
+        search_bar.instrumentation = Instrumentation([self.sink], slow_threshold=0, explain_rate=0)
+        search_bar.evaluate(search_bar.filter(User.objects.all()))
+        self.assertEqual(explains, [])
+
+
+class StaffSearchView(SearchBarViewMixin, ListView):
+    model = User
+    searchbar_fields = [
+        'username',
+        'email',
+        {'label': 'name', 'lookup': 'icontains'},
+        {'label': 'staff', 'choices': (('1', 'Yes'), ('0', 'No')), 'required': True},
+        {'label': 'joined', 'type': 'date', 'lookup': 'range', 'required': True},
+        {'label': 'group', 'lookup': 'in', 'choices': ()},
+        {'label': 'q', 'type': 'terms'},
+        'nickname',
+    ]
+    searchbar_replacements = {
+        'name': 'first_name',
+        'staff': 'is_staff',
+        'joined': 'date_joined',
+        'group': 'groups__name',
+        'q': ['=last_name', 'groups__name'],
+    }
+
+
+urlpatterns = [
+    path('users/', UserSearchView.as_view()),
+    path('staff/', include([path('search/', StaffSearchView.as_view())])),
+    path('other/', lambda request: None),
+]
+
+
+class AdvisorTestCase(TestCase):
+
+    def testAdvise(self):
+        advices, suggestions = advise(StaffSearchView)
+        statuses = [(advice.label, advice.target, advice.lookup, advice.status) for advice in advices]
+        self.assertEqual(statuses, [
+            ('username', 'auth.User.username', '', 'indexed'),
+            ('email', 'auth.User.email', '', 'missing'),
+            ('name', 'auth.User.first_name', 'icontains', 'unindexable'),
+            ('staff', 'auth.User.is_staff', '', 'missing'),
+            ('joined', 'auth.User.date_joined', 'range', 'missing'),
+            ('group', 'auth.Group.name', 'in', 'indexed'),
+            ('q', 'auth.User.last_name', 'iexact', 'unindexable'),
+            ('q', 'auth.Group.name', 'icontains', 'unindexable'),
+            ('nickname', 'nickname', '', 'unresolved'),
+        ])
+        indexes = [(model, index.fields, [str(expression) for expression in index.expressions])
+                   for model, index in suggestions]
+        self.assertEqual(indexes, [
+            (User, ['is_staff', 'date_joined'], []),
+            (User, ['email'], []),
+        ])
+        self.assertTrue(all(len(index.name) <= 30 for model, index in suggestions))
+
+    def testUpperIndex(self):
+        # iexact is UPPER(column) = UPPER(value) on PostgreSQL and Oracle
+        with mock.patch.dict(connection.operators, {'iexact': '= UPPER(%s)'}):
+            advices, suggestions = advise(StaffSearchView)
+        self.assertEqual([advice.status for advice in advices if advice.lookup == 'iexact'], ['missing'])
+        self.assertEqual([str(index.expressions[0]) for model, index in suggestions if index.expressions],
+                         ['Upper(F(last_name))'])
+
+        with mock.patch.object(connection, 'vendor', 'mysql'):
+            advices, suggestions = advise(StaffSearchView)
+        self.assertEqual([advice.status for advice in advices if advice.lookup == 'iexact'], ['missing'])
+        self.assertIn(['last_name'], [index.fields for model, index in suggestions])
+
+    def testCommand(self):
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command('searchbar_indexes', urlconf='django_searchbar.tests', check=True, migrations=True,
+                         dry_run=True, stdout=stdout, stderr=stderr)
+        output = stdout.getvalue()
+        self.assertIn('users/ django_searchbar.tests.UserSearchView', output)
+        self.assertIn('staff/search/ django_searchbar.tests.StaffSearchView', output)
+        self.assertIn('email auth.User.email (exact): missing index', output)
+        self.assertIn('username auth.User.username (exact): indexed by username', output)
+        self.assertEqual(output.count("fields=['email']"), 1)
+        # Django's apps are not written to
+        self.assertNotIn("migrations.AddIndex(", output)
+        self.assertIn('auth is not an app of the project', stderr.getvalue())
+
+    def testMigrationModules(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        os.makedirs(os.path.join(directory, 'searchbar_test_migrations', 'auth'))
+        for package in ('searchbar_test_migrations', os.path.join('searchbar_test_migrations', 'auth')):
+            open(os.path.join(directory, package, '__init__.py'), 'w').close()
+
+        stdout = io.StringIO()
+        with mock.patch('sys.path', [directory] + sys.path), \
+                override_settings(MIGRATION_MODULES={'auth': 'searchbar_test_migrations.auth'}):
+            call_command('searchbar_indexes', urlconf='django_searchbar.tests', migrations=True, stdout=stdout)
+        path = os.path.join(directory, 'searchbar_test_migrations', 'auth', '0001_searchbar_indexes.py')
+        self.assertIn('Wrote %s' % path, stdout.getvalue())
+        with open(path) as f:
+            self.assertIn("models.Index(fields=['email']", f.read())
+
+
+class SingleFlightTestCase(TestCase):
+
+    def run_concurrently(self, single_flight, keys, func):
+        barrier = threading.Barrier(len(keys))
+
+        def call(key):
+            barrier.wait()
+            return single_flight.do(key, lambda: func(key))
+
+        with ThreadPoolExecutor(len(keys)) as executor:
+            return list(executor.map(call, keys))
+
+    def slow(self, key):
+        with self.lock:
+            self.calls.append(key)
+        time.sleep(0.1)
+        return [key]
+
+    def setUp(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def testCoalescing(self):
+        single_flight = SingleFlight()
+        results = self.run_concurrently(single_flight, ['a'] * 8 + ['b'] * 4, self.slow)
+        self.assertEqual(sorted(self.calls), ['a', 'b'])
+        self.assertEqual(results, [['a']] * 8 + [['b']] * 4)
+        self.assertEqual(single_flight.stats(), {'runs': 2, 'shared': 10})
+        self.assertEqual(single_flight.calls, {})
+
+        # Once done, the next call runs again
+        single_flight.do('a', lambda: self.slow('a'))
+        self.assertEqual(len(self.calls), 3)
+
+    def testErrorsAreShared(self):
+        def fail(key):
+            self.slow(key)
+            raise ValueError(key)
+
+        single_flight = SingleFlight()
+        with self.assertRaises(ValueError):
+            self.run_concurrently(single_flight, ['a'] * 4, fail)
+        self.assertEqual(self.calls, ['a'])
+        self.assertEqual(single_flight.calls, {})
+
+    def testAcrossProcesses(self):
+        # Each instance stands for a process, sharing the cache
+        cache.clear()
+        flights = [CacheSingleFlight(poll_interval=0.005) for i in range(6)]
+        barrier = threading.Barrier(len(flights))
+
+        def call(single_flight):
+            barrier.wait()
+            return single_flight.do('key', lambda: self.slow('key'))
+
+        with ThreadPoolExecutor(len(flights)) as executor:
+            results = list(executor.map(call, flights))
+        self.assertEqual(self.calls, ['key'])
+        self.assertEqual(results, [['key']] * 6)
+        self.assertEqual(sum(single_flight.stats()['shared'] for single_flight in flights), 5)
+
+    def testStaleLock(self):
+        cache.clear()
+        single_flight = CacheSingleFlight(lock_timeout=0.05, poll_interval=0.01)
+        cache.add('searchbar:flight:lock:key', 1)
+        self.assertEqual(single_flight.do('key', lambda: 'result'), 'result')
+
+    def testWaitTimeout(self):
+        single_flight = SingleFlight(timeout=0.05)
+        # A caller that never finishes
+        single_flight.calls['key'] = Call()
+        self.assertEqual(single_flight.do('key', lambda: 'result'), 'result')
+        self.assertEqual(single_flight.stats(), {'runs': 1, 'shared': 0})
+
+    def testFilter(self):
+        arsham = User.objects.create(username='arsham')
+        User.objects.create(username='ivan')
+        single_flight = SingleFlight()
+        search_bar = SearchBar(RequestFactory().get('/?username=arsham'), ['username'], method='get')
+        search_bar.is_valid()
+        users = search_bar.filter(User.objects.order_by('pk'), single_flight=single_flight)
+        # Without concurrency, the query is the one without the single flight
+        with self.assertNumQueries(1):
+            self.assertEqual([user.username for user in users], ['arsham'])
+        self.assertNotIn('IN', str(users.query))
+        with self.assertNumQueries(1):
+            self.assertEqual([user.username for user in users.all()[:1]], ['arsham'])
+        self.assertEqual(single_flight.stats()['runs'], 2)
+
+        # The callers of the same query get copies of the rows of the one running it
+        users = search_bar.filter(User.objects.order_by('pk'), single_flight=single_flight)
+        running = threading.Event()
+
+        def run():
+            running.set()
+            time.sleep(0.1)
+            return [arsham]
+
+        with ThreadPoolExecutor(1) as executor:
+            leader = executor.submit(single_flight.do, single_flight.get_key(users), run)
+            running.wait()
+            with self.assertNumQueries(0):
+                shared = list(users)
+        self.assertEqual(leader.result(), [arsham])
+        self.assertEqual(shared, [arsham])
+        self.assertIsNot(shared[0], arsham)
+
+        results_cache = SearchResultCache(single_flight=single_flight)
+        search_bar.filter(User.objects.all(), cache=results_cache)
+        self.assertEqual(single_flight.stats()['runs'], 4)
+
+        view = type('CoalescedView', (UserSearchView,), {'searchbar_single_flight': single_flight})
+        response = view.as_view()(RequestFactory().get('/?username=ivan'))
+        self.assertEqual([user.username for user in response.context_data['object_list']], ['ivan'])
+        self.assertEqual(single_flight.stats()['runs'], 5)
+
+    def testVersions(self):
+        single_flight = CacheSingleFlight(key_prefix='searchbar-flight')
+        key = single_flight.get_key(User.objects.all())
+        self.assertEqual(single_flight.get_key(User.objects.all()), key)
+        User.objects.create(username='arsham')
+        self.assertNotEqual(single_flight.get_key(User.objects.all()), key)
+
+
+class AutocompleteTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        for username, first_name in [('arsham', 'Arsham'), ('Arshia', 'arshia'), ('ivan', 'Ivan'), ('arman', 'Arsham')]:
+            User.objects.create(username=username, first_name=first_name)
+
+    def testSuggest(self):
+        autocomplete = Autocomplete.from_view(UserSearchView, label='username', limit=2)
+        self.assertEqual(autocomplete.get_targets(), ['username'])
+        self.assertEqual(autocomplete.suggest(User.objects.all(), 'ARS'), ['Arshia', 'arsham'])
+        self.assertEqual(autocomplete.suggest(User.objects.all(), 'ar'), ['Arshia', 'arman'])
+        self.assertEqual(autocomplete.suggest(User.objects.all(), ''), [])
+
+        # Through the replacements, with the distinct values of all the targets
+        autocomplete = Autocomplete(['name'], {'name': ['first_name', '^username']})
+        self.assertEqual(autocomplete.get_targets(), ['first_name', 'username'])
+        self.assertEqual(autocomplete.suggest(User.objects.all(), 'arsh'), ['Arsham', 'arshia', 'Arshia', 'arsham'])
+
+    def testCache(self):
+        autocomplete = Autocomplete(['username'], cache_length=2)
+        queryset = User.objects.all()
+        self.assertEqual(autocomplete.get_content(queryset, 'ar'), b'["Arshia","arman","arsham"]')
+        with self.assertNumQueries(0):
+            self.assertEqual(autocomplete.get_content(queryset, 'AR'), b'["Arshia","arman","arsham"]')
+        # Longer prefixes are not cached
+        with self.assertNumQueries(1):
+            autocomplete.get_content(queryset, 'ars')
+
+        User.objects.create(username='arya')
+        self.assertEqual(autocomplete.get_content(queryset, 'ar'), b'["Arshia","arman","arsham","arya"]')
+        self.assertEqual(autocomplete.get_content(queryset.filter(is_staff=True), 'ar'), b'[]')
+
+    def testPrefixIndex(self):
+        index = PrefixIndex()
+        autocomplete = Autocomplete(['first_name'], index=index)
+        queryset = User.objects.all()
+        self.assertEqual(autocomplete.suggest(queryset, 'ars'), ['Arsham', 'arshia'])
+        with self.assertNumQueries(0):
+            self.assertEqual(autocomplete.suggest(queryset, 'i'), ['Ivan'])
+            self.assertEqual(autocomplete.suggest(queryset, 'z'), [])
+
+        User.objects.create(username='zed', first_name='Zed')
+        self.assertEqual(autocomplete.suggest(queryset, 'z'), ['Zed'])
+
+        # Too many values, the database is queried
+        autocomplete.index = PrefixIndex(max_size=2)
+        with self.assertNumQueries(2):
+            self.assertEqual(autocomplete.suggest(queryset, 'ars'), ['Arsham', 'arshia'])
+
+    def testPrefixIndexEntries(self):
+        index = PrefixIndex(max_entries=2)
+        for username in ('arsham', 'ivan', 'zed'):
+            index.search(User.objects.exclude(username=username), 'first_name', 'a', 10)
+        self.assertEqual(len(index.entries), 2)
+        # The one searched last is kept
+        index.search(User.objects.exclude(username='ivan'), 'first_name', 'a', 10)
+        index.search(User.objects.all(), 'first_name', 'a', 10)
+        with self.assertNumQueries(0):
+            index.search(User.objects.exclude(username='ivan'), 'first_name', 'a', 10)
+
+        # The concurrent misses of a column load it once
+        index = PrefixIndex()
+        loads = []
+
+        def load(queryset, target):
+            loads.append(target)
+            time.sleep(0.05)
+            return ['ivan'], ['Ivan']
+
+        index.load = load
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(lambda i: index.search(User.objects.all(), 'first_name', 'i', 10), range(4)))
+        self.assertEqual(results, [['Ivan']] * 4)
+        self.assertEqual(loads, ['first_name'])
+
+        # The other columns don't wait for it, both loads run at once
+        index = PrefixIndex()
+        barrier = threading.Barrier(2, timeout=5)
+
+        def load(queryset, target):
+            barrier.wait()
+            return ['ivan'], ['Ivan']
+
+        index.load = load
+        with ThreadPoolExecutor(2) as executor:
+            results = list(executor.map(lambda target: index.search(User.objects.all(), target, 'i', 10),
+                                        ['first_name', 'last_name']))
+        self.assertEqual(results, [['Ivan']] * 2)
+
+    def testView(self):
+        view = AutocompleteView.as_view(model=User, autocomplete=Autocomplete.from_view(UserSearchView))
+        response = view(RequestFactory().get('/?q=iv'))
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(response.content), ['ivan'])
+        self.assertEqual(view(RequestFactory().get('/?q=' + 'a' * 101)).status_code, 400)
+
+    def testBenchmark(self):
+        from django_searchbar.benchmarks import autocomplete
+        results = autocomplete.run(rows=50, number=2, repeat=1)
+        self.assertIn('prefix index', results)
+        self.assertTrue(all(value > 0 for value in results.values()))
+
+
+# Counts to a hundred million, long enough to be interrupted
+SLOW_CONDITION = '(WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c LIMIT 100000000) SELECT count(*) FROM c) > 0'
+
+
+class SearchBudgetTestCase(TestCase):
+
+    fields = [{'label': 'username', 'lookup': 'icontains'}, 'email', {'label': 'q', 'type': 'terms'}]
+
+    def get_search_bar(self, query, budget):
+        search_bar = SearchBar(RequestFactory().get('/' + query), self.fields, {'q': ['username', 'email']}, method='get')
+        search_bar.budget = budget
+        return search_bar
+
+    def testChecks(self):
+        budget = SearchBudget(min_term_length=3, max_fields=2)
+        search_bar = self.get_search_bar('?username=ab', budget)
+        self.assertFalse(search_bar.is_valid())
+        self.assertEqual(search_bar.errors, ['username needs at least 3 characters'])
+
+        search_bar = self.get_search_bar('?q=a bob "x"', budget)
+        self.assertTrue(search_bar.is_valid())
+        self.assertEqual(search_bar.get_active_fields(), [('q', 'terms', ['bob'])])
+        # Only short terms is no search at all
+        self.assertEqual(self.get_search_bar('?q=a b', budget).get_active_fields(), [])
+
+        search_bar = self.get_search_bar('?username=abc&email=a@example.com&q=bob', budget)
+        self.assertFalse(search_bar.is_valid())
+        self.assertEqual(search_bar.errors, ['Search at most 2 fields at once'])
+
+        # The exact lookups use the indexes, short values are fine
+        self.assertTrue(self.get_search_bar('?email=a', budget).is_valid())
+
+    def testLookupString(self):
+        User.objects.create(username='arsham', email='a@example.com')
+        budget = SearchBudget(min_term_length=3)
+        search_bar = self.get_search_bar('?email=a', budget)
+        self.assertTrue(search_bar.is_valid())
+        self.assertEqual(list(User.objects.filter(search_bar.get_filters(lookup_string='icontains'))), [])
+        self.assertEqual(search_bar.errors, ['email needs at least 3 characters'])
+
+        search_bar = self.get_search_bar('?email=a', budget)
+        self.assertTrue(search_bar.is_valid())
+        self.assertEqual(search_bar.get_lookups(lookup_string='startswith'), [('email__startswith', 'a')])
+        self.assertEqual(search_bar.errors, [])
+
+    def testTimeout(self):
+        User.objects.create(username='arsham')
+        budget = SearchBudget(timeout=0.05)
+        search_bar = self.get_search_bar('?username=ars', budget)
+        self.assertTrue(search_bar.is_valid())
+        self.assertEqual(len(search_bar.evaluate(search_bar.filter(User.objects.all()))), 1)
+
+        started = time.monotonic()
+        with self.assertRaises(SearchTimeout):
+            search_bar.evaluate(search_bar.filter(User.objects.extra(where=[SLOW_CONDITION])))
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(search_bar.errors, [TIMEOUT_ERROR])
+        # The connection is usable, without the handler
+        self.assertEqual(User.objects.count(), 1)
+
+    def testViewTimeout(self):
+        User.objects.create(username='arsham')
+        view = type('SlowView', (UserSearchView,), {
+            'searchbar_budget': SearchBudget(timeout=0.05),
+            'paginate_by': 10,
+            'get_queryset': lambda self: User.objects.extra(where=[SLOW_CONDITION]).order_by('pk'),
+        })
+        response = view.as_view()(RequestFactory().get('/?username=arsham'))
+        response.render()
+        self.assertEqual(list(response.context_data['object_list']), [])
+        self.assertEqual(response.context_data['search_bar'].errors, [TIMEOUT_ERROR])
+        self.assertFalse(response.context_data['search_bar'].is_valid())
+
+        # A later page of no results is the first one
+        response = view.as_view()(RequestFactory().get('/?username=arsham&page=3'))
+        self.assertEqual(response.context_data['page_obj'].number, 1)
+        self.assertEqual(response.context_data['search_bar'].errors, [TIMEOUT_ERROR])
+
+        view.searchbar_budget = SearchBudget(timeout=5)
+        view.get_queryset = lambda self: User.objects.order_by('pk')
+        response = view.as_view()(RequestFactory().get('/?username=arsham'))
+        self.assertEqual([user.username for user in response.context_data['object_list']], ['arsham'])
+
+    def testViewOverBudget(self):
+        User.objects.create(username='arsham')
+        view = UserSearchView.as_view(searchbar_fields=[{'label': 'username', 'lookup': 'icontains'}],
+                                      searchbar_budget=SearchBudget(min_term_length=3),
+                                      searchbar_export_columns=('username',))
+        response = view(RequestFactory().get('/?username=a'))
+        self.assertEqual(list(response.context_data['object_list']), [])
+        self.assertEqual(response.context_data['search_bar'].errors, ['username needs at least 3 characters'])
+
+        response = view(RequestFactory().get('/?username=a&export=csv'))
+        self.assertEqual(b''.join(response.streaming_content).decode(), 'username\r\n')
+
+        response = view(RequestFactory().get('/?username=ars'))
+        self.assertEqual([user.username for user in response.context_data['object_list']], ['arsham'])
+
+    def testLimitedQueries(self):
+        User.objects.create(username='arsham')
+        view = type('SlowView', (UserSearchView,), {
+            'searchbar_budget': SearchBudget(timeout=0.05),
+            'searchbar_export_columns': ('username',),
+            'get_queryset': lambda self: User.objects.extra(where=[SLOW_CONDITION]),
+        })
+        response = view.as_view()(RequestFactory().get('/?username=arsham&export=csv'))
+        with self.assertRaises(SearchTimeout):
+            b''.join(response.streaming_content)
+        self.assertEqual(User.objects.count(), 1)
+
+        # The query of the cached primary keys
+        response = view.as_view(searchbar_cache=SearchResultCache(key_prefix='searchbar-budget'))(
+            RequestFactory().get('/?username=arsham'))
+        self.assertEqual(list(response.context_data['object_list']), [])
+        self.assertEqual(response.context_data['search_bar'].errors, [TIMEOUT_ERROR])
+
+    def run_postgresql(self, cause=None):
+        """
+        Runs a query within a budget on a fake PostgreSQL connection, the query is canceled with ``cause``
+        """
+        def execute(sql, params=None):
+            if sql == 'SELECT 1' and cause is not None:
+                error = OperationalError('canceled')
+                error.__cause__ = cause
+                raise error
+
+        cursor = mock.MagicMock()
+        cursor.fetchone.return_value = ('0',)
+        cursor.execute.side_effect = execute
+        postgresql = mock.MagicMock(alias='default', vendor='postgresql', searchbar_limited=False)
+        postgresql.cursor.return_value.__enter__.return_value = cursor
+        with mock.patch('django_searchbar.budget.connections', {'default': postgresql}), \
+                mock.patch('django_searchbar.budget.transaction.atomic'):
+            try:
+                with SearchBudget(timeout=1.5).limit('default'):
+                    with postgresql.cursor() as query_cursor:
+                        query_cursor.execute('SELECT 1')
+            finally:
+                self.assertFalse(postgresql.searchbar_limited)
+        return cursor
+
+    def testPostgresqlTimeout(self):
+        cursor = self.run_postgresql()
+        self.assertEqual(cursor.execute.call_args_list, [
+            mock.call('SHOW statement_timeout'),
+            mock.call("SELECT set_config('statement_timeout', %s, true)", ['1500']),
+            mock.call('SELECT 1'),
+            mock.call("SELECT set_config('statement_timeout', %s, true)", ['0']),
+        ])
+
+        # query_canceled, as psycopg2 and psycopg report it
+        for attribute in ('pgcode', 'sqlstate'):
+            cause = Exception()
+            setattr(cause, attribute, '57014')
+            with self.assertRaises(SearchTimeout):
+                self.run_postgresql(cause)
+        cause = Exception()
+        cause.pgcode = '42P01'
+        with self.assertRaises(OperationalError):
+            self.run_postgresql(cause)
+
+
+@override_settings(SEARCHBAR_REPLICA='replica', DATABASE_ROUTERS=['django_searchbar.routers.SearchRouter'])
+class ReplicaRoutingTestCase(TestCase):
+
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        routers._down_until.clear()
+        User.objects.create(username='primary')
+        User.objects.using('replica').create(username='replica')
+        self.session = SessionStore()
+        self.session.create()
+
+    def tearDown(self):
+        routers._down_until.clear()
+
+    def search(self, write=False):
+        def view(request):
+            if write:
+                Group.objects.create(name='writers')
+            return UserSearchView.as_view()(request)
+
+        request = RequestFactory().get('/')
+        request.session = self.session
+        response = routers.SearchRouterMiddleware(view)(request)
+        return [user.username for user in response.context_data['object_list']]
+
+    def testReadsFromReplica(self):
+        self.assertEqual(self.search(), ['replica'])
+        with override_settings(SEARCHBAR_REPLICA=None):
+            self.assertEqual(self.search(), ['primary'])
+        view = type('PrimaryView', (UserSearchView,), {'searchbar_routing': False})
+        response = view.as_view()(RequestFactory().get('/'))
+        self.assertEqual([user.username for user in response.context_data['object_list']], ['primary'])
+
+    def testStickyAfterWrite(self):
+        self.assertEqual(self.search(write=True), ['primary'])
+        self.assertEqual(self.search(), ['primary'])
+
+        self.session[routers.STICKY_SESSION_KEY] = time.time() - 1
+        self.assertEqual(self.search(), ['replica'])
+
+    def testReplicaUnavailable(self):
+        with mock.patch.object(connections['replica'], 'ensure_connection', side_effect=OperationalError) as ensure:
+            self.assertEqual(self.search(), ['primary'])
+            self.assertEqual(self.search(), ['primary'])
+        # Not tried again until SEARCHBAR_REPLICA_RETRY has passed
+        self.assertEqual(ensure.call_count, 1)
+        self.assertEqual(self.search(), ['primary'])
+
+        routers._down_until.clear()
+        self.assertEqual(self.search(), ['replica'])
+
+    def testCachedResults(self):
+        results_cache = SearchResultCache(key_prefix='searchbar-replica')
+        results_cache.cache.clear()
+        view = type('CachedView', (UserSearchView,), {'searchbar_cache': results_cache})
+        request = RequestFactory().get('/?username=replica')
+        response = view.as_view()(request)
+        self.assertEqual([user.username for user in response.context_data['object_list']], ['replica'])
+
+
+class SearchResultCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.results_cache = SearchResultCache(timeout=60)
+        self.results_cache.cache.clear()
+        self.arsham = User.objects.create(username='arsham', email='arsham@example.com')
+        User.objects.create(username='ivan', email='ivan@example.com')
+
+    def search(self, query, **kwargs):
+        search_bar = SearchBar(RequestFactory().get(query), ['username', 'email'], **kwargs)
+        search_bar.is_valid()
+        return search_bar
+
+    def testSearchKeyIsNormalized(self):
+        self.assertEqual(self.search('/?username=arsham&email=').get_search_key(),
+                         self.search('/?email=&username=arsham&other=1').get_search_key())
+        self.assertNotEqual(self.search('/?username=arsham').get_search_key(),
+                            self.search('/?username=arsham').get_search_key(lookup_string='icontains'))
+        self.assertNotEqual(self.search('/?username=arsham').get_search_key(),
+                            self.search('/?username=arsham', replacements={'username': 'email'}).get_search_key())
+
+    def testHitsAndMisses(self):
+        with self.assertNumQueries(2):
+            users = list(self.search('/?username=arsham').filter(User.objects.all(), cache=self.results_cache))
+        self.assertEqual(users, [self.arsham])
+
+        with self.assertNumQueries(1):
+            users = list(self.search('/?username=arsham').filter(User.objects.all(), cache=self.results_cache))
+        self.assertEqual(users, [self.arsham])
+
+        self.search('/?username=ivan').filter(User.objects.all(), cache=self.results_cache)
+        self.assertEqual(self.results_cache.stats(), {'hits': 1, 'misses': 2, 'ratio': 1 / 3})
+
+    def testKeepsTheBaseQueryset(self):
+        search_bar = self.search('/?username=arsham')
+        search_bar.filter(User.objects.all(), cache=self.results_cache)
+        self.assertFalse(search_bar.filter(User.objects.filter(is_staff=True), cache=self.results_cache).exists())
+
+    def testInvalidatedBySignals(self):
+        search_bar = self.search('/?email=new@example.com')
+        self.assertFalse(search_bar.filter(User.objects.all(), cache=self.results_cache).exists())
+
+        user = User.objects.create(username='new', email='new@example.com')
+        self.assertTrue(search_bar.filter(User.objects.all(), cache=self.results_cache).exists())
+
+        user.delete()
+        self.assertFalse(search_bar.filter(User.objects.all(), cache=self.results_cache).exists())
+        self.assertEqual(self.results_cache.hits, 0)
+
+    def testTooManyResultsAreNotCached(self):
+        self.results_cache.max_results = 1
+        search_bar = self.search('/?username=arsham')
+        self.assertEqual(search_bar.filter(User.objects.all(), lookup_string='icontains', cache=self.results_cache).count(), 1)
+        search_bar = self.search('/?email=example')
+        self.assertEqual(search_bar.filter(User.objects.all(), lookup_string='icontains', cache=self.results_cache).count(), 2)
+
+    def testMixin(self):
+        view = UserSearchView.as_view(searchbar_cache=self.results_cache)
+        for i in range(2):
+            response = view(RequestFactory().get('/?username=ivan'))
+            self.assertEqual([u.username for u in response.context_data['object_list']], ['ivan'])
+        self.assertEqual(self.results_cache.hits, 1)
+
+
+class FragmentCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.fragment_cache = FragmentCache()
+        self.fragment_cache.cache.clear()
+
+    def search(self, request, fields=('name', 'age')):
+        search_bar = SearchBar(request, list(fields))
+        search_bar.fragment_cache = self.fragment_cache
+        return search_bar
+
+    def testCachedMarkupIsTheSame(self):
+        request = RequestFactory().get('/?name=arsham')
+        uncached = SearchBar(request, ['name', 'age'])
+        self.assertEqual(str(self.search(request)), str(uncached))
+        self.assertEqual(str(self.search(request)), str(uncached))
+        self.assertEqual(self.fragment_cache.hits, 1)
+
+        request = RequestFactory().get('/?name=ivan')
+        self.assertIn('value="ivan"', str(self.search(request)))
+        self.assertEqual(self.fragment_cache.misses, 2)
+        self.assertEqual(self.fragment_cache.stats(), {'hits': 1, 'misses': 2, 'ratio': 1 / 3})
+
+    def testConcurrentCounts(self):
+        request = RequestFactory().get('/?name=arsham')
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda i: str(self.search(request)), range(200)))
+        stats = self.fragment_cache.stats()
+        self.assertEqual(stats['hits'] + stats['misses'], 200)
+
+    def testCsrfTokenIsNotCached(self):
+        first = RequestFactory().post('/', {'name': 'arsham'})
+        second = RequestFactory().post('/', {'name': 'arsham'})
+        first_form = str(self.search(first).as_form())
+        second_form = str(self.search(second).as_form())
+        self.assertEqual(self.fragment_cache.hits, 1)
+        self.assertIn('csrfmiddlewaretoken', first_form)
+        self.assertNotEqual(first_form, second_form)
+
+        search_bar = self.search(RequestFactory().get('/'))
+        search_bar.method = 'get'
+        self.assertNotIn('csrfmiddlewaretoken', str(search_bar.as_form()))
+        self.assertNotIn('searchbar-csrf', str(search_bar.as_form()))
+
+    def testChangedFieldsAreNotCached(self):
+        search_bar = self.search(RequestFactory().get('/'))
+        str(search_bar)
+        search_bar['email'] = 'Email'
+        self.assertIn('name="email"', str(search_bar))
+        self.assertEqual(self.fragment_cache.hits, 0)
+
+    def testTemplateTag(self):
+        request = RequestFactory().post('/', {'name': 'arsham'})
+        template = Template('{% load searchbar %}{% searchbar search_bar %}|{% searchbar search_bar form_tag=False %}')
+        output = template.render(Context({'search_bar': SearchBar(request, ['name'])}))
+        form, fields = output.split('|')
+        self.assertIn('<form', form)
+        self.assertIn('csrfmiddlewaretoken', form)
+        self.assertIn('value="arsham"', fields)
+        self.assertNotIn('<form', fields)
+
+    def testBenchmark(self):
+        from django_searchbar.benchmarks import rendering
+        results = rendering.run(number=5, repeat=1)
+        self.assertEqual(set(results), {'as_form uncached', 'as_form cached'})
+
+
+class BenchmarkTestCase(TestCase):
+
+    def testHotPaths(self):
+        from django_searchbar.benchmarks import hotpaths
+        results = hotpaths.run(rows=50, number=2, repeat=1)
+        self.assertIn('view request', results)
+        self.assertTrue(all(value > 0 for value in results.values()))
+
+    def testCommand(self):
+        from django_searchbar.benchmarks import to_json, get_metadata
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        before, after = os.path.join(directory, 'before.json'), os.path.join(directory, 'after.json')
+        with open(before, 'w') as f:
+            f.write(to_json({'rendering': {'as_form cached': 1000.0, 'as_form uncached': 1000.0}}, get_metadata()))
+
+        stdout = io.StringIO()
+        with mock.patch('django_searchbar.benchmarks.create_database'), \
+                mock.patch.object(connection.creation, 'destroy_test_db'):
+            call_command('searchbar_benchmark', 'rendering', number=2, repeat=1, output=after, compare=before,
+                         stdout=stdout)
+
+        with open(after) as f:
+            written = json.load(f)
+        self.assertEqual(set(written['results']['rendering']), {'as_form cached', 'as_form uncached'})
+        self.assertEqual(written['metadata']['number'], 2)
+        self.assertIn('rendering  as_form cached', stdout.getvalue())
+        self.assertIn('-100.0%', stdout.getvalue())
+
+    def testUnknownBenchmark(self):
+        with self.assertRaises(CommandError):
+            call_command('searchbar_benchmark', 'nothing')
+
+    def testFormatResults(self):
+        from django_searchbar.benchmarks import format_results
+        self.assertEqual(format_results({'search': 0.0000125, 'memory (bytes)': 2048}), [
+            'search                              12.50 us',
+            'memory (bytes)                       2048',
+        ])
+
+
+class KeysetPaginationTestCase(TestCase):
+
+    def setUp(self):
+        for i in range(25):
+            User.objects.create(username='user%02d' % i, email='%s@example.com' % ('even' if i % 2 else 'odd'),
+                                is_staff=i % 3 == 0)
+
+    def get(self, query, **kwargs):
+        view = UserSearchView.as_view(paginate_by=5, searchbar_keyset_ordering=('-is_staff', 'username'), **kwargs)
+        return view(RequestFactory().get(query))
+
+    def usernames(self, response):
+        return [u.username for u in response.context_data['object_list']]
+
+    def testWalkingForwardAndBack(self):
+        expected = list(User.objects.filter(email='odd@example.com').order_by('-is_staff', 'username')
+                        .values_list('username', flat=True))
+
+        response = self.get('/?email=odd@example.com')
+        self.assertIsNone(response.context_data['previous_cursor'])
+        self.assertTrue(response.context_data['is_paginated'])
+        pages = [self.usernames(response)]
+        while response.context_data['next_cursor']:
+            response = self.get('/?email=odd@example.com&cursor=%s' % response.context_data['next_cursor'])
+            pages.append(self.usernames(response))
+        self.assertEqual(sum(pages, []), expected)
+        self.assertEqual([len(page) for page in pages], [5, 5, 3])
+
+        while response.context_data['previous_cursor']:
+            response = self.get('/?email=odd@example.com&cursor=%s' % response.context_data['previous_cursor'])
+            self.assertEqual(self.usernames(response), pages.pop(-2))
+        self.assertEqual(len(pages), 1)
+
+    def testCursorQueriesDontUseOffset(self):
+        response = self.get('/')
+        cursor = response.context_data['next_cursor']
+        with CaptureQueriesContext(connection) as queries:
+            self.get('/?cursor=%s' % cursor)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('OFFSET', queries[0]['sql'])
+
+    def testInvalidCursor(self):
+        self.assertRaises(Http404, self.get, '/?cursor=nonsense')
+        self.assertRaises(Http404, self.get, '/?cursor=%s' % encode_cursor('next', [1]))
+
+    def testPageNumbersStillWork(self):
+        response = UserSearchView.as_view(paginate_by=10)(RequestFactory().get('/?page=3'))
+        self.assertEqual(len(response.context_data['object_list']), 5)
+        self.assertNotIn('next_cursor', response.context_data)
+
+    def testPaginatorOnItsOwn(self):
+        paginator = KeysetPaginator(User.objects.filter(is_staff=True), 4, ['-date_joined'])
+        page = paginator.page()
+        self.assertEqual(len(page), 4)
+        self.assertFalse(page.has_previous())
+        page = paginator.page(paginator.page(page.next_cursor).next_cursor)
+        self.assertEqual(len(page), 1)
+        self.assertFalse(page.has_next())
+        self.assertTrue(page.has_previous())
+
+
+class CountStrategyTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        for i in range(12):
+            User.objects.create(username='user%02d' % i, email='user%02d@example.com' % i)
+
+    def get(self, query, strategy):
+        view = UserSearchView.as_view(paginate_by=5, searchbar_count_strategy=strategy)
+        with CaptureQueriesContext(connection) as queries:
+            response = view(RequestFactory().get(query))
+        return response, [query['sql'] for query in queries]
+
+    def testExact(self):
+        response, queries = self.get('/?page=3', 'exact')
+        self.assertEqual(response.context_data['paginator'].count, 12)
+        self.assertEqual(len(response.context_data['object_list']), 2)
+        self.assertNotIn('count_strategy', response.context_data)
+        self.assertTrue(any('COUNT(' in sql for sql in queries))
+
+    def testCached(self):
+        response, queries = self.get('/?email=user01@example.com', 'cached')
+        self.assertEqual(response.context_data['count_strategy'], 'exact')
+        self.assertEqual(response.context_data['paginator'].count, 1)
+
+        response, queries = self.get('/?email=user01@example.com&page=1', 'cached')
+        self.assertEqual(response.context_data['count_strategy'], 'cached')
+        self.assertEqual(response.context_data['paginator'].count, 1)
+        self.assertFalse(any('COUNT(' in sql for sql in queries))
+
+        response, queries = self.get('/?page=2', 'cached')
+        self.assertEqual(response.context_data['count_strategy'], 'exact')
+        self.assertEqual(response.context_data['paginator'].count, 12)
+
+    def testHasMore(self):
+        response, queries = self.get('/?page=2', 'has_more')
+        page = response.context_data['page_obj']
+        self.assertEqual(response.context_data['count_strategy'], 'has_more')
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('COUNT(', queries[0])
+        self.assertTrue(page.has_next())
+        self.assertTrue(page.has_previous())
+        self.assertEqual((page.start_index(), page.end_index()), (6, 10))
+        self.assertIsNone(response.context_data['paginator'].count)
+
+        response, queries = self.get('/?page=3', 'has_more')
+        page = response.context_data['page_obj']
+        self.assertFalse(page.has_next())
+        self.assertEqual((page.start_index(), page.end_index()), (11, 12))
+
+        self.assertRaises(Http404, self.get, '/?page=4', 'has_more')
+        self.assertRaises(Http404, self.get, '/?page=last', 'has_more')
+
+    def testPaginatorInListView(self):
+
+        class PaginatedView(UserSearchView):
+            paginate_by = 5
+            paginator_class = SearchPaginator
+
+        response = PaginatedView.as_view()(RequestFactory().get('/?page=2'))
+        self.assertEqual(response.context_data['count_strategy'], 'exact')
+        self.assertEqual(len(response.context_data['object_list']), 5)
+
+
+class FieldTableTestCase(TestCase):
+
+    def testSharedAndResolvedOnce(self):
+        calls = []
+
+        def replacement(field):
+            calls.append(field)
+            return 'username'
+
+        fields = ['name', {'label': 'email', 'lookup': 'ICONTAINS '}, {'label': 'q', 'type': 'terms', 'max_terms': 2}]
+        replacements = {'name': replacement}
+        for username in ['arsham', 'ivan']:
+            search_bar = SearchBar(RequestFactory().get('/?name=%s&email=example' % username), fields, replacements, 'get')
+            self.assertTrue(search_bar.is_valid())
+            self.assertEqual(search_bar.get_lookups(), [('username', username), ('email__icontains', 'example')])
+        self.assertEqual(calls, ['name'])
+
+        table = get_field_table(fields, replacements)
+        self.assertIs(search_bar.table, table)
+        self.assertEqual([(spec.label, spec.lookup, spec.max_terms) for spec in table.fields],
+                         [('name', None, 5), ('email', 'icontains', 5), ('q', 'terms', 2)])
+        self.assertIs(table.form_class, compile_form(fields))
+        with self.assertRaises(AttributeError):
+            table.fields[0].extra = True
+        with self.assertRaises(TypeError):
+            table.labels['extra'] = table.fields[0]
+
+        # Changed in place, the spec gets a new table
+        fields[1]['lookup'] = 'iexact'
+        self.assertEqual(get_field_table(fields, replacements).labels['email'].lookup, 'iexact')
+        replacements['email'] = 'username'
+        self.assertEqual(get_field_table(fields, replacements).labels['email'].replacement, 'username')
+
+    def testSingleField(self):
+        spec = {'label': 'email', 'lookup': 'icontains'}
+        tables = set()
+        for query in ('/?email=arsham', '/?email=ivan'):
+            search_bar = SearchBar(RequestFactory().get(query), spec, method='get')
+            self.assertTrue(search_bar.is_valid())
+            tables.add(id(search_bar.table))
+        self.assertEqual(len(tables), 1)
+        self.assertIs(search_bar.table, get_field_table(spec, search_bar.replacements))
+        self.assertEqual(search_bar.get_lookups(), [('email__icontains', 'ivan')])
+
+        spec['lookup'] = 'iexact'
+        self.assertEqual(get_field_table(spec).labels['email'].lookup, 'iexact')
+        search_bar = SearchBar(RequestFactory().get('/?username=ivan'), 'username', method='get')
+        self.assertIs(search_bar.table, get_field_table('username', search_bar.replacements))
+        search_bar.fields = ['email']
+        self.assertEqual(list(search_bar.table.labels), ['email'])
+
+    def testSharedAcrossRequests(self):
+        clear_table_cache()
+        with mock.patch('django_searchbar.compiled.FieldTable', wraps=FieldTable) as field_table:
+            for username in ['arsham', 'ivan', 'arsham', 'ivan', 'arsham']:
+                response = UserSearchView.as_view()(RequestFactory().get('/?username=%s' % username))
+                self.assertEqual(response.context_data['search_bar']['username'], username)
+            # Equal replacements share the table
+            get_field_table(UserSearchView.searchbar_fields, {})
+        self.assertEqual(field_table.call_count, 1)
+
+    def testAllocationBenchmark(self):
+        from django_searchbar.benchmarks import allocations
+        results = allocations.run(number=5, repeat=1)
+        self.assertLess(results['field table peak (bytes)'], results['freeze_spec peak (bytes)'])
+        self.assertGreater(results['search bar retained (blocks)'], 0)
+
+
+class ConditionalGetTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.arsham = User.objects.create(username='arsham', email='arsham@example.com')
+        User.objects.create(username='ivan', email='ivan@example.com')
+        self.view = UserSearchView.as_view(searchbar_etag=True, paginate_by=10, ordering=('pk',))
+
+    def get(self, query, view=None, **headers):
+        return (view or self.view)(RequestFactory().get(query, **headers))
+
+    def testNotModified(self):
+        response = self.get('/?username=arsham')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([user.username for user in response.context_data['object_list']], ['arsham'])
+        self.assertIn('value="arsham"', response.render().content.decode())
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('"'))
+        self.assertNotIn('Last-Modified', response)
+
+        # The search key is normalized, so is the order of the parameters
+        with self.assertNumQueries(0):
+            response = self.get('/?email=&username=arsham', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertFalse(hasattr(response, 'context_data'))
+
+        self.assertNotEqual(self.get('/?username=ivan')['ETag'], etag)
+        self.assertNotEqual(self.get('/?username=arsham&tab=2')['ETag'], etag)
+        self.assertNotIn('ETag', UserSearchView.as_view()(RequestFactory().get('/?username=arsham')))
+
+        self.arsham.email = 'arsham@example.org'
+        self.arsham.save()
+        response = self.get('/?username=arsham', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual([user.email for user in response.context_data['object_list']], ['arsham@example.org'])
+
+    def testVersionsOfEachView(self):
+        view_class = type('OtherUserSearchView', (UserSearchView,), {})
+        self.assertIsNot(view_class.get_searchbar_versions(), UserSearchView.get_searchbar_versions())
+        self.assertIs(view_class.get_searchbar_versions(), view_class.get_searchbar_versions())
+        versions = ModelVersions(key_prefix='searchbar-etag')
+        view_class.searchbar_etag_versions = versions
+        self.assertIs(view_class.get_searchbar_versions(), versions)
+
+    def testVersionField(self):
+        view = UserSearchView.as_view(searchbar_etag=True, searchbar_etag_field='date_joined')
+        response = self.get('/?username=arsham', view)
+        last_modified = response['Last-Modified']
+        with self.assertNumQueries(1):
+            response = self.get('/?username=arsham', view, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        User.objects.create(username='arman', date_joined=timezone.now() + datetime.timedelta(days=1))
+        response = self.get('/?username=arsham', view, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    async def testAsync(self):
+        view = AsyncUserSearchView.as_view(searchbar_etag=True)
+        response = await view(AsyncRequestFactory().get('/?username=arsham'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([user.username for user in response.context_data['object_list']], ['arsham'])
+        response = await view(AsyncRequestFactory().get('/?username=arsham', headers={'If-None-Match': response['ETag']}))
+        self.assertEqual(response.status_code, 304)
+
+
+class AsyncMixinTestCase(TestCase):
+
+    def setUp(self):
+        for i in range(7):
+            User.objects.create(username='user%s' % i, email='%s@example.com' % ('even' if i % 2 else 'odd'))
+
+    async def testGet(self):
+        request = AsyncRequestFactory().get('/?email=odd@example.com')
+        response = await AsyncUserSearchView.as_view()(request)
+        object_list = response.context_data['object_list']
+        self.assertIsInstance(object_list, list)
+        self.assertEqual([u.username for u in object_list], ['user0', 'user2', 'user4', 'user6'])
+        self.assertIs(response.context_data['user_list'], object_list)
+        self.assertIn('value="odd@example.com"', str(response.context_data['search_bar']))
+
+    async def testPostAndPagination(self):
+        request = AsyncRequestFactory().post('/', {'email': 'even@example.com'})
+        response = await AsyncUserSearchView.as_view(searchbar_method='post', paginate_by=2)(request)
+        page = response.context_data['page_obj']
+        self.assertEqual(page.paginator.count, 3)
+        self.assertIsInstance(page.object_list, list)
+        self.assertEqual([u.username for u in response.context_data['object_list']], ['user1', 'user3'])
+
+    async def testAsyncReplacements(self):
+
+        async def replacement(field):
+            await asyncio.sleep(0)
+            return 'username'
+
+        class ReplacedView(AsyncUserSearchView):
+            searchbar_fields = ['name']
+            searchbar_replacements = {'name': replacement}
+
+        response = await ReplacedView.as_view()(AsyncRequestFactory().get('/?name=user3'))
+        self.assertEqual([u.username for u in response.context_data['object_list']], ['user3'])
+
+    async def testAsyncReplacementsAwaitedOnce(self):
+        calls = []
+
+        async def replacement(field):
+            calls.append(field)
+            return {'name': 'username', 'kind': 'email'}[field]
+
+        class ReplacedView(AsyncUserSearchView):
+            searchbar_fields = ['name', {'label': 'kind', 'choices': (('odd@example.com', 'Odd'),)}]
+            searchbar_replacements = {'name': replacement, 'kind': replacement}
+            searchbar_etag = True
+            searchbar_facets = True
+            searchbar_cache = SearchResultCache(key_prefix='searchbar-async')
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            response = await ReplacedView.as_view()(AsyncRequestFactory().get('/?name=user3'))
+        self.assertEqual([u.username for u in response.context_data['object_list']], ['user3'])
+        self.assertEqual(response.context_data['search_bar']['facets'], {'kind': {'odd@example.com': 0}})
+        self.assertEqual(sorted(calls), ['kind', 'name'])
+
+        search_bar = SearchBar(RequestFactory().get('/?name=user3'), ['name'], {'name': replacement}, 'get')
+        self.assertTrue(search_bar.is_valid())
+        with self.assertRaises(AssertionError):
+            search_bar.get_filters()
+        # The key doesn't need the replacement
+        self.assertEqual(search_bar.get_search_key(), (('name__exact', "'user3'"),))
+
+    async def testAsyncGetFilters(self):
+        search_bar = SearchBar(AsyncRequestFactory().get('/?name=user3&age=6'), ['name', 'age'],
+                               replacements={'name': lambda field: 'username'})
+        search_bar.is_valid()
+        filters = await search_bar.aget_filters()
+        self.assertEqual(filters, search_bar.get_filters())
+        self.assertIn("'username'", str(filters))
+
+    def testViewIsAsync(self):
+        self.assertTrue(AsyncUserSearchView.view_is_async)
+
+
+class ExportTestCase(TestCase):
+
+    def get(self, query, **kwargs):
+        view = UserSearchView.as_view(searchbar_export_columns=('username', 'email', 'is_staff'), **kwargs)
+        return view(RequestFactory().get(query))
+
+    def testCsv(self):
+        User.objects.create(username='arsham', email='arsham@example.com', is_staff=True)
+        User.objects.create(username='ivan', email='ivan@example.com')
+        response = self.get('/?username=arsham&export=csv')
+        self.assertIsInstance(response, StreamingHttpResponse)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="user.csv"')
+        self.assertEqual(b''.join(response.streaming_content).decode(),
+                         'username,email,is_staff\r\narsham,arsham@example.com,True\r\n')
+
+    def testJsonl(self):
+        User.objects.create(username='arsham', email='arsham@example.com')
+        response = self.get('/?export=jsonl')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines],
+                         [{'username': 'arsham', 'email': 'arsham@example.com', 'is_staff': False}])
+
+    def testNoExport(self):
+        self.assertNotIsInstance(self.get('/?export=xml'), StreamingHttpResponse)
+        response = UserSearchView.as_view()(RequestFactory().get('/?export=csv'))
+        self.assertNotIsInstance(response, StreamingHttpResponse)
+
+    def testMemoryStaysFlat(self):
+        rows = 100000
+        # bulk_create is limited to a few rows per query on sqlite, executemany is much faster
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                'INSERT INTO %s (password, is_superuser, username, first_name, last_name, email, is_staff, is_active, '
+                'date_joined) VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)' % User._meta.db_table,
+                (('', False, 'user%06d' % i, '', '', 'user%06d@example.com' % i, False, True, timezone.now())
+                 for i in range(rows)),
+            )
+        response = self.get('/?email=example.com&export=csv', searchbar_fields=[{'label': 'email', 'lookup': 'endswith'}])
+
+        tracemalloc.start()
+        try:
+            lines = sum(chunk.count(b'\n') for chunk in response.streaming_content)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(lines, rows + 1)
+        # The rows alone take well over 20MB when they are all in memory at once
+        self.assertLess(peak, 5 * 1024 * 1024)
+
 
 class IntegrationTestCase(TestCase):
 
@@ -355,3 +2286,70 @@ class IntegrationTestCase(TestCase):
         self.assertEqual(form['name'], 'arsham')
         self.assertEqual(form['age'], '6')
         self.assertEqual(form['order_by'], 'asc')
+
+
+class AsyncUserSearchView(AsyncSearchBarViewMixin, ListView):
+    model = User
+    template_name = 'django_searchbar/test.html'
+    searchbar_fields = ['username', 'email']
+    searchbar_method = 'get'
+
+
+class MixinTestCase(TestCase):
+
+    def setUp(self):
+        User.objects.create(username='arsham', email='arsham@example.com')
+        User.objects.create(username='ivan', email='ivan@example.com')
+
+    def testFilteringQueryset(self):
+        request = RequestFactory().get('/?username=arsham')
+        response = UserSearchView.as_view()(request)
+        self.assertEqual([u.username for u in response.context_data['object_list']], ['arsham'])
+
+        request = RequestFactory().post('/', {'username': 'ivan'})
+        response = UserSearchView.as_view(searchbar_method='post')(request)
+        self.assertEqual([u.username for u in response.context_data['object_list']], ['ivan'])
+
+    def testSearchBarIsBuiltOncePerRequest(self):
+        request = RequestFactory().get('/?username=arsham')
+        with mock.patch('django_searchbar.mixins.SearchBar', wraps=SearchBar) as search_bar, \
+                mock.patch.object(CompiledSearchBarForm, '__init__', autospec=True,
+                                  side_effect=CompiledSearchBarForm.__init__) as form:
+            response = UserSearchView.as_view()(request)
+            response.render()
+        self.assertEqual(search_bar.call_count, 1)
+        self.assertEqual(form.call_count, 1)
+        self.assertIn('value="arsham"', response.content.decode())
+
+    def testFieldTableIsReused(self):
+        tables = set()
+        for username in ['arsham', 'ivan']:
+            with mock.patch('django_searchbar.utils.get_field_table', wraps=get_field_table) as field_table:
+                response = UserSearchView.as_view()(RequestFactory().get('/?username=%s' % username))
+                response.render()
+            self.assertEqual(field_table.call_count, 1)
+            tables.add(id(response.context_data['search_bar'].table))
+        self.assertEqual(len(tables), 1)
+
+    def testMemoizedValidationAndFilters(self):
+        request = RequestFactory().get('/?username=arsham')
+        search_bar = SearchBar(request, ['username', {'label': 'email', 'required': True}])
+        self.assertFalse(search_bar.is_valid())
+        self.assertFalse(search_bar.is_valid())
+        self.assertEqual(len(search_bar.errors), 1)
+        self.assertIs(search_bar.get_filters(), search_bar.get_filters())
+        self.assertIsNot(search_bar.get_filters(), search_bar.get_filters(lookup_string='icontains'))
+
+    def testOverriddenGetSearchbar(self):
+
+        class CustomSearchBar(SearchBar):
+            pass
+
+        class CustomView(UserSearchView):
+            def get_searchbar(self, request):
+                return CustomSearchBar(request, ['email'], method='get')
+
+        request = RequestFactory().get('/?email=ivan@example.com')
+        response = CustomView.as_view()(request)
+        self.assertIsInstance(response.context_data['search_bar'], CustomSearchBar)
+        self.assertEqual([u.username for u in response.context_data['object_list']], ['ivan'])
@@ -1,6 +1,6 @@
-from django.conf.urls import patterns, url
+from django.urls import path
+from django_searchbar import views
 
-urlpatterns = patterns(
-    '',
-    url(r'^', 'django_searchbar.views.homepage'),
-)
+urlpatterns = [
+    path('', views.homepage),
+]
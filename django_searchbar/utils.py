@@ -1,12 +1,56 @@
 if __debug__:
     from django.http import HttpRequest
 
+import asyncio
 import collections
-from django_searchbar.forms import SearchBarForm
+import collections.abc
+import contextlib
+import copy
+from django_searchbar.compiled import get_field_table
+from django_searchbar.terms import SearchTerms, split_terms
+from django_searchbar.validation import FastForm
+from django_searchbar.budget import SearchTimeout
 from django import forms
 from django.middleware import csrf
 from django.utils.safestring import mark_safe
-from django.db.models import Q
+from django.db.models import Q, Count
+from django.db.models.query import QuerySet
+
+CSRF_PLACEHOLDER = '<!--searchbar-csrf-->'
+EMPTY_VALUES = (None, '', [], (), (None, None))
+TIMEOUT_ERROR = 'The search took too long, try narrowing it down'
+# The lookup of a search that isn't run
+NOTHING = ('pk__in', [])
+
+
+def get_lookup_name(field_name, lookup):
+    if lookup:
+        return "{field}__{method}".format(field=field_name, method=lookup)
+    return field_name
+
+
+def get_q(field_name, value):
+    """
+    Returns the Q object of a (lookup, value) pair, a pair without a lookup has a condition as value
+    """
+    if field_name:
+        return Q(**{field_name: value})
+    return Q(value)
+
+
+def iter_choices(choices):
+    """
+    Yields the (value, label) pairs of choices, as (value, label) tuples, {value: label} dictionaries or groups
+    """
+    for choice in choices:
+        if isinstance(choice, dict):
+            for value, label in choice.items():
+                yield value, label
+        elif isinstance(choice[1], (list, tuple)):
+            for value, label in iter_choices(choice[1]):
+                yield value, label
+        else:
+            yield choice[0], choice[1]
 
 
 def listify(item):
@@ -21,7 +65,7 @@ def listify(item):
     return item
 
 
-class SearchBar(collections.MutableMapping):
+class SearchBar(collections.abc.MutableMapping):
 
     """
     Usage:
@@ -30,19 +74,30 @@ class SearchBar(collections.MutableMapping):
             search_bar = SearchBar(request, ['name', 'age'])
             if search_bar.is_valid():
                 name_value = search_bar['name']
+
+        With fast=True, the input is validated by the fields without instantiating the form (see FastForm),
+        for the views that only need the values and the filters.
     """
 
-    def __init__(self, request, fields=None, replacements={}, method='post'):
+    fragment_cache = None
+    instrumentation = None
+    custom_fields = False
+    facets = None
+    budget = None
+    over_budget = False
+
+    def __init__(self, request, fields=None, replacements={}, method='post', fast=False):
 
         assert isinstance(request, HttpRequest), 'request should be an instance of the HttpRequest object'
         assert isinstance(fields, (type(None), list, tuple, str, dict)), 'fields should be None, list or a tuple containing strings'
-        assert isinstance(replacements, (dict, collections.Callable)), 'fields should be dictionary or a callable'
+        assert isinstance(replacements, (dict, collections.abc.Callable)), 'fields should be dictionary or a callable'
 
         if __debug__:
             def check_dict(item):
                 assert 'label' in item, 'Your fields should have a label'
                 if 'choices' in item:
-                    assert isinstance(item['choices'], collections.Iterable), 'Your choices should be a dict'
+                    assert isinstance(item['choices'], collections.abc.Iterable) or callable(item['choices']), \
+                        'Your choices should be iterable or a callable'
 
             if isinstance(fields, (list, tuple)):
                 for item in fields:
@@ -52,24 +107,77 @@ class SearchBar(collections.MutableMapping):
             elif isinstance(fields, dict):
                 check_dict(fields)
 
+        # The spec as given, its field table is shared by the search bars of the spec
+        self.__spec = fields
         if fields:
             fields = listify(fields)
 
         self.request = request
         self.replacements = replacements
-        self.fields = fields
+        self.fields = self.__fields = fields
         self.old_fields = None
         self.action = ''
         self.method = method.lower().strip()
+        self.fast = fast
         self.__form = None
+        self.__table = None
+        # The spec and the replacements the table was looked up for
+        self.__table_for = (None, None)
+        self.__validations = set()
+        self.__filters = {}
+        self.__search_keys = {}
+        # The results of the replacements that are coroutine functions, see aresolve_replacements
+        self.__awaited = {}
         self.errors = []
 
+    def stage(self, name, queryset=None):
+        """
+        Returns the context manager measuring the stage ``name``, see django_searchbar.instrumentation
+        """
+        if self.instrumentation is None:
+            return contextlib.nullcontext()
+        return self.instrumentation.stage(self, name, queryset)
+
+    @contextlib.contextmanager
+    def limit(self, queryset=None):
+        """
+        Runs the queries of the block within the time budget of the search, see django_searchbar.budget.SearchBudget
+        A timeout adds TIMEOUT_ERROR to errors and raises SearchTimeout.
+        """
+        if self.budget is None or not isinstance(queryset, QuerySet):
+            yield
+            return
+
+        try:
+            with self.budget.limit(queryset.db):
+                yield
+        except SearchTimeout:
+            if TIMEOUT_ERROR not in self.errors:
+                self.errors.append(TIMEOUT_ERROR)
+            raise
+
+    @property
+    def table(self):
+        """
+        The FieldTable of the spec: its fields and their resolved replacements, shared by the search bars of the spec
+        """
+        # A single field was put in a list by __init__, the table is the one of the spec as given
+        fields = (self.__spec if self.fields is self.__fields else self.fields) or ()
+        source, replacements = self.__table_for
+        if source is not fields or replacements is not self.replacements:
+            self.__table = get_field_table(fields, self.replacements)
+            self.__table_for = (fields, self.replacements)
+        return self.__table
+
     @property
     def form(self):
         if not self.__form and self.old_fields != self.fields:
-            self.__form = SearchBarForm(self.request.GET or self.request.POST, fields=self.fields)
-            self.__form.is_valid()
-            self.old_fields = self.fields
+            with self.stage('form'):
+                form_class = self.table.form_class
+                data = self.request.GET or self.request.POST
+                self.__form = FastForm(form_class, data) if self.fast else form_class(data)
+                self.__form.is_valid()
+                self.old_fields = self.fields
 
         return self.__form
 
@@ -77,9 +185,20 @@ class SearchBar(collections.MutableMapping):
         """
         Validates the SearchBar instance.
         All required argument you pass here, should end up in request results to pass.
+        The checks run once per set of arguments, calling it again reuses the outcome.
         @return bool
         """
 
+        if args in self.__validations:
+            return not self.errors
+
+        with self.stage('is_valid'):
+            self.__validate(*args)
+        self.__validations.add(args)
+        return not self.errors
+
+    def __validate(self, *args):
+
         def check_validation(self, item):
             if isinstance(item, dict):
                 if item.get('required', False) and self.form.cleaned_data.get(item['label'], '') == '':
@@ -90,7 +209,7 @@ class SearchBar(collections.MutableMapping):
 
         if not self.fields:
             self.errors.append('There is no field set')
-            return False
+            return
 
         form_validation = self.form.is_valid()
 
@@ -105,49 +224,309 @@ class SearchBar(collections.MutableMapping):
         else:
             self.errors.append('Values in form was failed by form itself')
 
-        return not self.errors
+        if form_validation:
+            self.check_budget(self.get_active_fields())
+
+    def check_budget(self, active_fields):
+        """
+        Adds the errors of a search beyond its budget, see django_searchbar.budget.SearchBudget
+        @param active_fields: the (field, lookup, value) of the search, with the lookups it runs with
+        @return bool: True when the search is within the budget
+        """
+        if self.budget is None:
+            return True
+        errors = self.budget.check(active_fields)
+        self.errors.extend(error for error in errors if error not in self.errors)
+        if errors:
+            self.over_budget = True
+        return not errors
+
+    def render_form(self):
+        """
+        Renders the whole form, with CSRF_PLACEHOLDER where the csrf token goes
+        """
+        submit_button = '<input type="submit" value="submit" />'
+        with self.stage('render'):
+            return "<form method='%s' action='%s'>%s %s %s</form>" % (self.method, self.action, CSRF_PLACEHOLDER, self.form, submit_button)
 
     def as_form(self):
+        if self.fragment_cache is not None and not self.custom_fields:
+            return_string = self.fragment_cache.render(self, 'as_form', self.render_form)
+        else:
+            return_string = self.render_form()
+
         csrf_ = ''
         if self.method == 'post':
             csrf_ = "<input type='hidden' name='csrfmiddlewaretoken' value='{0}' />".format(csrf.get_token(self.request))
-        submit_button = '<input type="submit" value="submit" />'
-        return_string = "<form method='%s' action='%s'>%s %s %s</form>" % (self.method, self.action, csrf_, self, submit_button)
-        return mark_safe(return_string)
+        return mark_safe(return_string.replace(CSRF_PLACEHOLDER, csrf_))
 
     def get_filters(self, *args, lookup_string=''):
         """
         Returns a Q object based on all the input from query term
         @param lookup_string: adds this ``lookup_string`` to query lookup of all fields
         @param args: if provided, items you need to be in queryset. otherwise it's everything
+        The Q object is built once per arguments and reused afterwards.
         """
-        filters = Q()
         lookup_string = lookup_string.lower().strip()
+        key = (args, lookup_string)
+        if key not in self.__filters:
+            with self.stage('get_filters'):
+                filters = Q()
+                for field_name, value in self.get_lookups(*args, lookup_string=lookup_string):
+                    filters &= get_q(field_name, value)
+                self.__filters[key] = filters
+        return self.__filters[key]
+
+    def get_lookups(self, *args, lookup_string=''):
+        """
+        Returns the (lookup, value) pairs get_filters builds its Q object from, after
+        replacements and ignore lists are applied
+        A field's own lookup (the 'lookup' key of its dict) takes precedence over ``lookup_string``,
+        'in' with a single value becomes an exact match, 'range' with one bound becomes gte/lte.
+        A search beyond its budget with the lookups it runs with gets an error, and a lookup matching nothing.
+        @return list
+        """
+        active_fields = self.get_active_fields(*args, lookup_string=lookup_string)
+        if not self.check_budget(active_fields):
+            return [NOTHING]
+        return [self.get_lookup(field, field_lookup, value) for field, field_lookup, value in active_fields]
 
-        if args:
-            __fields = [k for k in self.fields if k in args]
-        else:
-            __fields = self.fields
-
-        for field in __fields:
+    def get_lookup(self, field, field_lookup, value, replacement=None):
+        """
+        Returns the (lookup, value) pair of an active field
+        Full text fields become a primary key subquery of their backend: pk__in, or <replacement>__in.
+        Terms fields have no lookup, their value is a SearchTerms condition over the replacement targets.
+        """
+        if replacement is None:
+            replacement = self.get_replacement(field)
+        if field_lookup == 'match':
+            if field not in self.replacements:
+                replacement = 'pk'
+            return get_lookup_name(replacement, 'in'), self.get_field_spec(field)['fulltext'].search(value)
+        if field_lookup == 'terms':
+            spec = self.get_field_spec(field) or {}
+            return '', SearchTerms(listify(replacement), value, spec.get('lookup', 'icontains'))
+        return get_lookup_name(replacement, field_lookup), value
+
+    def get_field_spec(self, label):
+        """
+        Returns the dictionary of a field in the spec, or None
+        """
+        spec = self.table.labels.get(label)
+        if spec is None:
+            return None
+        return spec.spec
 
-            ignore_list = []
-            if isinstance(field, dict):
-                ignore_list = field.get('ignore_list', [])
-                field = field['label']
+    def get_replacement(self, field):
+        """
+        Returns the name the field has in the queries, after replacements
+        Those of the fields in the spec are resolved once for the spec, see FieldTable. A coroutine function
+        has to be awaited by aresolve_replacements (or aget_filters) first.
+        """
+        spec = self.table.labels.get(field)
+        if spec is not None and spec.resolved:
+            return spec.replacement
+        if field in self.__awaited:
+            return self.__awaited[field]
+        replacement = self.replacements.get(field, field)
+        assert not asyncio.iscoroutinefunction(replacement), \
+            'The replacement of %s is a coroutine function, await aresolve_replacements() first' % field
+        if isinstance(replacement, collections.abc.Callable):
+            replacement = replacement(field)
+        return replacement
+
+    async def aresolve_replacements(self, fields=None):
+        """
+        Awaits the replacements that are coroutine functions, once for the search bar, so get_replacement and
+        the methods using it (get_search_key, count_facets, filter...) have their results
+        @param fields: the labels to resolve, all those of the spec by default
+        """
+        if fields is None:
+            fields = [spec.label for spec in self.table.fields]
+        for field in fields:
+            if field in self.__awaited:
+                continue
+            spec = self.table.labels.get(field)
+            replacement = spec.replacement if spec is not None else self.replacements.get(field, field)
+            if asyncio.iscoroutinefunction(replacement):
+                self.__awaited[field] = await replacement(field)
+
+    async def aget_filters(self, *args, lookup_string=''):
+        """
+        Same as get_filters, callable replacements can be coroutine functions, e.g. if they need I/O
+        """
+        lookup_string = lookup_string.lower().strip()
+        key = (args, lookup_string)
+        if key not in self.__filters:
+            filters = Q()
+            for field_name, value in await self.aget_lookups(*args, lookup_string=lookup_string):
+                filters &= get_q(field_name, value)
+            self.__filters[key] = filters
+        return self.__filters[key]
+
+    async def aget_lookups(self, *args, lookup_string=''):
+        """
+        Same as get_lookups, awaiting the replacements that are coroutine functions
+        """
+        active_fields = self.get_active_fields(*args, lookup_string=lookup_string)
+        if not self.check_budget(active_fields):
+            return [NOTHING]
+        await self.aresolve_replacements([field for field, field_lookup, value in active_fields])
+        return [self.get_lookup(field, field_lookup, value) for field, field_lookup, value in active_fields]
 
-            if self[field] and not self[field] in ignore_list:
-                replacement = self.replacements.get(field, field)
-                if isinstance(replacement, collections.Callable):
-                    replacement = replacement(field)
+    def get_active_fields(self, *args, lookup_string=''):
+        """
+        Returns the (field, lookup, value) of the fields that take part in the filters, before replacements
+        It's a single pass over the precompiled fields of the spec and the cleaned data.
+        @return list
+        """
+        active_fields = []
+        lookup_string = lookup_string.lower().strip()
+        cleaned_data = self.form.cleaned_data
+
+        for spec in self.table.fields:
+            # The arguments name the fields given by their name
+            if args and (spec.spec is not None or spec.label not in args):
+                continue
+
+            field = spec.label
+            field_lookup = lookup_string if spec.lookup is None else spec.lookup
+            ignore_list = spec.ignore_list
+            value = cleaned_data.get(field, '')
+            if field_lookup == 'terms':
+                value = split_terms(value, spec.max_terms)
+                if self.budget is not None:
+                    value = self.budget.simplify_terms(value)
+            elif field_lookup == 'in':
+                value = [item for item in value if item not in ignore_list]
+                if len(value) == 1:
+                    field_lookup, value = '', value[0]
+            elif field_lookup == 'range' and value:
+                lower, upper = value
+                if lower is None:
+                    field_lookup, value = 'lte', upper
+                elif upper is None:
+                    field_lookup, value = 'gte', lower
+
+            if value in EMPTY_VALUES or value in ignore_list:
+                continue
+
+            active_fields.append((field, field_lookup, value))
+        return active_fields
+
+    def order_by_rank(self, queryset, alias='search_rank'):
+        """
+        Orders the queryset by the relevance of the first full text field that has an input
+        """
+        for field, field_lookup, value in self.get_active_fields():
+            if field_lookup == 'match':
+                return self.get_field_spec(field)['fulltext'].rank(queryset, value, alias)
+        return queryset
 
-                if lookup_string:
-                    field_name = "{field}__{method}".format(field=replacement, method=lookup_string)
+    def count_facets(self, queryset, lookup_string=''):
+        """
+        Counts, in a single aggregate query, how many results each choice of the choice fields would return.
+        The count of a field's choice applies the filters of all the other fields, values in its ignore_list
+        are left out. The counts are shown next to the choices and returned by search_bar['facets'].
+        @param queryset: the queryset before the search filters
+        @return dict: {label: {value: count}}
+        """
+        active_fields = [(field,) + self.get_lookup(field, field_lookup, value)
+                         for field, field_lookup, value in self.get_active_fields(lookup_string=lookup_string)]
+        aggregates = {}
+        facets = []
+
+        for item in self.fields or []:
+            if not isinstance(item, dict) or 'choices' not in item:
+                continue
+
+            label = item['label']
+            others = Q()
+            for field, field_name, value in active_fields:
+                if field != label:
+                    others &= get_q(field_name, value)
+
+            replacement = self.get_replacement(label)
+            ignore_list = item.get('ignore_list', [])
+            # The field has the loaded choices of querysets and callables
+            choices = self.form.fields[label].choices if label in self.form.fields else item['choices']
+            for value, choice_label in iter_choices(choices):
+                if value in ignore_list:
+                    continue
+                alias = 'facet_%s' % len(aggregates)
+                aggregates[alias] = Count('pk', distinct=True, filter=others & Q(**{replacement: value}))
+                facets.append((label, value, alias))
+
+        results = {}
+        if aggregates:
+            with self.limit(queryset):
+                results = queryset.aggregate(**aggregates)
+        self.facets = collections.OrderedDict()
+        for label, value, alias in facets:
+            self.facets.setdefault(label, collections.OrderedDict())[value] = results[alias]
+
+        def add_counts(choices, counts):
+            for choice in choices:
+                if isinstance(choice, dict):
+                    yield from add_counts(choice.items(), counts)
+                elif isinstance(choice[1], (list, tuple)):
+                    yield choice[0], list(add_counts(choice[1], counts))
+                elif choice[0] in counts:
+                    yield choice[0], '%s (%s)' % (choice[1], counts[choice[0]])
                 else:
-                    field_name = replacement
+                    yield choice
+
+        for label, counts in self.facets.items():
+            if label in self.form.fields:
+                field = self.form.fields[label]
+                if getattr(self.form, 'shares_fields', False):
+                    field = self.form.fields[label] = copy.deepcopy(field)
+                field.choices = list(add_counts(field.choices, counts))
+        return self.facets
 
-                filters &= Q(**{field_name: self[field]})
-        return filters
+    def get_search_key(self, *args, lookup_string=''):
+        """
+        Returns a hashable, normalized key of the search: the sorted lookups and their values.
+        Two requests producing the same filters share the same key. A full text field is keyed by its input,
+        so working out the key doesn't run the search of its backend, and a field with a coroutine replacement
+        by its label, so it doesn't have to be awaited. The budget is checked without adding its errors.
+        @return tuple
+        """
+        key = (args, lookup_string.lower().strip())
+        if key not in self.__search_keys:
+            active_fields = self.get_active_fields(*args, lookup_string=lookup_string)
+            if self.budget is not None and self.budget.check(active_fields):
+                lookups = [NOTHING]
+            else:
+                lookups = [('%s__%s' % (field, field_lookup or 'exact'), value)
+                           if field_lookup == 'match' or not self.table.labels[field].resolved
+                           else self.get_lookup(field, field_lookup, value)
+                           for field, field_lookup, value in active_fields]
+            self.__search_keys[key] = tuple(sorted((field_name, repr(value)) for field_name, value in lookups))
+        return self.__search_keys[key]
+
+    def evaluate(self, queryset):
+        """
+        Fetches the results of the queryset, in the 'evaluate' stage when the search bar is instrumented,
+        and within its time budget (raises SearchTimeout past it)
+        @return the queryset, with its results loaded
+        """
+        with self.stage('evaluate', queryset), self.limit(queryset):
+            len(queryset)
+        return queryset
+
+    def filter(self, queryset, *args, lookup_string='', cache=None, single_flight=None):
+        """
+        Filters the queryset with get_filters
+        @param cache: a django_searchbar.cache.SearchResultCache to reuse the results of the same searches
+        @param single_flight: a django_searchbar.coalescing.SingleFlight to share the query of the identical
+                              searches running at the same time, when there is no cache (give it to the cache otherwise)
+        """
+        if cache is not None:
+            return cache.filter(queryset, self, *args, lookup_string=lookup_string)
+        if single_flight is not None:
+            return single_flight.filter(queryset, self, *args, lookup_string=lookup_string)
+        return queryset.filter(self.get_filters(*args, lookup_string=lookup_string))
 
     def __contains__(self, key):
 
@@ -158,10 +537,25 @@ class SearchBar(collections.MutableMapping):
         if key == 'as_form':
             return self.as_form()
 
+        if key == 'facets':
+            return self.facets or {}
+
         return self.form.cleaned_data.get(key, '')
 
+    def reset(self):
+        """
+        Forgets the memoized validation and filters, e.g. after the fields have changed
+        Rendering doesn't use the fragment cache after that, the fields don't match the spec anymore.
+        """
+        self.__validations = set()
+        self.__filters = {}
+        self.__search_keys = {}
+        self.custom_fields = True
+
     def __setitem__(self, key, value):
 
+        self.reset()
+
         if isinstance(value, str):
 
             self.form.fields[key] = forms.CharField(label=value, required=False)
@@ -184,6 +578,8 @@ class SearchBar(collections.MutableMapping):
 
     def __delitem__(self, key):
 
+        self.reset()
+
         self.form.fields.pop(key)
 
     def __iter__(self):
@@ -197,4 +593,11 @@ class SearchBar(collections.MutableMapping):
 
     def __str__(self):
 
-        return str(self.form)
+        if self.fragment_cache is not None and not self.custom_fields:
+            return self.fragment_cache.render(self, 'str', self.render_fields)
+        return self.render_fields()
+
+    def render_fields(self):
+
+        with self.stage('render'):
+            return str(self.form)
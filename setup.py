@@ -15,14 +15,17 @@ setup(
     long_description=read_file('README.md'),
     classifiers=[
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.2',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Topic :: Software Development :: Libraries',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: BSD License',
         'Operating System :: OS Independent',
         'Framework :: Django',
+        'Framework :: Django :: 4.1',
+        'Framework :: Django :: 4.2',
         'Environment :: Web Environment',
     ],
     keywords=['searchbar', 'django', 'forms', 'template'],
@@ -32,5 +35,7 @@ setup(
     url='http://github.com/arsham/django-searchbar',
     license='BSD',
     packages=find_packages(),
+    install_requires=['Django>=4.1'],
+    python_requires='>=3.8',
     zip_safe=False,
 )